@@ -6,12 +6,15 @@ sys.path.append(f"{os.path.dirname(__file__)}/utils")
 
 from utils.statcom_child import Statcom
 from utils.meter_satec_child import Meter
+from utils.meter_forwarder import MeterForwarder
 
 import argparse
 import curses
-import numpy as np
 import time
 
+LIFESIGN_MODULUS = 2**16
+STATCOM_METER_REGISTERS_ADDRESS = 1109
+
 
 class Monitor:
     statcom_addr: str
@@ -24,6 +27,9 @@ class Monitor:
     reg_statcom: dict
     update_freq: float
     update_time: float
+    local_lifesign: bool
+    statcom_read_time: float
+    adaptive: bool
 
     def __init__(
         self,
@@ -32,6 +38,9 @@ class Monitor:
         port: int,
         update_freq: float,
         gui: bool = True,
+        local_lifesign: bool = False,
+        statcom_read_freq: float = 1.0,
+        adaptive: bool = False,
     ) -> None:
         # CLI Setup
         self.gui = gui
@@ -98,6 +107,12 @@ class Monitor:
         self.reg_meter_grid = self.meter_grid.update_read()
         self.reg_statcom = self.statcom.update_read()
 
+        # The meter registers are decoded straight into a preallocated Statcom
+        # payload, so the update loop doesn't allocate per cycle
+        self.meter_forwarder = MeterForwarder.from_meter(
+            self.meter_grid, STATCOM_METER_REGISTERS_ADDRESS
+        )
+
         self._screen_refresh_time = 0.2
         self._screen_old_time = time.perf_counter()
 
@@ -105,6 +120,28 @@ class Monitor:
         self.update_time = 1 / self.update_freq
         self._update_old_time = time.perf_counter()
 
+        # In adaptive mode the update rate follows the slower of the two
+        # devices' poll rate controllers, starting from -F.
+        self.adaptive = adaptive
+        if self.adaptive:
+            for device in [self.meter_grid, self.statcom]:
+                device.set_reporting_period(self.update_time)
+                device.enable_adaptive_polling()
+
+        # In local lifesign mode the lifesign counters are kept here and only
+        # resynced from the Statcom at startup or after a failed write, so the
+        # full Statcom state is read at its own slower rate.
+        self.local_lifesign = local_lifesign
+        self.statcom_read_time = 1 / statcom_read_freq
+        self._statcom_read_old_time = time.perf_counter()
+        self._lifesign_resync = False
+        self._resync_lifesign()
+
+        # Meter readings that didn't fit the Statcom registers, their writes
+        # are skipped
+        self.forward_errors = 0
+        self.last_forward_error = None
+
     def _check_screen(self):
         passed = True
         self.screen.refresh()
@@ -148,7 +185,7 @@ class Monitor:
         self.screen.addstr(
             self._freq_row,
             self._meter_name_col + 12 + 4,
-            f"{self.update_freq}",
+            f"{self.update_freq:.1f}",
             curses.color_pair(3),
         )
         self.screen.addstr(
@@ -190,11 +227,11 @@ class Monitor:
                         f"{direction} {p_type[0]} {ph}:",
                         curses.color_pair(1),
                     )
-                    # Convert using numpy because the STATCOM stores the values as uint16 but the values are realistically an int16.
+                    # The register map decodes the powers as int16
                     self.screen.addstr(
                         row,
                         self._statcom_value_col,
-                        f"{np.array((self.reg_statcom.get(f'{direction}_Meter_{p_type[0]}_Power_{ph}'))).astype(np.int16)}",
+                        f"{int(self.reg_statcom.get(f'{direction}_Meter_{p_type[0]}_Power_{ph}')):d}",
                         curses.color_pair(3),
                     )
                     self.screen.addstr(
@@ -213,11 +250,18 @@ class Monitor:
             self.screen.addstr(
                 row,
                 self._statcom_value_col,
-                f"{int(self.reg_statcom.get(f'{direction}_Meter_Lifesign')):d}",
+                f"{self._get_lifesign(direction):d}",
                 curses.color_pair(3),
             )
             row += 1
 
+    def _get_lifesign(self, direction: str) -> int:
+        if self.local_lifesign:
+            if direction == "Export":
+                return self._export_lifesign
+            return self._generation_lifesign
+        return int(self.reg_statcom.get(f"{direction}_Meter_Lifesign"))
+
     def _timed_out(self, old_time: float, dt: float):
         if time.perf_counter() - old_time > dt:
             return True
@@ -232,26 +276,33 @@ class Monitor:
             self._update_old_time = time.perf_counter()
             return True
 
-    def _get_meter_grid_power(self):
-        kVA_meter = []
-        kW_meter = []
-        for ph in range(3):
-            val = self.reg_meter_grid.get(f"kVA_{ph+1}", None)
-            if val is None:
-                raise ValueError("Satec register missing kVA value.")
-            val = int(val)
-            if val < 0:
-                val += 2**16
-            kVA_meter += [val]
-
-            val = self.reg_meter_grid.get(f"kW_{ph+1}", None)
-            if val is None:
-                raise ValueError("Satec register missing kW value.")
-            val = int(val)
-            if val < 0:
-                val += 2**16
-            kW_meter += [val]
-        return kVA_meter, kW_meter
+    def _statcom_read_timed_out(self):
+        if self._timed_out(self._statcom_read_old_time, self.statcom_read_time):
+            self._statcom_read_old_time = time.perf_counter()
+            return True
+
+    def _resync_lifesign(self):
+        self._export_lifesign = int(self.reg_statcom.get("Export_Meter_Lifesign"))
+        self._generation_lifesign = int(
+            self.reg_statcom.get("Generation_Meter_Lifesign")
+        )
+        self._lifesign_resync = False
+
+    def _next_lifesign(self):
+        self._export_lifesign = (self._export_lifesign + 1) % LIFESIGN_MODULUS
+        self._generation_lifesign = (self._generation_lifesign + 1) % LIFESIGN_MODULUS
+        return self._export_lifesign, self._generation_lifesign
+
+    def _write_statcom(self, register_blocks):
+        """
+        Writes the register blocks to the Statcom. Returns False if the write
+        raised or the Statcom answered with a Modbus exception response.
+        """
+        try:
+            function_codes = self.statcom.write_modbus(register_blocks)
+        except Exception:
+            return False
+        return all(code < 0x80 for code in function_codes)
 
     def run_no_gui(self):
         print("Running without GUI...")
@@ -260,35 +311,60 @@ class Monitor:
 
     def _update(self):
         if self._update_timed_out():
-            self.reg_meter_grid = self.meter_grid.update_read()
-            self.reg_statcom = self.statcom.update_read()
-
-            # Get values to be written to Statcom.
-            kVA_meter, kW_meter = self._get_meter_grid_power()
-            export_lifesign = int(self.reg_statcom.get("Export_Meter_Lifesign")) + 1
-            generation_lifesign = (
-                int(self.reg_statcom.get("Generation_Meter_Lifesign")) + 1
+            raw_meter_regs = self.meter_grid.read_modbus(
+                self.meter_forwarder.get_read_blocks()
             )
 
-            write_meter_regs = [
-                [
-                    1109,
-                    kVA_meter
-                    + kW_meter
-                    + [export_lifesign]
-                    + kVA_meter
-                    + kW_meter
-                    + [generation_lifesign],
-                ]
-            ]
-
-            self.statcom.write_modbus(write_meter_regs)
+            if self.local_lifesign:
+                if self._lifesign_resync or self._statcom_read_timed_out():
+                    self.reg_statcom = self.statcom.update_read()
+                    if self._lifesign_resync:
+                        self._resync_lifesign()
+                export_lifesign, generation_lifesign = self._next_lifesign()
+            else:
+                self.reg_statcom = self.statcom.update_read()
+                export_lifesign = (
+                    int(self.reg_statcom.get("Export_Meter_Lifesign")) + 1
+                ) % LIFESIGN_MODULUS
+                generation_lifesign = (
+                    int(self.reg_statcom.get("Generation_Meter_Lifesign")) + 1
+                ) % LIFESIGN_MODULUS
+
+            # Get values to be written to Statcom. A value out of range fails
+            # the write, the Statcom then sees the lifesign stop.
+            try:
+                self.meter_forwarder.forward(
+                    raw_meter_regs, export_lifesign, generation_lifesign
+                )
+            except ValueError as e:
+                self.forward_errors += 1
+                self.last_forward_error = str(e)
+                if self.local_lifesign:
+                    self._lifesign_resync = True
+                return
+
+            if (
+                not self._write_statcom(self.meter_forwarder.get_write_blocks())
+                and self.local_lifesign
+            ):
+                self._lifesign_resync = True
+
+            if self.adaptive:
+                self._update_adaptive_rate()
+
+    def _update_adaptive_rate(self):
+        self.update_time = max(
+            self.meter_grid.get_reporting_period(),
+            self.statcom.get_reporting_period(),
+        )
+        self.update_freq = 1 / self.update_time
 
     def _display(self, _):
         while True:
             self._update()
 
             if self._screen_timed_out() and self._check_screen():
+                self.reg_meter_grid.update(self.meter_forwarder.get_readings())
                 self.screen.clear()
                 self._print_headings()
                 self._print_meter_grid()
@@ -341,6 +417,27 @@ if __name__ == "__main__":
         action="store_true",
         help="Whether to run in quiet mode with no GUI.",
     )
+    parser.add_argument(
+        "-L",
+        "--local-lifesign",
+        required=False,
+        action="store_true",
+        help="Keep the Statcom lifesign counters locally instead of reading them every update.",
+    )
+    parser.add_argument(
+        "--statcom-freq",
+        required=False,
+        type=float,
+        default=1.0,
+        help="Statcom state read frequency when using local lifesign [Hz].",
+    )
+    parser.add_argument(
+        "-A",
+        "--adaptive",
+        required=False,
+        action="store_true",
+        help="Adapt the update frequency to the measured device latency, starting from FREQ.",
+    )
 
     args = parser.parse_args()
 
@@ -350,5 +447,8 @@ if __name__ == "__main__":
         port=args.port,
         update_freq=args.Freq,
         gui=not args.q,
+        local_lifesign=args.local_lifesign,
+        statcom_read_freq=args.statcom_freq,
+        adaptive=args.adaptive,
     )
     monitor.run()
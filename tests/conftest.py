@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules in utils/ import each other by their bare names
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "utils"))
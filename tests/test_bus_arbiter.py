@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from bus_arbiter import MIN_INTER_FRAME_GAP, BusArbiter, get_inter_frame_gap
+
+
+class Response():
+    def __init__(self, error=False) -> None:
+        self.error = error
+
+    def isError(self):
+        return self.error
+
+
+class Connection():
+    """
+    Records the units served, holding the bus for a short time per request.
+    """
+
+    def __init__(self, served, request_time=0.0) -> None:
+        self.served = served
+        self.request_time = request_time
+        self.closed = 0
+
+    def read_holding_registers(self, address, count=1, unit=None):
+        self.served.append(unit)
+        time.sleep(self.request_time)
+        return Response(error=address < 0)
+
+    def close(self):
+        self.closed += 1
+
+
+def test_inter_frame_gap():
+    assert get_inter_frame_gap(9600) == pytest.approx(3.5 * 11 / 9600)
+    assert get_inter_frame_gap(115200) == MIN_INTER_FRAME_GAP
+
+
+def test_requests_and_errors_are_counted_per_unit():
+    served = []
+    arbiter = BusArbiter([Connection(served)])
+    client = arbiter.get_client(1)
+    client.read_holding_registers(0, 2)
+    client.read_holding_registers(-1, 2)
+    arbiter.get_client(2).read_holding_registers(0, 2)
+
+    assert served == [1, 1, 2]
+    stats = arbiter.get_stats()
+    assert stats[1]["requests"] == 2 and stats[1]["errors"] == 1
+    assert stats[2]["requests"] == 1 and stats[2]["errors"] == 0
+    assert stats[1]["latency_ewma"] is not None
+
+
+def test_batch_is_reentrant():
+    connection = Connection([])
+    arbiter = BusArbiter([connection])
+    with arbiter.batch(1) as client:
+        with arbiter.batch(1) as inner_client:
+            assert inner_client is client
+        arbiter.get_client(1).read_holding_registers(0)
+    # The connection is free again for another thread
+    thread = threading.Thread(target=arbiter.get_client(2).read_holding_registers, args=(0,))
+    thread.start()
+    thread.join(1.0)
+    assert not thread.is_alive()
+
+
+def test_units_are_served_round_robin():
+    served = []
+    arbiter = BusArbiter([Connection(served, request_time=0.002)])
+
+    def poll(unit_id, count):
+        client = arbiter.get_client(unit_id)
+        for _ in range(count):
+            client.read_holding_registers(0)
+
+    # Unit 1 queues 3 requests at once, units 2 and 3 one each
+    with arbiter.batch(0):
+        threads = [threading.Thread(target=poll, args=(1, 1)) for _ in range(3)]
+        threads += [threading.Thread(target=poll, args=(unit_id, 1)) for unit_id in (2, 3)]
+        for queue_depth, thread in enumerate(threads, 1):
+            thread.start()
+            while arbiter.get_queue_depth() < queue_depth:
+                time.sleep(0.001)
+        assert arbiter.get_unit_stats(1)["queue_depth"] == 3
+    for thread in threads:
+        thread.join()
+
+    assert served == [1, 2, 3, 1, 1]
+
+
+def test_sleep_releases_the_connection():
+    served = []
+    arbiter = BusArbiter([Connection(served)])
+    with arbiter.batch(1):
+        thread = threading.Thread(target=arbiter.get_client(2).read_holding_registers, args=(0,))
+        thread.start()
+        arbiter.sleep(0.05)
+        assert served == [2]
+        arbiter.get_client(1).read_holding_registers(0)
+    thread.join()
+    assert served == [2, 1]
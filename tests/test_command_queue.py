@@ -0,0 +1,77 @@
+from collections import namedtuple
+
+from command_queue import CommandQueue
+
+Command = namedtuple("Command", ["command_key_word", "settings"])
+
+COALESCE_KEYS = {"start": "run", "stop": "run", "set_power": "power", "set_powers_3p": "power"}
+
+
+def make_queue():
+    return CommandQueue(COALESCE_KEYS, ("stop",))
+
+
+def get_key_words(batch):
+    return [(command.command_key_word, command.settings) for command in batch]
+
+
+def test_newest_command_of_a_key_is_kept():
+    queue = make_queue()
+    assert not queue.put(Command("set_power", [1]))
+    assert queue.put(Command("set_powers_3p", [2, 2, 2]))
+    assert queue.put(Command("set_power", [3]))
+    assert get_key_words(queue.get_batch()) == [("set_power", [3])]
+    assert queue.get_stats()["commands_coalesced"] == 2
+
+
+def test_unkeyed_commands_are_not_coalesced():
+    queue = make_queue()
+    queue.put(Command("voltage_mode", []))
+    queue.put(Command("voltage_mode", []))
+    assert len(queue.get_batch()) == 2
+
+
+def test_priority_commands_run_first():
+    queue = make_queue()
+    queue.put(Command("set_power", [1]))
+    queue.put(Command("voltage_mode", []))
+    queue.put(Command("stop", []))
+    assert get_key_words(queue.get_batch()) == [("stop", []), ("set_power", [1]), ("voltage_mode", [])]
+
+
+def test_stop_then_start_runs_both():
+    queue = make_queue()
+    queue.put(Command("stop", []))
+    assert not queue.put(Command("start", []))
+    assert get_key_words(queue.get_batch()) == [("stop", []), ("start", [])]
+
+
+def test_commands_after_a_stop_still_coalesce():
+    queue = make_queue()
+    queue.put(Command("stop", []))
+    queue.put(Command("start", [1]))
+    assert queue.put(Command("start", [2]))
+    assert get_key_words(queue.get_batch()) == [("stop", []), ("start", [2])]
+
+
+def test_newer_stop_supersedes_a_queued_start():
+    queue = make_queue()
+    queue.put(Command("stop", []))
+    queue.put(Command("start", []))
+    assert queue.put(Command("stop", [2]))
+    assert get_key_words(queue.get_batch()) == [("stop", [2])]
+
+    queue.put(Command("start", []))
+    assert queue.put(Command("stop", []))
+    assert get_key_words(queue.get_batch()) == [("stop", [])]
+
+
+def test_batch_empties_the_queue():
+    queue = make_queue()
+    queue.put(Command("start", []))
+    queue.get_batch()
+    assert queue.is_empty()
+    assert queue.get_batch() == []
+    queue.record_failure()
+    assert queue.get_stats() == dict(
+        commands_received=1, commands_coalesced=0, commands_executed=1, commands_failed=1, batches=1)
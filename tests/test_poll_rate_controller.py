@@ -0,0 +1,32 @@
+from poll_rate_controller import PollRateController
+
+
+def test_increases_up_to_target_utilisation():
+    controller = PollRateController(min_frequency=1, max_frequency=100, target_utilisation=0.7)
+    for _ in range(1000):
+        controller.record(0.01, requests=2)
+    # Two requests of 10 ms per poll at 70% utilisation
+    assert abs(controller.get_frequency() - 35) < 1e-6
+
+
+def test_backs_off_on_errors():
+    controller = PollRateController(min_frequency=1, max_frequency=100, initial_frequency=10)
+    controller.record(0.01, errors=1)
+    assert controller.get_frequency() == 5
+    assert controller.get_stats()["errors"] == 1
+
+
+def test_backs_off_when_saturated():
+    controller = PollRateController(min_frequency=1, max_frequency=100, initial_frequency=10)
+    controller.record(0.01)
+    for _ in range(20):
+        controller.record(0.1)
+    assert controller.get_frequency() == 1
+
+
+def test_clamped_to_range():
+    controller = PollRateController(min_frequency=2, max_frequency=4, initial_frequency=10)
+    assert controller.get_frequency() == 4
+    for _ in range(10):
+        controller.record(0.01, errors=1)
+    assert controller.get_frequency() == 2
@@ -0,0 +1,148 @@
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("redis")
+
+from postgres_reporter import PostgresReporter, SqliteConnection
+
+TABLE = "meter_readings"
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class Database():
+    """
+    A SQLite database that can be taken down, or made to fail after a number
+    of inserts.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = str(path)
+        self.available = True
+        self.inserts_before_failure = None
+
+    def connect(self):
+        if not self.available:
+            raise ConnectionError("database unavailable")
+        database = self
+
+        class Connection(SqliteConnection):
+            def insert_rows(self, table, columns, rows):
+                if database.inserts_before_failure is not None:
+                    if database.inserts_before_failure == 0:
+                        raise ConnectionError("connection lost")
+                    database.inserts_before_failure -= 1
+                super().insert_rows(table, columns, rows)
+
+        return Connection(self.path)
+
+    def get_rows(self, columns="kW_1, kW_2"):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(f"SELECT {columns} FROM {TABLE} ORDER BY datetime, kW_1").fetchall()
+        except sqlite3.OperationalError:
+            return []
+        finally:
+            connection.close()
+
+
+def make_reading(index, **fields):
+    return dict(datetime=START + timedelta(seconds=index), device_id="meter", **fields)
+
+
+@pytest.fixture
+def database(tmp_path):
+    return Database(tmp_path / "readings.sqlite")
+
+
+@pytest.fixture
+def reporter(tmp_path, database):
+    return PostgresReporter(database.connect, spool_directory=f"{tmp_path}/spool/")
+
+
+def test_flush_into_sqlite(reporter, database):
+    for index in range(5):
+        reporter.add_reading(TABLE, make_reading(index, kW_1=float(index), kW_2=1.0))
+    reporter.flush()
+
+    assert database.get_rows() == [(float(index), 1.0) for index in range(5)]
+    assert reporter.get_stats()["rows_written"] == 5
+    assert reporter.get_stats()["buffered_rows"] == 0
+
+
+def test_backpressure_spools_to_disk(reporter, database):
+    reporter.max_buffered_rows = 3
+    for index in range(3):
+        reporter.add_reading(TABLE, make_reading(index, kW_1=float(index), kW_2=1.0))
+
+    assert reporter.get_stats()["buffered_rows"] == 0
+    assert reporter.get_stats()["rows_spooled"] == 3
+    assert os.path.isfile(reporter.get_spool_path(TABLE))
+    assert database.get_rows() == []
+
+    reporter.flush()
+    assert len(database.get_rows()) == 3
+    assert reporter.get_spooled_tables() == []
+
+
+def test_spool_full_drops_readings(reporter):
+    reporter.max_spool_bytes = 1
+    reporter.add_reading(TABLE, make_reading(0, kW_1=1.0))
+    reporter.spool_buffers()
+    assert reporter.get_stats()["rows_dropped"] == 1
+    assert reporter.get_spool_bytes() == 0
+
+
+def test_replay_spool_after_database_returns(reporter, database):
+    reporter.replay_batch_rows = 4
+    database.available = False
+    for index in range(10):
+        reporter.add_reading(TABLE, make_reading(index, kW_1=float(index), kW_2=1.0))
+    reporter.flush()
+    assert reporter.get_stats()["rows_spooled"] == 10
+
+    # A batch fails part way through the replay, the rest stays spooled
+    database.available = True
+    database.inserts_before_failure = 1
+    reporter.flush()
+    assert len(database.get_rows()) == 4
+    assert reporter.get_spool_offset(TABLE) > 0
+
+    database.inserts_before_failure = None
+    reporter.add_reading(TABLE, make_reading(10, kW_1=10.0, kW_2=1.0))
+    reporter.flush()
+    assert database.get_rows() == [(float(index), 1.0) for index in range(11)]
+    assert reporter.get_spooled_tables() == []
+
+
+def test_failed_insert_spools_only_unwritten_readings(reporter, database):
+    for index in range(3):
+        reporter.add_reading(TABLE, make_reading(index, kW_1=float(index), kW_2=1.0))
+        # Readings with other fields are inserted separately
+        reporter.add_reading(TABLE, make_reading(index, kW_1=float(index) + 10))
+
+    database.inserts_before_failure = 1
+    reporter.flush()
+    assert len(database.get_rows()) == 3
+    assert reporter.get_stats()["rows_spooled"] == 3
+
+    database.inserts_before_failure = None
+    reporter.flush()
+    rows = database.get_rows()
+    assert len(rows) == 6 and len(set(rows)) == 6
+
+
+def test_delta_readings_carry_last_values_forward(reporter, database):
+    assert reporter.fill_reading("meter_grid_1", "basic_delta", make_reading(0, kW_1=2.0)) is None
+    assert reporter.get_stats()["deltas_dropped"] == 1
+
+    reporter.add_reading(TABLE, reporter.fill_reading("meter_grid_1", "basic", make_reading(1, kW_1=1.0, kW_2=5.0)))
+    reporter.add_reading(TABLE, reporter.fill_reading("meter_grid_1", "basic_delta", make_reading(2, kW_1=2.0)))
+    reporter.add_reading(TABLE, reporter.fill_reading("meter_grid_1", "basic_delta", make_reading(3, kW_2=6.0)))
+    reporter.flush()
+
+    assert database.get_rows("datetime, kW_1, kW_2") == [
+        ((START + timedelta(seconds=index)).isoformat(), kW_1, kW_2)
+        for index, kW_1, kW_2 in [(1, 1.0, 5.0), (2, 2.0, 5.0), (3, 2.0, 6.0)]]
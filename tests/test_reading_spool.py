@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from reading_spool import ReadingSpool
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return f"{tmp_path}/spool/"
+
+
+def fill(spool, count, start=0):
+    for index in range(start, start + count):
+        spool.append(f"topic_{index}", f"data_{index}")
+
+
+def test_drain_sends_oldest_first(directory):
+    spool = ReadingSpool(directory, max_bytes=100000, segment_bytes=200)
+    fill(spool, 10)
+    assert len(os.listdir(directory)) > 1
+
+    sent = []
+    assert spool.drain(lambda topic, data: sent.append((topic, data)), max_messages=4) == 4
+    assert spool.drain(lambda topic, data: sent.append((topic, data)), max_messages=100) == 6
+    assert sent == [(f"topic_{index}", f"data_{index}") for index in range(10)]
+    assert spool.is_empty()
+    assert os.listdir(directory) == []
+
+
+def test_full_spool_drops_oldest_segments(directory):
+    spool = ReadingSpool(directory, max_bytes=500, segment_bytes=200)
+    fill(spool, 50)
+    assert spool.get_bytes() <= 500
+    assert spool.get_dropped_segments() > 0
+
+    sent = []
+    spool.drain(lambda topic, data: sent.append(topic), max_messages=100)
+    assert sent[-1] == "topic_49"
+    assert "topic_0" not in sent
+
+
+def test_failed_send_keeps_the_message(directory):
+    spool = ReadingSpool(directory, max_bytes=100000, segment_bytes=200)
+    fill(spool, 3)
+
+    sent = []
+    failed = []
+
+    def send(topic, data):
+        if topic == "topic_1" and not failed:
+            failed.append(topic)
+            raise ConnectionError("redis unavailable")
+        sent.append(topic)
+
+    with pytest.raises(ConnectionError):
+        spool.drain(send, max_messages=10)
+    assert sent == ["topic_0"]
+
+    assert spool.drain(send, max_messages=10) == 2
+    assert sent == ["topic_0", "topic_1", "topic_2"]
+
+
+def test_spool_is_reopened_after_a_restart(directory):
+    spool = ReadingSpool(directory, max_bytes=100000, segment_bytes=200)
+    fill(spool, 10)
+
+    spool = ReadingSpool(directory, max_bytes=100000, segment_bytes=200)
+    assert not spool.is_empty()
+    fill(spool, 2, start=10)
+
+    sent = []
+    spool.drain(lambda topic, data: sent.append(topic), max_messages=100)
+    assert sent == [f"topic_{index}" for index in range(12)]
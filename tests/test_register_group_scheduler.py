@@ -0,0 +1,67 @@
+from register_group_scheduler import RegisterGroupScheduler
+
+
+def register(name, location, dtype="H"):
+    return dict(reg_name=name, location=location, dtype=dtype, scalar=1)
+
+
+def make_scheduler(groups, registers):
+    return RegisterGroupScheduler.from_config(dict(register_groups=groups, basic_read_registers=registers))
+
+
+def group(name, frequency, *blocks):
+    return dict(name=name, reporting_frequency=frequency, blocks=[dict(start=start, size=size) for start, size in blocks])
+
+
+def test_no_register_groups():
+    assert RegisterGroupScheduler.from_config(dict(basic_read_registers=[])) is None
+
+
+def test_groups_are_read_at_their_own_rates():
+    scheduler = make_scheduler(
+        [group("fast", 10, (99, 3)), group("slow", 1, (199, 3))],
+        [register("a", 100), register("b", 200)])
+
+    first = scheduler.get_due_read(0.0)
+    assert [r["reg_name"] for r in first["registers"]] == ["a", "b"]
+    assert first["reading_type"] == "basic"
+
+    assert scheduler.get_due_read(0.05) is None
+    assert [r["reg_name"] for r in scheduler.get_due_read(0.1)["registers"]] == ["a"]
+    assert [r["reg_name"] for r in scheduler.get_due_read(1.0)["registers"]] == ["a", "b"]
+
+
+def test_due_time_steps_from_the_previous_due_time():
+    scheduler = make_scheduler([group("fast", 10, (99, 3))], [register("a", 100)])
+    scheduler.get_due_read(0.0)
+    # A late read doesn't push back the next one
+    assert scheduler.get_due_read(0.13) is not None
+    assert scheduler.get_due_read(0.2) is not None
+    # After a long stall the group catches up with one read, not one per
+    # missed period, then steps on from the stall
+    assert scheduler.get_due_read(5.0) is not None
+    assert scheduler.get_due_read(5.01) is not None
+    assert scheduler.get_due_read(5.05) is None
+    assert scheduler.get_due_read(5.1) is not None
+
+
+def test_merge_blocks():
+    blocks = [dict(start=120, size=5), dict(start=99, size=11), dict(start=109, size=5), dict(start=200, size=3)]
+    assert RegisterGroupScheduler.merge_blocks(blocks) == [
+        dict(start=99, size=15), dict(start=120, size=5), dict(start=200, size=3)]
+
+
+def test_merged_reads_are_split_at_the_modbus_limit():
+    # Two adjacent groups of 100 registers merge into a 200 register read
+    registers = [register(f"r{location}", location) for location in range(100, 200)]
+    registers += [register("long", 224, "f")]
+    registers += [register(f"r{location}", location) for location in range(226, 300)]
+    scheduler = make_scheduler(
+        [group("first", 10, (99, 101)), group("second", 10, (199, 101))], registers)
+
+    custom_read = scheduler.get_due_read(0.0)
+    blocks = custom_read["blocks"]
+    assert all(block["size"] - 1 <= 125 for block in blocks)
+    # The 2 word register at 224-225 is not split between the reads
+    assert blocks == [dict(start=99, size=125), dict(start=223, size=77)]
+    assert len(custom_read["registers"]) == len(registers)
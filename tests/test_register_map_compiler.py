@@ -0,0 +1,145 @@
+import glob
+import os
+
+import pytest
+
+import register_map_compiler as compiler
+
+CONFIG_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "config")
+
+
+def register(name, location, dtype="H", scalar=1):
+    return dict(reg_name=name, location=location, dtype=dtype, scalar=scalar)
+
+
+def make_config(registers, blocks=None, **sections):
+    if blocks is None:
+        blocks = [dict(start=99, size=11)]
+    return dict(basic_read_registers=registers, basic_read_block=blocks, **sections)
+
+
+def write_config(path, registers, blocks):
+    lines = []
+    for reg in registers:
+        lines.append("[[basic_read_registers]]")
+        lines.extend([f'reg_name = "{reg["reg_name"]}"', f'location = {reg["location"]}',
+                      f'dtype = "{reg["dtype"]}"', f'scalar = {reg["scalar"]}'])
+    for block in blocks:
+        lines.append("[[basic_read_block]]")
+        lines.extend([f'start = {block["start"]}', f'size = {block["size"]}'])
+    path.write_text("\n".join(lines) + "\n")
+
+
+def test_valid_config():
+    config = make_config([register("a", 100), register("b", 101, "f"), register("c", 103, "d")])
+    assert compiler.validate(config) == ([], [])
+
+
+@pytest.mark.parametrize("config_path", sorted(glob.glob(os.path.join(CONFIG_DIRECTORY, "*registers*.toml"))))
+def test_shipped_register_configs_are_valid(config_path):
+    errors, _ = compiler.validate(compiler.toml.load(config_path))
+    assert errors == []
+
+
+def test_missing_keys_and_unknown_dtype():
+    config = make_config([dict(reg_name="a", location=100), register("b", 101, "x")])
+    errors, _ = compiler.validate(config)
+    assert any("missing dtype, scalar" in error for error in errors)
+    assert any("unknown dtype 'x'" in error for error in errors)
+
+
+def test_duplicate_names():
+    errors, _ = compiler.validate(make_config([register("a", 100), register("a", 101)]))
+    assert errors == ["'a' is defined 2 times."]
+
+
+def test_multi_word_overlap():
+    errors, _ = compiler.validate(make_config([register("a", 100, "i"), register("b", 101)]))
+    assert len(errors) == 1 and "overlaps 'a'" in errors[0]
+
+
+def test_register_on_block_start_is_not_read():
+    errors, _ = compiler.validate(make_config([register("a", 99)]))
+    assert any("first location" in error for error in errors)
+
+
+def test_block_splitting_a_register():
+    errors, _ = compiler.validate(make_config([register("a", 109, "f")]))
+    assert any("splits 'a'" in error for error in errors)
+
+
+def test_register_outside_blocks():
+    errors, _ = compiler.validate(make_config([register("a", 200)]))
+    assert errors == ["'a' at 200 is not in any basic_read_block."]
+
+
+def test_block_over_modbus_limit():
+    errors, _ = compiler.validate(make_config([register("a", 100)], [dict(start=99, size=127)]))
+    assert any("more than 125" in error for error in errors)
+
+
+def test_register_outside_groups_is_a_warning():
+    config = make_config(
+        [register("a", 100), register("b", 105)],
+        register_groups=[dict(name="fast", reporting_frequency=10, blocks=[dict(start=99, size=3)])])
+    errors, warnings = compiler.validate(config)
+    assert errors == []
+    assert warnings == ["'b' at 105 is not in any register group block."]
+
+
+def test_decode_plan_fills_unused_words():
+    plan = compiler.build_decode_plan([register("a", 100, "f"), register("b", 103)], [dict(start=99, size=5)])
+    assert plan["reg_names"] == ["a", "unused_102", "b"]
+    assert plan["unpack_string"] == "<fhH"
+
+
+def test_artefact_path_depends_on_directory(tmp_path):
+    first = compiler.get_artefact_path(str(tmp_path / "one" / "registers.toml"), "cache/")
+    second = compiler.get_artefact_path(str(tmp_path / "two" / "registers.toml"), "cache/")
+    assert first != second
+    assert os.path.basename(first).startswith("registers_")
+
+
+def test_load_register_map_caches_and_recompiles(tmp_path):
+    config_path = tmp_path / "registers.toml"
+    cache_directory = f"{tmp_path}/cache/"
+    write_config(config_path, [register("a", 100)], [dict(start=99, size=3)])
+
+    register_map = compiler.load_register_map(str(config_path), cache_directory)
+    assert os.path.isfile(compiler.get_artefact_path(str(config_path), cache_directory))
+    assert register_map.get_plan()["reg_names"] == ["a", "unused_101"]
+
+    write_config(config_path, [register("b", 100)], [dict(start=99, size=3)])
+    assert compiler.load_register_map(str(config_path), cache_directory).get_plan()["reg_names"] == ["b", "unused_101"]
+
+
+def test_invalid_config_raises(tmp_path):
+    config_path = tmp_path / "registers.toml"
+    write_config(config_path, [register("a", 200)], [dict(start=99, size=3)])
+    with pytest.raises(compiler.RegisterMapError):
+        compiler.load_register_map(str(config_path), f"{tmp_path}/cache/")
+
+
+def test_merged_register_groups_are_checked():
+    # Each group reads 100 registers, together they read 200
+    registers = [register(f"r{location}", location) for location in range(100, 300)]
+    blocks = [dict(start=99, size=101), dict(start=199, size=101)]
+    assert compiler.split_blocks(compiler.merge_blocks(blocks), registers) == [
+        dict(start=99, size=126), dict(start=224, size=76)]
+
+    # A register across the split is moved whole into the second read
+    registers[124] = register("r224", 224, "f")
+    del registers[125]
+    assert compiler.split_blocks(compiler.merge_blocks(blocks), registers) == [
+        dict(start=99, size=125), dict(start=223, size=77)]
+    assert compiler.validate_merged_group_blocks(
+        registers, [dict(blocks=blocks[:1]), dict(blocks=blocks[1:])]) == []
+
+
+def test_adjacent_register_groups_over_modbus_limit_are_valid():
+    registers = [register(f"r{location}", location) for location in range(100, 300) if location != 199]
+    blocks = [dict(start=99, size=101), dict(start=199, size=101)]
+    config = make_config(registers, blocks, register_groups=[
+        dict(name="first", reporting_frequency=10, blocks=blocks[:1]),
+        dict(name="second", reporting_frequency=1, blocks=blocks[1:])])
+    assert compiler.validate(config) == ([], [])
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from register_values import RegisterValues, decode_values, encode_values
+
+
+@pytest.mark.parametrize("dtype, values", [
+    ("h", [-32768, -1, 0, 32767]),
+    ("H", [0, 1, 65535]),
+    ("i", [-2 ** 31, -70000, 2 ** 31 - 1]),
+    ("L", [0, 2 ** 32 - 1]),
+    ("q", [-2 ** 40, 2 ** 40]),
+    ("f", [-1.5, 0.0, 1234.25]),
+    ("d", [-1e100, 3.141592653589793]),
+])
+def test_round_trip(dtype, values):
+    assert decode_values(encode_values(values, dtype), dtype).tolist() == values
+
+
+def test_signed_words():
+    assert encode_values([-1, -100], "h") == [65535, 65436]
+    # Words read back as signed python ints wrap to their uint16 value
+    assert decode_values([-1, -100], "h").tolist() == [-1, -100]
+
+
+def test_multi_word_order_is_least_significant_first():
+    assert encode_values([0x12345678], "I") == [0x5678, 0x1234]
+
+
+def test_scalar_and_offset():
+    words = encode_values([230.04, -1.0], "h", scalar=0.1, offset=-2.0)
+    assert words == [2320, 10]
+    np.testing.assert_allclose(decode_values(words, "h", scalar=0.1, offset=-2.0), [230.0, -1.0])
+
+
+@pytest.mark.parametrize("dtype, value", [("h", 32768), ("h", -32769), ("H", -1), ("I", 2 ** 32)])
+def test_out_of_range(dtype, value):
+    with pytest.raises(ValueError):
+        encode_values([value], dtype)
+
+
+def test_register_values_by_name():
+    register_values = RegisterValues([
+        dict(reg_name="Set_Power", location=101, dtype="h", scalar=1),
+        dict(reg_name="Energy", location=110, dtype="L", scalar=0.1)])
+    assert register_values.encode("Set_Power", [-100, -100]) == (100, [65436, 65436])
+    assert register_values.get_words("Energy") == 2
+    assert register_values.decode("Energy", [10, 0]).tolist() == [1.0]
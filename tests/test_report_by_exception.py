@@ -0,0 +1,51 @@
+import pytest
+
+from report_by_exception import ReportByExceptionFilter, decode_delta_reading_type, encode_delta_reading_type
+
+
+def make_filter(keyframe_period=10):
+    return ReportByExceptionFilter.from_register_config([
+        dict(reg_name="kW", deadband=1.0),
+        dict(reg_name="V", deadband=1, deadband_type="percent"),
+        dict(reg_name="Hz")], keyframe_period)
+
+
+def test_delta_reading_type():
+    assert encode_delta_reading_type("basic") == "basic_delta"
+    assert decode_delta_reading_type("basic_delta") == "basic"
+    assert decode_delta_reading_type("basic") == "basic"
+
+
+def test_unknown_deadband_type():
+    with pytest.raises(ValueError):
+        ReportByExceptionFilter.from_register_config([dict(reg_name="kW", deadband=1, deadband_type="relative")], 10)
+
+
+def test_keyframe_then_deltas():
+    report_filter = make_filter()
+    state = dict(datetime=0, device_id="meter", kW=10.0, V=230.0, Hz=50.0)
+    assert report_filter.filter(state, 0) == (True, state)
+
+    assert report_filter.filter(dict(state, datetime=1, kW=10.5, V=232.0), 1) == (False, None)
+    assert report_filter.filter(dict(state, datetime=2, kW=11.5, V=233.0, Hz=50.01), 2) == \
+        (False, dict(datetime=2, device_id="meter", kW=11.5, V=233.0, Hz=50.01))
+
+    # Deadbands are from the last reported value, not the last reading
+    assert report_filter.filter(dict(state, datetime=3, kW=12.0, V=233.0, Hz=50.01), 3) == (False, None)
+
+
+def test_keyframe_period():
+    report_filter = make_filter(keyframe_period=5)
+    state = dict(datetime=0, device_id="meter", kW=10.0, V=230.0, Hz=50.0)
+    report_filter.filter(state, 0)
+    assert report_filter.filter(dict(state, datetime=4), 4) == (False, None)
+    assert report_filter.filter(dict(state, datetime=5), 5)[0]
+
+
+def test_add_registers():
+    report_filter = make_filter()
+    group_registers = [dict(reg_name="A", deadband=2.0)]
+    report_filter.add_registers(group_registers)
+    report_filter.add_registers(group_registers)
+    assert report_filter.get_deadbands()["A"] == (2.0, "absolute")
+    assert len(report_filter.get_deadbands()) == 3
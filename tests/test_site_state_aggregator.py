@@ -0,0 +1,65 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("redis")
+
+from pubsub_topic_encoder_decoder import PubSubTopicEncoderDecoder as psted
+from redis_message_structures import RedisEncoderDecoder
+from report_by_exception import encode_delta_reading_type
+from site_state_aggregator import SiteStateAggregator
+
+DATETIME = "2024-01-01T00:00:00+00:00"
+
+
+@pytest.fixture
+def aggregator():
+    aggregator = SiteStateAggregator()
+    aggregator.reading_types = ["basic", "energy"]
+    return aggregator
+
+
+def publish(aggregator, device_name, reading_type, **fields):
+    aggregator.handle_reading(
+        psted.encode_readings_topic(device_name, 1, reading_type),
+        json.dumps(dict(datetime=DATETIME, **fields)))
+
+
+def test_latest_readings_are_combined(aggregator):
+    publish(aggregator, "meter_grid", "basic", kW_1=1.0)
+    publish(aggregator, "meter_grid", "basic", kW_1=2.0)
+    publish(aggregator, "meter_grid", "energy", kWh=5.0)
+    publish(aggregator, "statcom", "basic", kW=3.0)
+    publish(aggregator, "statcom", "unknown", kW=4.0)
+
+    now = time.time()
+    combined = RedisEncoderDecoder.decode_combined_reading(aggregator.get_combined_reading(now))
+    assert combined["datetime"].timestamp() == pytest.approx(now)
+    assert sorted(key for key in combined if key != "datetime") == ["meter_grid", "meter_grid_energy", "statcom"]
+    assert combined["meter_grid"]["kW_1"] == 2.0
+    assert combined["meter_grid_energy"]["kWh"] == 5.0
+
+
+def test_delta_is_merged_into_the_full_reading(aggregator):
+    delta_type = encode_delta_reading_type("basic")
+    publish(aggregator, "meter_grid", delta_type, kW_1=9.0)
+    assert aggregator.get_current_readings(time.time()) == {}
+
+    publish(aggregator, "meter_grid", "basic", kW_1=1.0, kW_2=2.0)
+    publish(aggregator, "meter_grid", delta_type, kW_2=3.0)
+    assert json.loads(aggregator.get_current_readings(time.time())["meter_grid"]) == dict(
+        datetime=DATETIME, kW_1=1.0, kW_2=3.0)
+
+
+def test_old_readings_are_left_out(aggregator):
+    publish(aggregator, "meter_grid", "basic", kW_1=1.0)
+    now = time.time()
+    assert "meter_grid" in aggregator.get_current_readings(now + aggregator.max_reading_age - 1)
+    assert aggregator.get_current_readings(now + aggregator.max_reading_age + 1) == {}
+
+
+def test_ticks_are_aligned_to_the_period(aggregator):
+    aggregator.period = 0.5
+    assert aggregator.get_next_tick(10.2) == 10.5
+    assert aggregator.get_next_tick(10.5) == 11.0
@@ -0,0 +1,80 @@
+import pytest
+
+pytest.importorskip("redis")
+
+from time_aligned_join import DeviceBuffer, TimeAlignedJoin
+
+
+def make_join(**kwargs):
+    return TimeAlignedJoin({"meter_grid_1": ["kW_1", "kW_2"], "statcom_1": ["kW"]}, **kwargs)
+
+
+def test_values_are_interpolated_between_readings():
+    join = make_join()
+    join.add_reading("meter_grid_1", 0.0, {"kW_1": 0.0, "kW_2": 10.0})
+    join.add_reading("meter_grid_1", 0.5, {"kW_1": 5.0, "kW_2": 20.0})
+    join.add_reading("statcom_1", 0.1, {"kW": 1.0})
+    assert join.get_vector(0.25) == [2.5, 15.0, 1.0]
+    assert join.get_latest_common_time() == 0.1
+
+
+def test_stale_and_missing_values_are_none():
+    join = make_join(max_gap=1.0)
+    join.add_reading("meter_grid_1", 0.0, {"kW_1": 1.0})
+    assert join.get("meter_grid_1", "kW_1", -0.1) is None
+    assert join.get("meter_grid_1", "kW_1", 0.9) == 1.0
+    assert join.get("meter_grid_1", "kW_1", 1.1) is None
+    assert join.get("meter_grid_1", "kW_2", 0.5) is None
+    assert join.get("statcom_1", "kW", 0.0) is None
+    assert join.get_latest_common_time() is None
+
+
+def test_late_reading_is_inserted_in_order():
+    buffer = DeviceBuffer(["kW"], buffer_time=10.0)
+    for timestamp in [0.0, 2.0, 1.0]:
+        buffer.add(timestamp, {"kW": timestamp})
+    assert buffer.times == [0.0, 1.0, 2.0]
+    assert buffer.values["kW"] == [0.0, 1.0, 2.0]
+
+
+def test_old_readings_expire():
+    buffer = DeviceBuffer(["kW"], buffer_time=1.0)
+    for index in range(100):
+        buffer.add(index * 0.1, {"kW": index})
+    # The last reading before the buffer time is kept to interpolate from
+    assert len(buffer) == 12
+    assert len(buffer.times) < 50
+
+
+def test_delta_without_a_full_reading_is_dropped():
+    join = make_join()
+    join.add_reading("meter_grid_1", 1.0, {"kW_1": 1.0}, is_delta=True)
+    assert join.get_stats()["readings_dropped"] == 1
+    assert len(join.get_buffer("meter_grid_1")) == 0
+
+
+def test_delta_is_filled_from_the_reading_before_it():
+    join = make_join()
+    join.add_reading("meter_grid_1", 1.0, {"kW_1": 1.0, "kW_2": 10.0})
+    join.add_reading("meter_grid_1", 2.0, {"kW_1": 2.0}, is_delta=True)
+    assert join.get_vector(2.0)[:2] == [2.0, 10.0]
+
+    # A delta arriving after a later full reading takes the other fields from
+    # the reading before its own time, not from the later one
+    join.add_reading("meter_grid_1", 3.0, {"kW_1": 3.0, "kW_2": 30.0})
+    join.add_reading("meter_grid_1", 2.5, {"kW_1": 2.5}, is_delta=True)
+    assert join.get_vector(2.5)[:2] == [2.5, 10.0]
+
+    # A delta older than every buffered reading has nothing to fill it from
+    join.add_reading("meter_grid_1", 0.5, {"kW_1": 0.5}, is_delta=True)
+    assert join.get_stats()["readings_dropped"] == 1
+
+
+def test_from_config_holds_values_for_the_keyframe_period():
+    config = {"ipc-parameters": {"report_by_exception": True, "slow_reporting_frequency": 0.1}}
+    join = TimeAlignedJoin.from_config({"meter_grid_1": ["kW_1"]}, config, max_gap=1.0)
+    join.add_reading("meter_grid_1", 0.0, {"kW_1": 1.0})
+    join.add_reading("meter_grid_1", 8.0, {"kW_1": 2.0})
+    assert join.get("meter_grid_1", "kW_1", 5.0) == 1.0
+    assert join.get("meter_grid_1", "kW_1", 17.0) == 2.0
+    assert join.get("meter_grid_1", "kW_1", 19.0) is None
@@ -0,0 +1,52 @@
+from write_verifier import WRITE_MISMATCH_EVENT, WriteVerifier
+
+
+def test_poll_read_verifies_written_registers():
+    verifier = WriteVerifier(verify_timeout=1.0)
+    verifier.expect(100, [1, -1], now=0.0)
+
+    # A block (99, 5) reads 100 to 103 in the normal polls
+    verifier.observe([(99, 5)], [0, 1, 0xFFFF, 0], now=0.25)
+    stats = verifier.get_stats()
+    assert stats["writes_verified"] == 2
+    assert stats["pending"] == 0
+    assert stats["mean_verify_latency"] == 0.25
+    assert verifier.pop_events() == []
+
+
+def test_mismatch_is_reported_once():
+    verifier = WriteVerifier(verify_timeout=1.0)
+    verifier.expect(101, [5], now=0.0)
+    verifier.observe([(100, 3)], [0, 4], now=0.1)
+    verifier.observe([(100, 3)], [0, 5], now=0.2)
+
+    assert verifier.get_stats()["mismatches"] == 1
+    assert verifier.get_stats()["writes_verified"] == 0
+    assert verifier.pop_events() == [dict(
+        event=WRITE_MISMATCH_EVENT, address=101, expected=5, observed=4, time_written=0.0)]
+    assert verifier.pop_events() == []
+
+
+def test_newer_write_replaces_the_expected_value():
+    verifier = WriteVerifier(verify_timeout=1.0)
+    verifier.expect(10, [1], now=0.0)
+    verifier.expect(10, [2], now=0.5)
+    verifier.observe([(10, 1)], [2], now=0.6, exact_count=True)
+    assert verifier.get_stats()["writes_verified"] == 1
+    assert verifier.get_stats()["mismatches"] == 0
+
+
+def test_overdue_registers_are_read_in_joined_blocks():
+    verifier = WriteVerifier(verify_timeout=1.0)
+    verifier.expect(10, [1, 2], now=0.0)
+    verifier.expect(12, [3], now=0.0)
+    verifier.expect(20, [4], now=0.0)
+    verifier.expect(30, [5], now=0.9)
+
+    assert verifier.get_overdue_blocks(now=0.5) == []
+    blocks = verifier.get_overdue_blocks(now=1.5)
+    assert blocks == [(10, 3), (20, 1)]
+    assert verifier.get_stats()["targeted_reads"] == 2
+
+    verifier.observe(blocks, [1, 2, 3, 4], now=1.6, exact_count=True)
+    assert verifier.get_stats()["pending"] == 1
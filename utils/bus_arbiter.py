@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+BusArbiter used to share Modbus connections between several Edge_device
+instances, e.g. the meters of an RS-485 daisy chain or the devices behind one
+Modbus TCP gateway.
+
+Every device on the bus gets a BusClient, which has the same read and write
+methods as the pymodbus client and runs each request as a transaction on one
+of the arbiter's connections. There are never more transactions in flight
+than connections. When a connection frees up it goes to the unit id after the
+one served last that has a request waiting (round robin), so each unit gets a
+fair share of the bus however many requests it queues.
+
+A device can hold a connection for several requests with batch(), e.g. all
+blocks of one poll, so its reads are not interleaved with other devices'
+requests. Inside a batch, sleep() releases the connection while the device
+backs off.
+
+SerialBusArbiter drives a Modbus RTU serial port. RTU frames must be separated
+by at least 3.5 character times of silence, so before each request it waits
+for whatever is left of that gap since the end of the last transaction,
+rather than a fixed delay. Above 19200 baud the gap is fixed at 1.75 ms as in
+the Modbus serial line specification.
+
+GatewayArbiter multiplexes the unit ids behind one Modbus TCP gateway over a
+pool of max_connections sockets (default 1), as cheap gateways fail with too
+many sockets or concurrent transactions.
+
+For each unit the arbiter reports the requests, errors, time waiting for the
+bus, an EWMA of the request latency and the number of requests queued. The
+stats are updated under the arbiter's lock, as transactions on different
+connections run at the same time.
+
+Arbiters are shared per connection through get_serial_bus_arbiter() and
+get_gateway_arbiter(), so all devices in a process that use the same port or
+gateway get the same arbiter. Devices on one bus must therefore run in one
+process, e.g. as threads.
+"""
+import collections
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# pymodbus is imported when an arbiter is created, so the simulator can be
+# used without it
+MIN_INTER_FRAME_GAP = 0.00175
+FIXED_GAP_BAUDRATE = 19200
+FRAME_GAP_CHARACTERS = 3.5
+LATENCY_EWMA_WEIGHT = 0.1
+
+_arbiters = {}
+_arbiters_lock = threading.Lock()
+
+
+class BusArbiter():
+    def __init__(self, clients: list, inter_frame_gap: float = 0) -> None:
+        self.clients = clients
+        self.inter_frame_gap = inter_frame_gap
+
+        self._condition = threading.Condition()
+        self._free_clients = list(clients)
+        # Threads holding a client -> [client, depth, unit_id]
+        self._owners = {}
+        # Waiting threads by unit id, in round robin order
+        self._waiting = collections.OrderedDict()
+        self.time_last_frame = 0
+
+        self.unit_stats = {}
+
+    def get_client(self, unit_id):
+        return BusClient(self, unit_id)
+
+    def get_stats(self):
+        """
+        Returns a copy of the stats of each unit.
+        """
+        with self._condition:
+            for unit_id, stats in self.unit_stats.items():
+                stats["queue_depth"] = len(self._waiting.get(unit_id, ()))
+            return {unit_id: dict(stats) for unit_id, stats in self.unit_stats.items()}
+
+    def get_unit_stats(self, unit_id):
+        return self.get_stats().get(unit_id)
+
+    def _get_unit_stats(self, unit_id):
+        if unit_id not in self.unit_stats:
+            self.unit_stats[unit_id] = dict(
+                requests=0,
+                errors=0,
+                bus_wait_time=0,
+                request_time=0,
+                latency_ewma=None,
+                queue_depth=0,
+                max_queue_depth=0)
+        return self.unit_stats[unit_id]
+
+    def record_error(self, unit_id):
+        with self._condition:
+            self._get_unit_stats(unit_id)["errors"] += 1
+
+    def get_queue_depth(self) -> int:
+        return sum([len(threads) for threads in self._waiting.values()])
+
+    def _is_next(self, thread) -> bool:
+        if not self._free_clients:
+            return False
+        next_unit = next(iter(self._waiting))
+        return self._waiting[next_unit][0] == thread
+
+    def acquire(self, unit_id=None):
+        """
+        Waits for a connection and returns it. Re-entrant, a thread that holds
+        a connection gets it straight away.
+        """
+        thread = threading.get_ident()
+        with self._condition:
+            if thread in self._owners:
+                self._owners[thread][1] += 1
+                return self._owners[thread][0]
+
+            waiting = self._waiting.setdefault(unit_id, collections.deque())
+            waiting.append(thread)
+            stats = self._get_unit_stats(unit_id)
+            stats["max_queue_depth"] = max(stats["max_queue_depth"], len(waiting))
+
+            while not self._is_next(thread):
+                self._condition.wait()
+
+            waiting.popleft()
+            if waiting:
+                # The unit's next request waits behind the other units
+                self._waiting.move_to_end(unit_id)
+            else:
+                del self._waiting[unit_id]
+
+            client = self._free_clients.pop()
+            self._owners[thread] = [client, 1, unit_id]
+            if self._free_clients and self._waiting:
+                # Another connection is free, wake the next waiting unit
+                self._condition.notify_all()
+            return client
+
+    def release(self):
+        with self._condition:
+            owner = self._owners[threading.get_ident()]
+            owner[1] -= 1
+            if owner[1] == 0:
+                del self._owners[threading.get_ident()]
+                self._free_clients.append(owner[0])
+                self._condition.notify_all()
+
+    @contextmanager
+    def batch(self, unit_id=None):
+        """
+        Holds a connection for all requests made inside the with block.
+        """
+        client = self.acquire(unit_id)
+        try:
+            yield client
+        finally:
+            self.release()
+
+    def sleep(self, duration: float):
+        """
+        Sleeps without holding a connection, then takes one back, so a device
+        backing off inside a batch doesn't block the other devices.
+        """
+        thread = threading.get_ident()
+        with self._condition:
+            owner = self._owners.pop(thread, None)
+            if owner is not None:
+                self._free_clients.append(owner[0])
+                self._condition.notify_all()
+
+        time.sleep(duration)
+
+        if owner is not None:
+            self.acquire(owner[2])
+            with self._condition:
+                self._owners[thread][1] = owner[1]
+
+    @contextmanager
+    def transaction(self, unit_id):
+        wait_start = time.perf_counter()
+        with self.batch(unit_id) as client:
+            # Only wait for the part of the gap that hasn't already passed
+            remaining_gap = self.time_last_frame + self.inter_frame_gap - time.perf_counter()
+            if remaining_gap > 0:
+                time.sleep(remaining_gap)
+
+            request_start = time.perf_counter()
+            with self._condition:
+                stats = self._get_unit_stats(unit_id)
+                stats["bus_wait_time"] += request_start - wait_start
+                stats["requests"] += 1
+            try:
+                yield client
+            except Exception:
+                self.record_error(unit_id)
+                raise
+            finally:
+                self.time_last_frame = time.perf_counter()
+                latency = self.time_last_frame - request_start
+                with self._condition:
+                    stats["request_time"] += latency
+                    if stats["latency_ewma"] is None:
+                        stats["latency_ewma"] = latency
+                    else:
+                        stats["latency_ewma"] += LATENCY_EWMA_WEIGHT * (latency - stats["latency_ewma"])
+
+    def close_connections(self):
+        """
+        Closes every connection without waiting for the bus, to unblock a
+        transaction stuck on a dead connection. Each is reopened by its next
+        request.
+        """
+        for client in self.clients:
+            client.close()
+
+    def reset(self, unit_id=None):
+        """
+        Closes a connection, it is reopened by its next request. A thread
+        holding a connection closes that one.
+        """
+        with self.batch(unit_id) as client:
+            client.close()
+
+
+class BusClient():
+    """
+    Stands in for a pymodbus client of one device on a shared bus.
+    """
+
+    def __init__(self, arbiter: BusArbiter, unit_id) -> None:
+        self.arbiter = arbiter
+        self.unit_id = unit_id
+
+    def read_holding_registers(self, address, count=1, unit=None, **kwargs):
+        unit = self.unit_id if unit is None else unit
+        with self.arbiter.transaction(unit) as client:
+            response = client.read_holding_registers(address=address, count=count, unit=unit, **kwargs)
+        return self._check_response(unit, response)
+
+    def write_registers(self, address, values, unit=None, **kwargs):
+        unit = self.unit_id if unit is None else unit
+        with self.arbiter.transaction(unit) as client:
+            response = client.write_registers(address, values, unit=unit, **kwargs)
+        return self._check_response(unit, response)
+
+    def _check_response(self, unit, response):
+        # pymodbus returns rather than raises timeouts and exception responses
+        if response.isError():
+            self.arbiter.record_error(unit)
+        return response
+
+    def close(self):
+        self.arbiter.reset(self.unit_id)
+
+
+class SerialBusArbiter(BusArbiter):
+    def __init__(
+        self,
+        port: str,
+        baudrate: int,
+        bytesize: int = 8,
+        parity: str = "N",
+        stopbits: int = 1,
+        timeout: float = 0.5,
+    ) -> None:
+        from pymodbus.client.sync import ModbusSerialClient
+
+        client = ModbusSerialClient(
+            method="rtu",
+            port=port,
+            baudrate=baudrate,
+            bytesize=bytesize,
+            parity=parity,
+            stopbits=stopbits,
+            timeout=timeout)
+        character_bits = 1 + bytesize + (0 if parity == "N" else 1) + stopbits
+        super().__init__([client], get_inter_frame_gap(baudrate, character_bits))
+        self.port = port
+
+
+class GatewayArbiter(BusArbiter):
+    def __init__(self, host: str, port: int, max_connections: int = 1, timeout: float = 1.0) -> None:
+        from pymodbus.client.sync import ModbusTcpClient
+
+        clients = [ModbusTcpClient(host=host, port=port, timeout=timeout) for _ in range(max_connections)]
+        super().__init__(clients)
+        self.host = host
+        self.port = port
+
+
+def get_inter_frame_gap(baudrate: int, character_bits: int = 11) -> float:
+    if baudrate > FIXED_GAP_BAUDRATE:
+        return MIN_INTER_FRAME_GAP
+    return FRAME_GAP_CHARACTERS * character_bits / baudrate
+
+
+def get_serial_bus_arbiter(port: str, baudrate: int, serial_config: dict) -> SerialBusArbiter:
+    """
+    Returns the arbiter of the serial port, creating it for the first device
+    on the port.
+    """
+    port = os.path.realpath(port)
+    with _arbiters_lock:
+        if port not in _arbiters:
+            _arbiters[port] = SerialBusArbiter(
+                port,
+                baudrate,
+                bytesize=serial_config["bytesize"],
+                parity=serial_config["parity"],
+                stopbits=serial_config["stopbits"],
+                timeout=serial_config["timeout"])
+        return _arbiters[port]
+
+
+def get_gateway_arbiter(host: str, port: int, gateway_config: dict) -> GatewayArbiter:
+    """
+    Returns the arbiter of the gateway, creating it for the first device
+    behind it.
+    """
+    key = (host, port)
+    with _arbiters_lock:
+        if key not in _arbiters:
+            _arbiters[key] = GatewayArbiter(
+                host,
+                port,
+                max_connections=gateway_config["max_connections"],
+                timeout=gateway_config["timeout"])
+        return _arbiters[key]
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+CommandQueue used to batch the commands a device receives between polls.
+
+Commands are queued as they arrive and run together as one batch from the
+device loop. Commands that set the same thing share a coalescing key, e.g.
+set_power and set_powers_3p both set the power setpoint, and only the newest
+command of each key is kept, so a burst of setpoints results in a single
+write. Commands without a key are never coalesced.
+
+Priority commands (e.g. stop) are run before the rest of the batch, the others
+run in the order they (or the command that superseded them) arrived. A priority
+command is never superseded by a command that isn't one: a start queued after
+a stop of the same key is kept and run after it, so a stop then start still
+resets the device. A newer priority command supersedes both. Each
+coalescing key should map to its own registers, so running the commands of
+different keys in a different order only changes when, not what, is written.
+"""
+
+
+class CommandQueue():
+    def __init__(self, coalesce_keys: dict, priority_commands: tuple = ()) -> None:
+        """
+        coalesce_keys maps a command key word to its coalescing key,
+        priority_commands are the command key words run first.
+        """
+        self.coalesce_keys = coalesce_keys
+        self.priority_commands = priority_commands
+
+        self._commands = {}
+        self._unkeyed_count = 0
+
+        self.commands_received = 0
+        self.commands_coalesced = 0
+        self.commands_executed = 0
+        self.commands_failed = 0
+        self.batches = 0
+
+    def __len__(self):
+        return len(self._commands)
+
+    def is_empty(self) -> bool:
+        return len(self._commands) == 0
+
+    def get_stats(self):
+        return {
+            "commands_received": self.commands_received,
+            "commands_coalesced": self.commands_coalesced,
+            "commands_executed": self.commands_executed,
+            "commands_failed": self.commands_failed,
+            "batches": self.batches,
+        }
+
+    def record_failure(self):
+        self.commands_failed += 1
+
+    def is_priority(self, command) -> bool:
+        return command.command_key_word in self.priority_commands
+
+    def put(self, command) -> bool:
+        """
+        Queues a CommandMessage. Returns True if it superseded a queued
+        command.
+        """
+        self.commands_received += 1
+
+        key = self.coalesce_keys.get(command.command_key_word)
+        if key is None:
+            key = ("unkeyed", self._unkeyed_count)
+            self._unkeyed_count += 1
+
+        after_key = ("after_priority", key)
+        superseded = 0
+        if self.is_priority(command):
+            # Also supersedes the commands queued to run after the key's
+            # previous priority command
+            superseded += self._commands.pop(after_key, None) is not None
+        elif key in self._commands and self.is_priority(self._commands[key]):
+            key = after_key
+        superseded += self._commands.pop(key, None) is not None
+
+        self.commands_coalesced += superseded
+        self._commands[key] = command
+        return superseded > 0
+
+    def get_batch(self) -> list:
+        """
+        Returns the queued commands, priority commands first, and empties the
+        queue.
+        """
+        commands = list(self._commands.values())
+        self._commands = {}
+        self._unkeyed_count = 0
+
+        if commands:
+            self.batches += 1
+            self.commands_executed += len(commands)
+
+        priority = [command for command in commands if self.is_priority(command)]
+        others = [command for command in commands if not self.is_priority(command)]
+        return priority + others
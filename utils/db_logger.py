@@ -36,30 +36,149 @@ The different level of logging levels are:
 """
 
 import logging
+import logging.handlers
 import os
 import sys
 import datetime
+import queue
+import threading
+import atexit
 
 LOGS_DIRECTORY =  f"{os.path.dirname(__file__)}/../logs/"
 MSG_FORMAT = "%(asctime)s | %(name)s | %(levelname)s | %(funcName)s | %(message)s | Line Num=%(lineno)d"
 
+# Size based rotation keeps at most (LOG_BACKUP_COUNT + 1) * LOG_MAX_BYTES of
+# logs per module on the SD card
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+# Queued mode settings. Records are dropped (and counted) rather than blocking
+# the caller when the queue is full.
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 100
+
 logging.Formatter.formatTime = (lambda self, record, datefmt=None: datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).astimezone().isoformat(sep="T",timespec="milliseconds"))
 
+class BatchedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler that only flushes to disk when flush_batch() is called,
+    so a batch of records is written with a single flush.
+    """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks. Records that arrive while the queue is
+    full are dropped and counted.
+    """
+
+    def __init__(self, log_queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingQueueListener():
+    """
+    Background writer thread for a DroppingQueueHandler. Waits for a record,
+    drains up to batch_size records from the queue, writes them and flushes
+    once per batch.
+    """
+    _sentinel = None
+
+    def __init__(self, queue_handler: DroppingQueueHandler, handler: BatchedRotatingFileHandler, batch_size=LOG_BATCH_SIZE) -> None:
+        self.queue_handler = queue_handler
+        self.queue = queue_handler.queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.dropped_reported = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.queue.put(self._sentinel)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for record in batch:
+                if record is self._sentinel:
+                    running = False
+                elif record.levelno >= self.handler.level:
+                    self.handler.handle(record)
+
+            self._report_dropped()
+            self.handler.flush_batch()
+
+    def _report_dropped(self):
+        dropped = self.queue_handler.dropped
+        if dropped > self.dropped_reported:
+            record = logging.LogRecord(
+                name=self.queue_handler.name or "db_logger", 
+                level=logging.WARNING, 
+                pathname=__file__, 
+                lineno=0, 
+                msg=f"LOGGER: Queue full, dropped {dropped - self.dropped_reported} log record(s).", 
+                args=None, 
+                exc_info=None, 
+                func="_report_dropped")
+            self.handler.handle(record)
+            self.dropped_reported = dropped
+
+
 class DBLogger():
     """
     Set up for a Python logging instance with custom handlers and formatters to 
     be used in modules that require logging.
     """
 
-    def __init__(self, name: str, logger_level=logging.INFO) -> None:
+    def __init__(
+        self, 
+        name: str, 
+        logger_level=logging.INFO, 
+        queued: bool = False, 
+        max_bytes: int = LOG_MAX_BYTES, 
+        backup_count: int = LOG_BACKUP_COUNT, 
+        queue_size: int = LOG_QUEUE_SIZE
+    ) -> None:
         """
         Initialises a DBLogger.
+
+        In queued mode records are put on a bounded queue and written to the
+        log file by a background thread, so logging never waits on disk I/O.
+        The log file is rotated once it reaches max_bytes in both modes.
         """
         self._name = name
         # self._module_name = self._name.split("/")[-1][:-3]
         self._module_name = self._name
         self._log_name = self._module_name + ".txt"
         self._log_path = LOGS_DIRECTORY + self._log_name
+        # logs/ is ignored by git, so it doesn't exist in a fresh checkout
+        os.makedirs(LOGS_DIRECTORY, exist_ok=True)
         if not os.path.isfile(self._log_path):
             with open(self._log_path, "a") as a:
                 print(f"Created log file at: {self._log_path}.")
@@ -75,11 +194,26 @@ class DBLogger():
         # self._postgres_handler.setFormatter(self._formatter)
         # self._postgres_handler.setLevel(logger_level)
 
-        # Create FileHandler to write to txt file
-        self._file_handler = logging.FileHandler(self._log_path)
+        # Create rotating FileHandler to write to txt file. In queued mode the
+        # background writer flushes once per batch instead of once per record.
+        file_handler_class = BatchedRotatingFileHandler if queued else logging.handlers.RotatingFileHandler
+        self._file_handler = file_handler_class(
+            self._log_path, maxBytes=max_bytes, backupCount=backup_count)
         self._file_handler.setFormatter(self._formatter)
         self._file_handler.setLevel(logger_level)
 
+        # In queued mode the file handler is driven by the background listener
+        # and the logger only has the non-blocking queue handler
+        self._queue_handler = None
+        self._queue_listener = None
+        if queued:
+            self._queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+            self._queue_handler.set_name(self._name)
+            self._queue_handler.setLevel(logger_level)
+            self._queue_listener = BatchingQueueListener(self._queue_handler, self._file_handler)
+            self._queue_listener.start()
+            atexit.register(self._queue_listener.stop)
+
         # Create handler to print to terminal
         self._stream_handler = logging.StreamHandler(sys.stdout)
         self._stream_handler.setFormatter(self._formatter)
@@ -87,9 +221,27 @@ class DBLogger():
 
         # Add handler to logger
         # self.logger.addHandler(self._postgres_handler)
-        self.logger.addHandler(self._file_handler)
+        if queued:
+            self.logger.addHandler(self._queue_handler)
+        else:
+            self.logger.addHandler(self._file_handler)
         # self.logger.addHandler(self._stream_handler)
         self.logger.setLevel(logger_level)
 
     def get_logger(self):
-        return self.logger
\ No newline at end of file
+        return self.logger
+
+    def get_dropped_count(self):
+        """
+        Returns the number of records dropped because the queue was full.
+        """
+        if self._queue_handler is None:
+            return 0
+        return self._queue_handler.dropped
+
+    def stop(self):
+        """
+        Writes any queued records and stops the background writer thread.
+        """
+        if self._queue_listener is not None:
+            self._queue_listener.stop()
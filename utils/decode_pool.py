@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+DecodePool used to decode and encode the raw reads of many devices in worker
+processes, so a box polling many devices is not limited to one core by the
+GIL.
+
+Each worker process has a ring of slots in a SharedMemory buffer, one raw
+frame (the registers returned by one Edge_device.read_modbus() call) per
+slot. submit() copies a frame into a free slot of the device's worker and
+queues only the slot index, so frames are never pickled. The worker decodes
+the frames queued together for one read layout in one FrameDecoder pass,
+encodes each reading with RedisEncoderDecoder and sends back the encoded
+readings, which are passed to the device's result handler by a thread of the
+parent process. When every slot of a worker is in use submit() waits, so a
+slow pool holds back the devices rather than queueing without bound.
+
+Devices are sharded by a hash of their name, so all frames of a device go to
+the same worker and its readings are handled in the order they were
+submitted. The worker keeps the last values of each device and merges every
+frame into them, so a read of only the due register groups publishes the full
+state as Edge_device.update() does in process.
+
+A run of frames that fails to decode or encode is dropped and reported, its
+slots are still returned. If a worker process stops, or no slot of a worker
+frees up within the submit timeout, submit() raises DecodePoolError rather
+than waiting forever, and the device decodes its readings itself.
+
+Workers are started with the spawn method, as the devices using the pool run
+threads. A process shares one pool, see get_decode_pool().
+
+Usage:
+    python decode_pool.py [devices] [frames per device]    # benchmark
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import db_logger
+from frame_decoder import FrameDecoder
+from redis_message_structures import RedisEncoderDecoder
+
+LOGGER_LEVEL = logging.INFO
+
+logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL, queued=True)
+logger = logger_setup.get_logger()
+
+MAX_FRAME_WORDS = 512
+SUBMIT_TIMEOUT = 5.0
+# How often a submit() waiting for a slot checks the worker is still running
+SLOT_WAIT_PERIOD = 0.5
+LAYOUT_TASK = "layout"
+FRAME_TASK = "frame"
+
+_decode_pool = None
+_decode_pool_lock = threading.Lock()
+
+
+class DecodePoolError(Exception):
+    pass
+
+
+def get_shard(device_name: str, n_workers: int) -> int:
+    # crc32 rather than hash(), which is salted per process
+    return zlib.crc32(device_name.encode()) % n_workers
+
+
+def decode_and_encode(
+    decoder: FrameDecoder,
+    frames: np.ndarray,
+    timestamps: list,
+    device_ids: list,
+    fields: list = None,
+    state: dict = None,
+) -> list:
+    """
+    Returns the encoded reading of each frame, as Edge_device.publish_reading()
+    would encode its state after update(). fields optionally gives a dict of
+    extra fields for each reading, or None. If a state dict is given each
+    reading is merged into it and the whole state is encoded.
+    """
+    columns = decoder.decode(frames)
+    names = list(columns.keys())
+    rows = zip(*[column.tolist() for column in columns.values()])
+    if fields is None:
+        fields = [None] * len(timestamps)
+
+    encoded = []
+    for timestamp, device_id, extra_fields, values in zip(timestamps, device_ids, fields, rows):
+        reading = dict(device_id=device_id, datetime=datetime.fromtimestamp(timestamp, tz=timezone.utc))
+        if extra_fields:
+            reading.update(extra_fields)
+        reading.update(zip(names, values))
+        if state is not None:
+            state.update(reading)
+            reading = state
+        encoded.append(RedisEncoderDecoder.encode_reading(reading))
+    return encoded
+
+
+def _run_worker(worker_index: int, buffer_name: str, n_slots: int, codec_name: str, tasks, results):
+    RedisEncoderDecoder.set_codec(codec_name)
+    buffer = shared_memory.SharedMemory(name=buffer_name)
+    slots = np.ndarray((n_slots, MAX_FRAME_WORDS), dtype=np.uint16, buffer=buffer.buf)
+    # layout id -> (device_name, topic, FrameDecoder)
+    layouts = {}
+    # device name -> last values of every field read
+    device_states = {}
+
+    def decode_run(run: list) -> list:
+        device_name, topic, decoder = layouts[run[0][1]]
+        encoded = decode_and_encode(
+            decoder,
+            slots[[task[2] for task in run], :decoder.get_n_words()],
+            [task[3] for task in run],
+            [task[4] for task in run],
+            [task[5] for task in run],
+            device_states.setdefault(device_name, {}))
+        return [(device_name, topic, data) for data in encoded]
+
+    try:
+        running = True
+        while running:
+            batch = [tasks.get()]
+            # Take everything already queued, so the frames of a layout are
+            # decoded together
+            while True:
+                try:
+                    batch.append(tasks.get_nowait())
+                except queue.Empty:
+                    break
+
+            messages = []
+            errors = []
+            used_slots = []
+            run = []
+
+            def flush_run():
+                # A failed run is dropped, its slots are returned with the
+                # rest of the batch
+                try:
+                    messages.extend(decode_run(run))
+                except Exception as e:
+                    errors.append(f"{len(run)} frame(s) of layout {run[0][1]}: {e!r}")
+
+            for task in batch:
+                # A run is the consecutive frames of one layout, decoding runs
+                # in turn keeps the readings in the order they were submitted
+                if run and (task is None or task[0] != FRAME_TASK or task[1] != run[0][1]):
+                    flush_run()
+                    run = []
+
+                if task is None:
+                    running = False
+                elif task[0] == LAYOUT_TASK:
+                    _, layout_id, device_name, topic, register_details = task
+                    try:
+                        layouts[layout_id] = (device_name, topic, FrameDecoder(*register_details))
+                    except Exception as e:
+                        errors.append(f"layout {layout_id} of {device_name}: {e!r}")
+                else:
+                    run.append(task)
+                    used_slots.append(task[2])
+            if run:
+                flush_run()
+
+            results.put((worker_index, used_slots, messages, errors))
+    finally:
+        del slots
+        buffer.close()
+
+
+class DecodePool():
+    def __init__(self, n_workers: int = 4, slots_per_worker: int = 64) -> None:
+        self.n_workers = n_workers
+        self.slots_per_worker = slots_per_worker
+
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        self.buffers = []
+        self.slots = []
+        self.tasks = []
+        self.workers = []
+        for worker_index in range(n_workers):
+            buffer = shared_memory.SharedMemory(create=True, size=slots_per_worker * MAX_FRAME_WORDS * 2)
+            tasks = context.Queue()
+            worker = context.Process(
+                target=_run_worker,
+                args=(worker_index, buffer.name, slots_per_worker, RedisEncoderDecoder.get_codec_name(), tasks, self.results),
+                daemon=True)
+            worker.start()
+            self.buffers.append(buffer)
+            self.slots.append(np.ndarray((slots_per_worker, MAX_FRAME_WORDS), dtype=np.uint16, buffer=buffer.buf))
+            self.tasks.append(tasks)
+            self.workers.append(worker)
+
+        self._condition = threading.Condition()
+        self._free_slots = [list(range(slots_per_worker)) for _ in range(n_workers)]
+        # device name -> handler called with (topic, encoded reading)
+        self.result_handlers = {}
+        # layout id -> worker index
+        self.layout_workers = {}
+
+        self.frames_submitted = 0
+        self.frames_decoded = 0
+        self.slot_waits = 0
+        self.decode_errors = 0
+
+        self._result_thread = threading.Thread(target=self._handle_results, daemon=True)
+        self._result_thread.start()
+
+    def get_stats(self):
+        with self._condition:
+            free_slots = sum([len(free_slots) for free_slots in self._free_slots])
+        return {
+            "workers": self.n_workers,
+            "frames_submitted": self.frames_submitted,
+            "frames_decoded": self.frames_decoded,
+            "frames_in_flight": self.n_workers * self.slots_per_worker - free_slots,
+            "slot_waits": self.slot_waits,
+            "decode_errors": self.decode_errors,
+            "workers_alive": len([worker for worker in self.workers if worker.is_alive()]),
+        }
+
+    def add_device(self, device_name: str, handle_result):
+        """
+        Registers the handler called, from the pool's result thread, with the
+        topic and encoded reading of each frame the device submits.
+        """
+        self.result_handlers[device_name] = handle_result
+
+    def add_layout(self, device_name: str, topic: str, reg_names: list, reg_scalars: list, reg_offsets: list, reg_dtypes: list) -> int:
+        """
+        Sends a read layout of a device, as returned by
+        Edge_device.get_register_details(), and the readings topic of the read
+        to the device's worker. Returns the layout id to submit frames with.
+        """
+        register_details = (reg_names, reg_scalars, reg_offsets, reg_dtypes)
+        if FrameDecoder(*register_details).get_n_words() > MAX_FRAME_WORDS:
+            raise ValueError(f"{device_name}: the read is longer than {MAX_FRAME_WORDS} words.")
+
+        with self._condition:
+            layout_id = len(self.layout_workers)
+            worker_index = get_shard(device_name, self.n_workers)
+            self.layout_workers[layout_id] = worker_index
+        self.tasks[worker_index].put((LAYOUT_TASK, layout_id, device_name, topic, register_details))
+        return layout_id
+
+    def submit(self, layout_id: int, raw_regs: list, timestamp: float, device_id, fields: dict = None, timeout: float = SUBMIT_TIMEOUT):
+        """
+        Queues a raw frame of a layout to be decoded and encoded with the
+        reading's timestamp and device id, and optionally extra fields such
+        as the read timing. Raises DecodePoolError if the worker has stopped
+        or no slot frees up within timeout seconds.
+        """
+        worker_index = self.layout_workers[layout_id]
+        worker = self.workers[worker_index]
+        if not worker.is_alive():
+            raise DecodePoolError(f"decode worker {worker_index} has stopped (exit code {worker.exitcode}).")
+
+        with self._condition:
+            if not self._free_slots[worker_index]:
+                self.slot_waits += 1
+                deadline = time.monotonic() + timeout
+                while not self._free_slots[worker_index]:
+                    if not worker.is_alive():
+                        raise DecodePoolError(f"decode worker {worker_index} has stopped (exit code {worker.exitcode}).")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise DecodePoolError(f"no free slot on decode worker {worker_index} within {timeout}s.")
+                    self._condition.wait(min(remaining, SLOT_WAIT_PERIOD))
+            slot = self._free_slots[worker_index].pop()
+            self.frames_submitted += 1
+
+        # Negative registers wrap to their uint16 value as in update_read()
+        self.slots[worker_index][slot, :len(raw_regs)] = np.asarray(raw_regs).astype(np.uint16)
+        self.tasks[worker_index].put((FRAME_TASK, layout_id, slot, timestamp, device_id, fields))
+
+    def _handle_results(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            worker_index, used_slots, messages, errors = result
+
+            with self._condition:
+                self._free_slots[worker_index].extend(used_slots)
+                self.frames_decoded += len(used_slots)
+                self.decode_errors += len(errors)
+                self._condition.notify_all()
+
+            for error in errors:
+                logger.warning(f"DECODE POOL: worker {worker_index} failed to decode {error}")
+
+            for device_name, topic, data in messages:
+                try:
+                    self.result_handlers[device_name](topic, data)
+                except Exception as e:
+                    logger.warning(f"DECODE POOL: {device_name}: failed to handle reading: {e}")
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results.put(None)
+        self._result_thread.join()
+
+        self.slots = []
+        for buffer in self.buffers:
+            buffer.close()
+            buffer.unlink()
+
+
+def get_decode_pool(pool_config: dict) -> DecodePool:
+    """
+    Returns the decode pool of the process, starting it for the first device
+    that uses it.
+    """
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            _decode_pool = DecodePool(pool_config["workers"], pool_config["slots_per_worker"])
+            # Unlink the shared memory when the process exits
+            atexit.register(_decode_pool.close)
+        return _decode_pool
+
+
+if __name__ == "__main__":
+    import sys
+    from frame_decoder import decode_frames_loop
+    from register_map_compiler import load_register_map
+
+    n_devices = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    n_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    n_workers = os.cpu_count() or 4
+
+    plan = load_register_map(f"{os.path.dirname(__file__)}/../config/config_meter_satec_registers.toml").get_plan()
+    register_details = (plan["reg_names"], plan["reg_scalars"], plan["reg_offsets"], plan["reg_dtypes"])
+    decoder = FrameDecoder(*register_details)
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 65536, size=(n_frames, decoder.get_n_words()), dtype=np.uint16)
+    frame_lists = frames.tolist()
+
+    # In process, each frame decoded one at a time as update_read() does,
+    # then encoded as publish_reading() does
+    start = time.perf_counter()
+    for device in range(n_devices):
+        for values in decode_frames_loop(frames, *register_details):
+            reading = dict(device_id=f"meter_{device}", datetime=datetime.now(tz=timezone.utc))
+            reading.update(values)
+            RedisEncoderDecoder.encode_reading(reading)
+    in_process_time = time.perf_counter() - start
+
+    pool = DecodePool(n_workers, slots_per_worker=256)
+    received = {}
+    done = threading.Event()
+
+    def handle_result(topic, data):
+        received[topic] = received.get(topic, 0) + 1
+        if sum(received.values()) == n_devices * n_frames:
+            done.set()
+
+    layouts = []
+    for device in range(n_devices):
+        pool.add_device(f"meter_{device}", handle_result)
+        layouts.append(pool.add_layout(f"meter_{device}", f"device/meter_{device}/readings/basic", *register_details))
+
+    start = time.perf_counter()
+    for index in range(n_frames):
+        for layout_id in layouts:
+            pool.submit(layout_id, frame_lists[index], time.time(), None)
+    done.wait()
+    pool_time = time.perf_counter() - start
+    pool.close()
+
+    total = n_devices * n_frames
+    print(f"{n_devices} devices x {n_frames} frames of {decoder.get_n_words()} words, codec {RedisEncoderDecoder.get_codec_name()}")
+    print(f"    {'in process, update_read() per frame:':38}{total / in_process_time:10.0f} frames/s")
+    print(f"    {f'pool of {n_workers} workers:':38}{total / pool_time:10.0f} frames/s")
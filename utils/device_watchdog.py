@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+DeviceWatchdog used to keep a device's heartbeat independent of its poll loop
+and to recover the loop when it stalls.
+
+The device loop calls kick() once per iteration. A watchdog thread sends the
+device heartbeat at the heartbeat period as long as the loop has kicked within
+stall_timeout, so heartbeats no longer wait for a slow poll, and stop when the
+loop is stuck (e.g. in the read_modbus() retry loop of an unreachable device)
+so whatever watches the heartbeats sees the device is down.
+
+Recovery of a stalled loop is bounded to two stages:
+    1. after stall_timeout the Modbus connection is reset, so a request
+       blocked on a dead socket fails and read_modbus() reconnects
+    2. after exit_timeout the process exits with WATCHDOG_EXIT_CODE, after
+       running its exit handlers, and the supervisor starts it again.
+       exit_timeout should be below the supervisor's heartbeat_timeout, so
+       the watchdog's exit comes first and the supervisor is the fallback.
+
+Devices sharing a bus arbiter run as threads of one process, so stage 2 is
+skipped for them: one unreachable device would otherwise restart every
+healthy device on its bus. Their heartbeats stay stopped until the loop
+recovers.
+
+Each stage runs once per stall. A stall ends at the next kick(), its duration
+is added to the stall metrics returned by get_stats(), which the device
+publishes with its other metrics. Stalls are also published as device events.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+
+import db_logger
+
+LOGGER_LEVEL = logging.INFO
+
+logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL, queued=True)
+logger = logger_setup.get_logger()
+
+STALL_EVENT = "loop_stall"
+RECOVERED_EVENT = "loop_recovered"
+EXIT_EVENT = "process_exit"
+WATCHDOG_EXIT_CODE = 3
+
+
+def exit_process():
+    """
+    Ends the process for the supervisor to restart it. The stalled thread
+    can't be interrupted, so the exit handlers (flushing the queued loggers,
+    closing the decode pool) are run here before os._exit().
+    """
+    atexit._run_exitfuncs()
+    os._exit(WATCHDOG_EXIT_CODE)
+
+
+class DeviceWatchdog():
+    def __init__(
+        self,
+        device,
+        stall_timeout: float,
+        exit_timeout: float,
+        check_period: float = 0.5,
+        exit=exit_process,
+    ) -> None:
+        self.device = device
+        self.stall_timeout = stall_timeout
+        self.exit_timeout = exit_timeout
+        self.check_period = check_period
+        self.exit = exit
+
+        self.time_last_kick = time.time()
+        self.time_last_heartbeat = 0
+        self.stalled = False
+        self.connection_reset = False
+        self.exiting = False
+
+        self.stalls = 0
+        self.connection_resets = 0
+        self.total_stall_time = 0
+        self.max_stall_time = 0
+        self.last_stall_time = None
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get_stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                "stalls": self.stalls,
+                "stalled": self.stalled,
+                "current_stall_time": now - self.time_last_kick if self.stalled else 0,
+                "last_stall_time": self.last_stall_time,
+                "max_stall_time": self.max_stall_time,
+                "total_stall_time": self.total_stall_time,
+                "connection_resets": self.connection_resets,
+                "time_since_kick": now - self.time_last_kick,
+            }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def kick(self):
+        """
+        Tells the watchdog the device loop is progressing, ending any stall.
+        """
+        now = time.time()
+        with self._lock:
+            stall_time = None
+            if self.stalled:
+                stall_time = now - self.time_last_kick
+                self.stalled = False
+                self.connection_reset = False
+                self.exiting = False
+                self.last_stall_time = stall_time
+                self.total_stall_time += stall_time
+                self.max_stall_time = max(self.max_stall_time, stall_time)
+            self.time_last_kick = now
+
+        if stall_time is not None:
+            logger.info(f"WATCHDOG: {self.device.get_module_name()}: loop recovered after {stall_time:.1f}s.")
+            self.device.publish_event({"event": RECOVERED_EVENT, "stall_time": stall_time})
+
+    def _run(self):
+        while True:
+            try:
+                self.check(time.time())
+            except Exception as e:
+                logger.warning(f"WATCHDOG: {self.device.get_module_name()}: check failed: {e}")
+            time.sleep(self.check_period)
+
+    def check(self, now: float):
+        """
+        Sends the heartbeat if due and the loop is alive, otherwise runs the
+        recovery stage the stall has reached.
+        """
+        with self._lock:
+            time_since_kick = now - self.time_last_kick
+            new_stall = not self.stalled and time_since_kick > self.stall_timeout
+            if new_stall:
+                self.stalled = True
+                self.stalls += 1
+            reset_connection = self.stalled and not self.connection_reset
+            if reset_connection:
+                self.connection_reset = True
+                self.connection_resets += 1
+            exit_due = self.stalled and not self.exiting and time_since_kick > self.exit_timeout
+            if exit_due:
+                self.exiting = True
+            stalled = self.stalled
+
+        if not stalled:
+            if now >= self.time_last_heartbeat + self.device.get_heartbeat_period():
+                self.device.send_heartbeat()
+                self.time_last_heartbeat = now
+                self.device.set_time_last_heartbeat(now)
+            return
+
+        module_name = self.device.get_module_name()
+        if new_stall:
+            logger.warning(f"WATCHDOG: {module_name}: no loop progress for {time_since_kick:.1f}s, stopping heartbeats.")
+            self.device.publish_event({"event": STALL_EVENT, "time_since_kick": time_since_kick})
+
+        if reset_connection:
+            logger.warning(f"WATCHDOG: {module_name}: resetting the Modbus connection.")
+            self.device.reset_connection()
+
+        if exit_due:
+            if self.device.get_bus_arbiter() is not None:
+                logger.error(f"WATCHDOG: {module_name}: no loop progress for {time_since_kick:.1f}s, not exiting as the process is shared with the other devices on its bus.")
+                return
+            logger.error(f"WATCHDOG: {module_name}: no loop progress for {time_since_kick:.1f}s, exiting for the supervisor to restart the process.")
+            self.device.publish_event({"event": EXIT_EVENT, "time_since_kick": time_since_kick})
+            self.exit()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import time
+import math
 from datetime import datetime, timezone
 import struct
 import sys
@@ -9,12 +10,26 @@ import logging
 import toml
 import os
 import ipaddress
+import threading
+import contextlib
+import redis
 
 from utils_custom import Utils
 import db_logger
 from pymodbus.client.sync import ModbusTcpClient
 from redis_edge_device_ipc import Redis_edge_device_ipc
 from pubsub_topic_encoder_decoder import PubSubTopicEncoderDecoder as psted
+from poll_rate_controller import PollRateController
+from report_by_exception import ReportByExceptionFilter, encode_delta_reading_type
+from register_group_scheduler import RegisterGroupScheduler
+from reading_spool import ReadingSpool
+from redis_message_structures import RedisEncoderDecoder
+from write_verifier import WriteVerifier
+from bus_arbiter import get_gateway_arbiter, get_serial_bus_arbiter
+from register_map_compiler import RegisterMapError, load_register_map
+from frame_decoder import FrameDecoder
+from decode_pool import DecodePoolError, get_decode_pool
+from device_watchdog import DeviceWatchdog
 
 # Use either real getmac library for raspios or temporary copied one for buildroot 
 from getmac import get_mac_address
@@ -23,9 +38,14 @@ from getmac import get_mac_address
 ALLOWED_ATTEMPTS = 3
 LOGGER_LEVEL = logging.INFO
 
-logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL)
+logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL, queued=True)
 logger = logger_setup.get_logger()
 CONFIG_FILE = f'{os.path.dirname(__file__)}/../config/config_python_modules.toml'
+SPOOL_DIRECTORY = f'{os.path.dirname(__file__)}/../spool/'
+REDIS_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+TRANSPORT_TCP = "tcp"
+TRANSPORT_SERIAL = "serial"
+TRANSPORT_GATEWAY = "gateway"
 
 class Edge_device():
     def __init__(
@@ -34,11 +54,15 @@ class Edge_device():
         host: ipaddress.IPv4Address, 
         port: int, 
         unit_id: int, 
-        uses_modbus: bool
+        uses_modbus: bool,
+        transport: str = TRANSPORT_TCP
     ) -> None:
         
+        self.transport = transport
+        self.bus_arbiter = None
+
         # Get mac address from ip
-        self.set_device_id(host)
+        self.set_device_id(host, port, unit_id)
 
         self.module_name = module_name
         self.module_type = module_name.rsplit("_", 1)[0]
@@ -49,43 +73,111 @@ class Edge_device():
             self.port = port
             self.unit_id = unit_id
             self.client = self.get_new_modbus_client(host, port)
-            if not self.check_register_locations():
+
+            # Devices with register groups in their config poll each group at
+            # its own rate, otherwise all basic registers are read every poll
+            self.register_group_scheduler = RegisterGroupScheduler.from_config(self.get_config())
+
+            # A compiled register map was fully validated when it was compiled
+            registers_read = self.get_register_map() is not None or self.check_register_locations()
+            if registers_read and self.get_register_map() is None and self.register_group_scheduler is not None:
+                registers_read = self.check_register_locations(self.register_group_scheduler.get_blocks())
+            if not registers_read:
                 error_msg = f"INITIALISE ERROR: registers missing in defined config register blocks for host '{self.host}'. Closing process..."
                 print(error_msg) #TODO: ERROR
                 logger.info(error_msg)
                 sys.exit(1)
+        else:
+            self.register_group_scheduler = None
 
         self.state = dict(datetime=None, device_id=None)
         self.redis_connected = False
+        self.redis_ipc = None
         try:
-            self.redis_ipc = Redis_edge_device_ipc(self.module_name, self.get_module_num())
+            self.redis_ipc = Redis_edge_device_ipc(self.module_name, self.get_module_num(), self.module_type)
             self.redis_connected = True
         except:
-            print("Failed to connect to redis server... Disabling redis functionality.")
+            print("Failed to connect to redis server... Spooling readings until it is available.")
 
         self.safe_mode = False
 
         config = toml.load(CONFIG_FILE)
+
+        # Readings published while redis is unavailable are stored in the spool
+        # and forwarded by a background thread once redis is back
+        spool_config = config["spool"]
+        self.spool = ReadingSpool(
+            SPOOL_DIRECTORY + self.module_name + "/", 
+            spool_config["max_bytes"], 
+            spool_config["segment_bytes"])
+        self.spool_drain_rate = spool_config["drain_rate"]
+        self.redis_reconnect_period = spool_config["reconnect_period"]
+        self.max_group_command_delay = config["group_commands"]["max_execute_delay"]
+
+        # Devices that verify their writes record the expected register values
+        # in the write verifier, which checks them against later reads
+        self.write_verifier = None
+
+        # Devices that only publish their readings can hand the raw frames to
+        # the process's decode pool, which decodes, encodes and publishes them
+        self.decode_pool = None
+        self.decode_pool_layouts = {}
+
+        # Poll rate, bus and write verification metrics are published together
+        # every metrics period
+        self.metrics_period = config["metrics"]["period"]
+        self.time_last_metrics = time.time()
+        self._store_and_forward_thread = None
         desired_reporting_frequency = config["ipc-parameters"]["reporting_frequency"]
         min_period = config["min-reporting-periods"][self.module_type]
         self.reporting_period = max(min_period, (1 / desired_reporting_frequency))
 
+        # When adaptive polling is enabled the reporting period is picked by
+        # the poll rate controller from the measured device round trip times
+        self.poll_rate_controller = None
+        if config["adaptive-polling"]["enabled"]:
+            self.enable_adaptive_polling(config)
+
         self.slow_reporting_frequency = config["ipc-parameters"]["slow_reporting_frequency"]
 
+        # In report by exception mode only the fields that moved outside their
+        # deadband are published, with a full keyframe at the slow reporting
+        # frequency. One filter is kept per reading type.
+        self.report_by_exception = config["ipc-parameters"]["report_by_exception"]
+        self.report_by_exception_filters = {}
+
         self.time_last_heartbeat = time.time()
         self.heartbeat_frequency = config["global"]['heartbeat_frequency']
         self.heartbeat_topic = psted.encode_heartbeat(
                                 module_name=self.module_name,
                                 module_num=self.module_num)
 
+        # With a watchdog the heartbeats are sent by the watchdog thread while
+        # the device loop keeps calling keep_alive()
+        self.watchdog = None
+        if config["watchdog"]["enabled"]:
+            self.enable_watchdog(config)
+
         self.set_sleep_time(self.reporting_period)
 
+        # Polls can be aligned to wall clock boundaries so the readings of
+        # devices polled at the same rate are taken at the same instants
+        sampling_config = config["sampling"]
+        self.align_polls = sampling_config["align_polls_to_wall_clock"]
+        self.alignment_period = sampling_config["alignment_period"]
+        # Readings carry the send time of the first request and the read
+        # duration when read_timing is set
+        self.read_timing = sampling_config["read_timing"]
+        self.last_read_timing = None
+
         self.time_last_publish = time.time()
 
         # Set reading_type to basic, if another type of reading is done then
         # need to set the state of reading_type e.g. battery basic vs voltage vs
         # temperature
         self.reading_type = "basic"
+        # Register config entries of the last read, for its deadbands
+        self.read_registers = None
 
         self.time_last_command = time.time()
         
@@ -137,6 +229,9 @@ class Edge_device():
     def get_reading_type(self):
         return self.reading_type
 
+    def get_read_registers(self):
+        return self.read_registers
+
     def get_module_num(self):
         """
         The number of the device, e.g. 1/3 statcoms installed
@@ -161,6 +256,9 @@ class Edge_device():
     def set_reading_type(self, reading_type: str):
         self.reading_type = reading_type
 
+    def set_reporting_period(self, reporting_period):
+        self.reporting_period = reporting_period
+
     def reset_state(self):
         self.state = dict(datetime=None, device_id=self.get_device_id())
 
@@ -181,24 +279,116 @@ class Edge_device():
 
     def get_config(self):
         raise NotImplementedError
+
+    def get_register_map(self):
+        """
+        Returns the compiled RegisterMap of the device's register config, or
+        None for devices that load their config directly.
+        """
+        return None
+
+    def load_register_map(self, config_path):
+        """
+        Returns the compiled register map of a register config file, closing
+        the process if the file is invalid.
+        """
+        try:
+            return load_register_map(config_path)
+        except RegisterMapError as e:
+            error_msg = f"INITIALISE ERROR: invalid register config: {e}. Closing process..."
+            print(error_msg) #TODO: ERROR
+            logger.info(error_msg)
+            sys.exit(1)
     
     def get_polarity(self):
         return 1
     
+    def get_poll_rate_controller(self):
+        return self.poll_rate_controller
+
+    def enable_adaptive_polling(self, config=None):
+        """
+        Creates a poll rate controller for this device type using the bounds
+        set in the config_python_modules.toml file, starting from the current
+        reporting period.
+        """
+        if config is None:
+            config = toml.load(CONFIG_FILE)
+        self.poll_rate_controller = PollRateController.from_config(
+            config, 
+            self.module_type, 
+            initial_frequency=1 / self.reporting_period)
+
+    def record_poll(self, duration, errors=0, requests=1):
+        """
+        Records the total round trip time of the requests of a read poll and
+        its number of failed requests. In adaptive polling mode the reporting
+        period is updated to the rate the device can currently sustain.
+        """
+        if self.poll_rate_controller is None or requests == 0:
+            return
+
+        self.poll_rate_controller.record(duration / requests, errors, requests)
+        self.reporting_period = self.poll_rate_controller.get_period()
+        self.set_sleep_time(self.reporting_period - duration)
+
     def get_new_modbus_client(self, host, port):
+        """
+        Returns the client for the device's transport. Serial devices get a
+        client on the shared arbiter of their port, where host is the serial
+        port path and port the baud rate. Gateway devices get a client on the
+        shared arbiter of the gateway at host and port.
+        """
+        if self.transport == TRANSPORT_SERIAL:
+            serial_config = toml.load(CONFIG_FILE)["serial"]
+            self.bus_arbiter = get_serial_bus_arbiter(host, port, serial_config)
+            return self.bus_arbiter.get_client(self.unit_id)
+        if self.transport == TRANSPORT_GATEWAY:
+            gateway_config = toml.load(CONFIG_FILE)["gateway"]
+            self.bus_arbiter = get_gateway_arbiter(host, port, gateway_config)
+            return self.bus_arbiter.get_client(self.unit_id)
         return ModbusTcpClient(host=host, port=port)
 
-    def set_device_id(self, host):
+    def get_bus_arbiter(self):
+        return self.bus_arbiter
+
+    def bus_batch(self):
+        """
+        Returns a context holding the shared bus, if the device is on one, for
+        several requests.
+        """
+        if self.bus_arbiter is None:
+            return contextlib.nullcontext()
+        return self.bus_arbiter.batch(self.unit_id)
+
+    def bus_sleep(self, duration):
+        if self.bus_arbiter is None:
+            time.sleep(duration)
+        else:
+            self.bus_arbiter.sleep(duration)
+
+    def set_device_id(self, host, port=None, unit_id=None):
         """
         Uses getmac library to return the mac address for an ip
         """
+        if self.transport == TRANSPORT_SERIAL:
+            # Serial devices have no mac address, use the port name and the
+            # unit id of the device on the daisy chain instead
+            self.device_id = f"{os.path.basename(host)}_{unit_id}"
+            return
+        if self.transport == TRANSPORT_GATEWAY:
+            # The mac address is the gateway's, shared by every unit behind it
+            self.device_id = f"{host}_{port}_{unit_id}"
+            return
+
         # Get mac address from ip
         mac = str(get_mac_address(ip=host))
         self.device_id = "".join(mac.split(":"))
 
-    def check_register_locations(self):
+    def check_register_locations(self, registers_to_read=None):
         locations = self.get_config_section_and_key_list("basic_read_registers", "location")
-        registers_to_read = self.get_config()["basic_read_block"]
+        if registers_to_read == None:
+            registers_to_read = self.get_config()["basic_read_block"]
 
         for l in locations:
             found = False
@@ -230,61 +420,287 @@ class Edge_device():
         else:
             return False
 
+    def get_aligned_period(self):
+        """
+        Returns the reporting period rounded up to a whole number of alignment
+        periods.
+        """
+        period = self.get_reporting_period()
+        if self.alignment_period > 0:
+            # The tolerance stops a period that is already a multiple, e.g.
+            # 0.3 for 0.1, being rounded up by float error
+            period = math.ceil(period / self.alignment_period - 1e-9) * self.alignment_period
+        return period
+
+    def get_next_poll_time(self, now: float):
+        """
+        Returns the next wall clock time that is a whole number of aligned
+        periods since the epoch.
+        """
+        period = self.get_aligned_period()
+        return math.floor(now / period) * period + period
+
     def sleep(self):
+        if self.align_polls:
+            now = time.time()
+            time.sleep(self.get_next_poll_time(now) - now)
+            return
         time.sleep(max(0, self.get_sleep_time()))
 
-    def read_modbus(self, register_blocks):
+    def read_modbus(self, register_blocks, exact_count=False):
         """
         https://stackoverflow.com/questions/69881272/pymodbus-read-and-decode-register-value
 
         Args:
             register_blocks (_type_): _description_
+            exact_count (bool): read number_registers registers from each
+                block instead of the config block convention of 
+                number_registers - 1.
 
         Returns:
             _type_: _description_
+
+        The wall clock and monotonic times each block's request was sent and
+        the duration of the whole read are kept, see get_last_read_timing().
         """
         data_frame = []
-        time_stamp = None
+        block_times = []
+        block_monotonic_times = []
+        read_start = time.monotonic()
         allowed_attempts = ALLOWED_ATTEMPTS
+        request_time = 0
+        errors = 0
 
         # TODO refactor below code to remove the large amount of code in a try except block
-        for start_register, number_registers in register_blocks:
-            read_error = True
-
-            while read_error:
-                try:
-                    # NOTE register block may need to start at (first_register_addr - 1), some devices may need to
-                    # start at the first_register_addr
-                    if self.unit_id == None:
-                        register_readings = self.client.read_holding_registers(address=start_register, count=number_registers - 1)
-                    else:
-                        register_readings = self.client.read_holding_registers(address=start_register, count=number_registers - 1, unit=self.unit_id)
-                    read_error = False
+        # On a shared bus the device holds the bus for all blocks of the read
+        with self.bus_batch():
+            for start_register, number_registers in register_blocks:
+                read_error = True
+                count = number_registers if exact_count else number_registers - 1
 
+                while read_error:
                     try:
-                        register_values = register_readings.registers
+                        # NOTE register block may need to start at (first_register_addr - 1), some devices may need to
+                        # start at the first_register_addr
+                        request_start = time.perf_counter()
+                        block_time = time.time()
+                        block_monotonic_time = time.monotonic()
+                        if self.unit_id == None:
+                            register_readings = self.client.read_holding_registers(address=start_register, count=count)
+                        else:
+                            register_readings = self.client.read_holding_registers(address=start_register, count=count, unit=self.unit_id)
+                        read_error = False
+
+                        try:
+                            register_values = register_readings.registers
+                        except Exception as e:
+                            print(f"\nError reading modbus reg: {e}\n")
+                            raise Exception
+
+                        request_time += time.perf_counter() - request_start
+
                     except Exception as e:
-                        print(f"\nError reading modbus reg: {e}\n")
-                        raise Exception
-
-                except Exception as e:
-                    read_error = True
-                    if allowed_attempts > 0:
-                        allowed_attempts -= 1
-                    else:
-                        print(f'{self.get_module_name()} : failed to read {ALLOWED_ATTEMPTS} time. Restarting pymodbus connection.') #TODO: ERROR
-                        logger.warning(f"EDGE DEVICE: {self.get_module_name()}: failed to read {ALLOWED_ATTEMPTS} time(s). Restarting pymodbus connection.")
-                        self.client = self.get_new_modbus_client(self.host, self.port)
-
-                        allowed_attempts = 3
-                    time.sleep(0.5)
-
-            if time_stamp is None:
-                time_stamp = time.time()
-                
-            data_frame.extend(register_values)
+                        read_error = True
+                        errors += 1
+                        if allowed_attempts > 0:
+                            allowed_attempts -= 1
+                        else:
+                            print(f'{self.get_module_name()} : failed to read {ALLOWED_ATTEMPTS} time. Restarting pymodbus connection.') #TODO: ERROR
+                            logger.warning(f"EDGE DEVICE: {self.get_module_name()}: failed to read {ALLOWED_ATTEMPTS} time(s). Restarting pymodbus connection.")
+                            self.client.close()
+                            self.client = self.get_new_modbus_client(self.host, self.port)
+
+                            allowed_attempts = 3
+                        self.bus_sleep(0.5)
+
+                block_times.append(block_time)
+                block_monotonic_times.append(block_monotonic_time)
+                data_frame.extend(register_values)
+
+        self.last_read_timing = dict(
+            block_times=block_times,
+            block_monotonic_times=block_monotonic_times,
+            read_duration=time.monotonic() - read_start)
+        self.record_poll(request_time, errors, len(register_blocks))
+        if self.write_verifier is not None:
+            self.write_verifier.observe(register_blocks, data_frame, time.time(), exact_count)
         return data_frame
   
+    def get_last_read_timing(self):
+        """
+        Returns the timing of the last read_modbus() call: the time.time() and
+        time.monotonic() times the request of each block was sent, which is
+        the last attempt when a request was retried, and the read duration in
+        seconds including retries.
+        """
+        return self.last_read_timing
+
+    def get_read_timing_fields(self):
+        """
+        Returns the timing of the last read as the scalar reading fields
+        published when read_timing is set.
+        """
+        read_timing = self.get_last_read_timing()
+        return dict(
+            read_start_time=read_timing["block_times"][0],
+            read_duration=read_timing["read_duration"])
+
+    def write_modbus(self, register_blocks):
+        """
+        Writes the register blocks and returns the function code of each
+        response. Modbus exception responses have the high bit of the
+        function code set. Writes are kept out of the poll rate controller,
+        which only sees reads.
+        """
+        function_codes = []
+        for start_register, register_values in register_blocks:
+            response = self.client.write_registers(start_register, register_values, unit=self.get_unit_id())
+            function_codes.append(response.function_code)
+        return function_codes
+
+    def enable_write_verification(self, config=None):
+        if config is None:
+            config = toml.load(CONFIG_FILE)
+        self.write_verifier = WriteVerifier(config["write_verification"]["verify_timeout"])
+
+    def get_write_verifier(self):
+        return self.write_verifier
+
+    def verify_writes(self):
+        """
+        Reads the written registers that the normal polls have not verified in
+        time, then publishes any mismatches as events.
+        """
+        if self.write_verifier is None:
+            return
+
+        now = time.time()
+        overdue_blocks = self.write_verifier.get_overdue_blocks(now)
+        if overdue_blocks:
+            self.read_modbus(overdue_blocks, exact_count=True)
+
+        for event in self.write_verifier.pop_events():
+            logger.warning(f"EDGE DEVICE: {self.get_module_name()}: wrote {event['expected']} to register {event['address']} but read {event['observed']}.")
+            self.publish_event(event)
+
+    def enable_decode_pool(self, config=None):
+        """
+        Hands this device's raw reads to the process's decode pool, which
+        decodes, encodes and publishes them on other cores. Only for devices
+        that don't use their state, as it is no longer updated by the reads.
+        """
+        if config is None:
+            config = toml.load(CONFIG_FILE)
+        if self.report_by_exception:
+            logger.warning(f"EDGE DEVICE: {self.get_module_name()}: report by exception needs the decoded state, not using the decode pool.")
+            return
+        self.decode_pool = get_decode_pool(config["decode_pool"])
+        self.decode_pool.add_device(self.module_name, self.send_reading)
+
+    def get_decode_pool_layout(self, custom_read=None):
+        """
+        Returns the decode pool layout id of a read, adding the layout to the
+        pool on the read's first use.
+        """
+        blocks = self.get_config()["basic_read_block"] if custom_read is None else custom_read["blocks"]
+        key = tuple([(block["start"], block["size"]) for block in blocks])
+        if key not in self.decode_pool_layouts:
+            topic = psted.encode_readings_topic(
+                f'{self.module_type}_{self.module_num}',
+                self.get_module_num(),
+                self.get_reading_type())
+            self.decode_pool_layouts[key] = self.decode_pool.add_layout(
+                self.module_name,
+                topic,
+                *self.get_register_details(custom_read=custom_read))
+        return self.decode_pool_layouts[key]
+
+    def enable_watchdog(self, config=None):
+        if config is None:
+            config = toml.load(CONFIG_FILE)
+        watchdog_config = config["watchdog"]
+        self.watchdog = DeviceWatchdog(
+            self,
+            watchdog_config["stall_timeout"],
+            watchdog_config["exit_timeout"],
+            watchdog_config["check_period"])
+
+    def get_watchdog(self):
+        return self.watchdog
+
+    def keep_alive(self):
+        """
+        Called once per iteration of the device loop. Tells the watchdog the
+        loop is progressing, or without a watchdog sends the heartbeat when it
+        is due.
+        """
+        if self.watchdog is not None:
+            self.watchdog.start()
+            self.watchdog.kick()
+            return
+
+        now = time.time()
+        if now > self.get_time_last_heartbeat() + self.get_heartbeat_period():
+            self.send_heartbeat()
+            self.set_time_last_heartbeat(now)
+
+    def reset_connection(self):
+        """
+        Closes the Modbus connection from another thread, so a request blocked
+        on it fails and read_modbus() reconnects. Devices on a shared bus close
+        all of the bus connections, as the bus is held by the stalled request.
+        """
+        if self.bus_arbiter is not None:
+            self.bus_arbiter.close_connections()
+        elif getattr(self, "client", None) is not None:
+            self.client.close()
+
+    def get_metrics(self) -> dict:
+        metrics = {}
+        if self.poll_rate_controller is not None:
+            metrics["poll_rate"] = self.poll_rate_controller.get_stats()
+        if self.bus_arbiter is not None:
+            metrics["bus"] = self.bus_arbiter.get_unit_stats(self.unit_id)
+        if self.write_verifier is not None:
+            metrics["write_verification"] = self.write_verifier.get_stats()
+        if self.decode_pool is not None:
+            metrics["decode_pool"] = self.decode_pool.get_stats()
+        if self.watchdog is not None:
+            metrics["watchdog"] = self.watchdog.get_stats()
+        return metrics
+
+    def publish_device_metrics(self):
+        """
+        Publishes the device metrics if the metrics period has passed.
+        """
+        now = time.time()
+        if now < self.time_last_metrics + self.metrics_period:
+            return
+        self.time_last_metrics = now
+
+        metrics = self.get_metrics()
+        if metrics:
+            self.publish_metrics(metrics)
+
+    def publish_event(self, event: dict):
+        self.send_diagnostic(psted.encode_event_topic(self.module_name), event)
+
+    def publish_metrics(self, metrics: dict):
+        self.send_diagnostic(psted.encode_metrics_topic(self.module_name), metrics)
+
+    def send_diagnostic(self, topic: str, data: dict):
+        """
+        Sends an event or metrics message. Unlike readings these are not
+        spooled while redis is unavailable.
+        """
+        if not self.redis_connected:
+            return
+        data = dict(data, datetime=datetime.now(tz=timezone.utc), device_id=self.get_state()["device_id"])
+        try:
+            self.redis_ipc.send_message(topic, RedisEncoderDecoder.encode_json_with_date(data))
+        except REDIS_ERRORS as e:
+            self.set_redis_disconnected(e)
+
     def get_config_section_and_key_list(self, section, key):
         """
         Returns a list of the register data values of the same key from config
@@ -317,13 +733,105 @@ class Edge_device():
         raise NotImplementedError
 
     def listen(self):
+        # Readings are still taken while redis is down so they can be spooled
+        self.log_reading()
+        if self.redis_connected:
+            try:
+                self.redis_ipc.listen(
+                    self.handle_command, 
+                    self.log_reading, 
+                    self.handle_error, 
+                    self.set_sleep_time,
+                    self.handle_group_command)
+            except REDIS_ERRORS as e:
+                self.set_redis_disconnected(e)
+            self.process_command_queue()
+            self.publish_device_metrics()
+
+    def process_command_queue(self):
+        """
+        Runs the commands queued by handle_command, for devices that queue
+        their commands rather than running them as they arrive.
+        """
+        pass
+
+    def handle_group_command(self, command_data):
+        """
+        Handles a command sent to every device of this type. The command is
+        executed at its execute_at time, so all devices act together, and
+        acknowledged on the group command ack topic with its timings.
+        """
+        time_received = time.time()
+        command = RedisEncoderDecoder.decode_command(command_data)
+
+        if command.execute_at is not None:
+            delay = command.execute_at - time.time()
+            if delay > self.max_group_command_delay:
+                logger.warning(f"EDGE DEVICE: {self.get_module_name()}: group command '{command.command_key_word}' scheduled {delay:.3f}s ahead, executing now.")
+            elif delay > 0:
+                time.sleep(delay)
+
+        time_executed = time.time()
+        success = True
+        try:
+            self.handle_command(command_data)
+            self.process_command_queue()
+        except Exception as e:
+            success = False
+            logger.warning(f"EDGE DEVICE: {self.get_module_name()}: group command '{command.command_key_word}' failed: {e}")
+
+        ack = {
+            "datetime": datetime.now(tz=timezone.utc),
+            "command_id": command.command_id,
+            "device_name": self.get_module_name(),
+            "command_key_word": command.command_key_word,
+            "success": success,
+            "time_received": time_received,
+            "time_executed": time_executed,
+            "duration": time.time() - time_executed,
+        }
+        self.redis_ipc.send_message(
+            psted.encode_group_command_ack_topic(self.module_type, self.module_name),
+            RedisEncoderDecoder.encode_json_with_date(ack))
+
+    def set_redis_disconnected(self, error):
         if self.redis_connected:
-            self.log_reading()
-            self.redis_ipc.listen(
-                self.handle_command, 
-                self.log_reading, 
-                self.handle_error, 
-                self.set_sleep_time)
+            logger.warning(f"EDGE DEVICE: {self.get_module_name()}: lost connection to redis, spooling readings: {error}")
+        self.redis_connected = False
+        self.start_store_and_forward()
+
+    def start_store_and_forward(self):
+        """
+        Starts the background thread that reconnects to redis and forwards the
+        spooled readings, if it isn't already running.
+        """
+        if self._store_and_forward_thread is None:
+            self._store_and_forward_thread = threading.Thread(target=self._store_and_forward_loop, daemon=True)
+            self._store_and_forward_thread.start()
+
+    def _store_and_forward_loop(self):
+        drain_interval = 0.1
+        while True:
+            if not self.redis_connected:
+                time.sleep(self.redis_reconnect_period)
+                try:
+                    self.redis_ipc = Redis_edge_device_ipc(self.module_name, self.get_module_num(), self.module_type)
+                    self.redis_connected = True
+                    logger.info(f"EDGE DEVICE: {self.get_module_name()}: reconnected to redis, forwarding {self.spool.get_bytes()} spooled bytes.")
+                except Exception:
+                    continue
+
+            # Forward the backlog at a limited rate so redis and its
+            # subscribers are not flooded on reconnect
+            try:
+                sent = self.spool.drain(self.redis_ipc.send_message, max(1, int(self.spool_drain_rate * drain_interval)))
+            except REDIS_ERRORS as e:
+                self.set_redis_disconnected(e)
+                continue
+            if sent == 0:
+                time.sleep(self.redis_reconnect_period)
+            else:
+                time.sleep(drain_interval)
 
     def handle_error(self, error_code):
         """
@@ -344,8 +852,10 @@ class Edge_device():
     def send_heartbeat(self):
         if self.redis_connected:
             # print("Sending hearbeat from " + self.get_module_name()) #TODO: ERROR
-            heartbeat_topic = psted.encode_heartbeat(self.module_name, self.module_num)
-            self.redis_ipc.send_message(heartbeat_topic, time.time())
+            try:
+                self.redis_ipc.send_message(self.heartbeat_topic, time.time())
+            except REDIS_ERRORS as e:
+                self.set_redis_disconnected(e)
         
         
     # def send_heartbeat_with_wait(self, wait: int):
@@ -367,7 +877,14 @@ class Edge_device():
         """
         if not self.check_safe_mode():
             # print("Logging") #TODO: ERROR
-            self.update()
+            if self.decode_pool is not None:
+                # The reading is published by the decode pool, unless the
+                # pool failed and it was decoded here
+                if not self.submit_reading():
+                    return
+            elif self.update() == False:
+                # No register group was due so there is nothing new to publish
+                return
 
             if self.state:
                 # print(self.state)
@@ -376,21 +893,85 @@ class Edge_device():
             print("Not logging as in safe mode...")
 
     def publish_data(self):
-        if self.redis_connected:
-            # print(f"reading type === {self.get_reading_type()}")
-            
-            # NOTE only publish the data if the time since last publish is more than
-            # 1 sec to avoid the postgres db being spamming with messages
-            # if now - self.time_last_publish >= 1:
-            device_name = f'{self.module_type}_{self.module_num}'
-            self.redis_ipc.publish_data(
-                device_name=device_name,
-                device_num=self.get_module_num(),
-                reading_type=self.get_reading_type(),
-                data=self.get_state(),
-                date_time_keys=self.get_datetime_values()
-                )
-                # self.time_last_publish = now
+        # print(f"reading type === {self.get_reading_type()}")
+        
+        # NOTE only publish the data if the time since last publish is more than
+        # 1 sec to avoid the postgres db being spamming with messages
+        # if now - self.time_last_publish >= 1:
+        reading_type = self.get_reading_type()
+        data = self.get_state()
+
+        if self.report_by_exception:
+            report_filter = self.get_report_by_exception_filter(reading_type, self.get_read_registers())
+            is_keyframe, data = report_filter.filter(data, time.time())
+            if data is None:
+                return
+            if not is_keyframe:
+                reading_type = encode_delta_reading_type(reading_type)
+
+        self.publish_reading(reading_type, data)
+            # self.time_last_publish = now
+
+    def publish_reading(self, reading_type, data):
+        """
+        Publishes a reading dict, which must contain a datetime, on the
+        readings topic of this device for the given reading type.
+
+        While redis is unavailable, or older readings are still waiting in the
+        spool, the reading is appended to the spool so readings are forwarded
+        in order.
+        """
+        device_name = f'{self.module_type}_{self.module_num}'
+        topic, data_json = Redis_edge_device_ipc.encode_data(
+            device_name=device_name,
+            device_num=self.get_module_num(),
+            reading_type=reading_type,
+            data=data)
+        self.send_reading(topic, data_json)
+
+    def send_reading(self, topic, data_json):
+        """
+        Sends an encoded reading, spooling it while redis is unavailable.
+        """
+        if self.redis_connected and self.spool.is_empty():
+            try:
+                self.redis_ipc.send_message(topic, data_json)
+                return
+            except REDIS_ERRORS as e:
+                self.set_redis_disconnected(e)
+
+        self.start_store_and_forward()
+        self.spool.append(topic, data_json)
+
+    def get_report_by_exception_filter(self, reading_type, registers=None):
+        """
+        Returns the filter of a reading type with the deadbands of registers,
+        the registers of the read being published, added to it.
+        """
+        if registers is None:
+            registers = self.get_config()["basic_read_registers"]
+        if reading_type not in self.report_by_exception_filters:
+            self.report_by_exception_filters[reading_type] = ReportByExceptionFilter.from_register_config(
+                registers, 
+                self.get_slow_reporting_period())
+        report_filter = self.report_by_exception_filters[reading_type]
+        report_filter.add_registers(registers)
+        return report_filter
+
+    def get_register_details(self, custom_read=None):
+        """
+        Returns the names, scalars, offsets and dtypes of the values unpacked
+        from a read, from the compiled decode plan when the device has a
+        register map.
+        """
+        register_map = self.get_register_map()
+        if register_map is None:
+            return self.register_details_in_blocks(custom_read=custom_read)
+
+        plan = register_map.get_plan(custom_read)
+        polarity = self.get_polarity()
+        reg_scalars = [scalar * polarity for scalar in plan["reg_scalars"]]
+        return plan["reg_names"], reg_scalars, plan["reg_offsets"], plan["reg_dtypes"]
 
     def register_details_in_blocks(self, custom_read=None):
 
@@ -501,10 +1082,35 @@ class Edge_device():
         
         return reg_names_blocked_final, reg_scalars_blocked_final, reg_offsets_blocked_final, reg_dtypes_blocked_final
 
-    def update_read(self, custom_read=None):
+    def get_frame_decoder(self, custom_read=None):
+        """
+        Returns a FrameDecoder for the raw frames of a read, to decode a
+        (T, n_words) stack of captured frames into columns in one pass.
+        custom_read is as passed to update_read().
+        """
+        return FrameDecoder(*self.get_register_details(custom_read=custom_read))
+
+    def get_read_blocks(self, custom_read=None):
+        """
+        Sets the reading type of a read and returns its (start, size) blocks.
+        """
+        if custom_read == None:
+            registers_to_read = self.get_config()["basic_read_block"]
+            self.set_reading_type('basic')
+            self.read_registers = self.get_config()["basic_read_registers"]
+        else:
+            registers_to_read = custom_read["blocks"]
+            self.set_reading_type(custom_read["reading_type"])
+            self.read_registers = custom_read["registers"]
+        registers_tuple = []
+        for reg in registers_to_read:
+            registers_tuple.append((reg["start"], reg["size"]))
+        return registers_tuple
+
+    def update_read(self, custom_read=None, raw_regs=None):
         """
         Queries the device and reads the chosen registers. The current device
-        state is returned.
+        state is returned. raw_regs decodes registers already read instead.
 
         If custom_read == None then only the "basic_read_registers" from the 
         device config file will be read for the device. If you wish to read a 
@@ -516,22 +1122,14 @@ class Edge_device():
             "blocks": <list of register blocks to read>
         }
         """
-        reg_names, reg_scalars, reg_offsets, reg_dtypes = self.register_details_in_blocks(custom_read=custom_read)
+        reg_names, reg_scalars, reg_offsets, reg_dtypes = self.get_register_details(custom_read=custom_read)
         # print(f"lengthe of reg names == {len(reg_names)}")
         unpack_string = "".join(reg_dtypes)
         # print(reg_dtypes)
         
-        if custom_read == None:
-            registers_to_read = self.get_config()["basic_read_block"]
-            self.set_reading_type('basic')
-        else:
-            registers_to_read = custom_read["blocks"]
-            self.set_reading_type(custom_read["reading_type"])
-        registers_tuple = []
-        for reg in registers_to_read:
-            registers_tuple.append((reg["start"], reg["size"]))
-
-        raw_regs = self.read_modbus(registers_tuple)
+        read_blocks = self.get_read_blocks(custom_read)
+        if raw_regs is None:
+            raw_regs = self.read_modbus(read_blocks)
         
         
         # decoder = BinaryPayloadDecoder.fromRegisters(raw_regs, byteorder=Endian.Big, wordorder=Endian.Big)
@@ -600,6 +1198,64 @@ class Edge_device():
         return results_obj
 
     def update(self):
-        timestamp = datetime.now(tz=timezone.utc)
-        self.get_state().update(datetime=timestamp)
-        self.get_state().update(self.update_read())
+        """
+        Reads the device and updates the state. If the device has register
+        groups only the groups that are due are read, and False is returned
+        when none are due.
+
+        The reading is timestamped with the time the first block was
+        requested.
+        """
+        custom_read = None
+        if self.register_group_scheduler is not None:
+            custom_read = self.register_group_scheduler.get_due_read(time.time())
+            if custom_read is None:
+                return False
+
+        self.update_state(custom_read)
+        return True
+
+    def update_state(self, custom_read=None, raw_regs=None):
+        """
+        Decodes a read into the state, reading the device unless the raw
+        registers of the read are given.
+        """
+        reading = self.update_read(custom_read=custom_read, raw_regs=raw_regs)
+        read_timing = self.get_last_read_timing()
+        self.get_state().update(datetime=datetime.fromtimestamp(read_timing["block_times"][0], tz=timezone.utc))
+        if self.read_timing:
+            self.get_state().update(self.get_read_timing_fields())
+        self.get_state().update(reading)
+
+    def submit_reading(self):
+        """
+        Reads the device like update() and submits the raw frame to the decode
+        pool instead of decoding it. The device state is not updated.
+
+        If the pool fails the device stops using it and the frame is decoded
+        into the state instead, and True is returned as the reading still
+        needs publishing.
+        """
+        custom_read = None
+        if self.register_group_scheduler is not None:
+            custom_read = self.register_group_scheduler.get_due_read(time.time())
+            if custom_read is None:
+                return False
+
+        raw_regs = self.read_modbus(self.get_read_blocks(custom_read))
+        read_timing = self.get_last_read_timing()
+        try:
+            layout_id = self.get_decode_pool_layout(custom_read)
+            self.decode_pool.submit(
+                layout_id, 
+                raw_regs, 
+                read_timing["block_times"][0], 
+                self.get_state()["device_id"],
+                self.get_read_timing_fields() if self.read_timing else None)
+            return False
+        except DecodePoolError as e:
+            logger.warning(f"EDGE DEVICE: {self.get_module_name()}: decode pool unavailable, decoding readings in process: {e}")
+            self.decode_pool = None
+
+        self.update_state(custom_read, raw_regs)
+        return True
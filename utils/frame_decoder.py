@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+FrameDecoder used to decode many raw register frames of one device layout at
+once, e.g. to back-fill or analyse captured data.
+
+A frame is the list of raw registers returned by one Edge_device.read_modbus()
+call, so a stack of T frames is a (T, n_words) uint16 array. The decoder is
+built from the register details of a read (Edge_device.get_register_details()
+or a compiled decode plan) and decodes the stack in one vectorised pass per
+dtype: the words of all registers of a dtype are gathered into a contiguous
+(T, n_registers, words) array and viewed as that dtype, with the same little
+endian word order as the struct.unpack() in Edge_device.update_read(). The
+values are then scaled, offset and rounded to 1 decimal as update_read() does.
+
+decode() returns a dict of register name -> float64 column of length T, the
+"unused_" registers are dropped.
+
+Usage:
+    python frame_decoder.py [register config file] [frames]    # benchmark
+"""
+import struct
+import sys
+import time
+
+import numpy as np
+from register_map_compiler import DTYPE_WORDS
+from register_values import NUMPY_DTYPES
+UNUSED_PREFIX = "unused_"
+
+
+class FrameDecoder():
+    def __init__(self, reg_names: list, reg_scalars: list, reg_offsets: list, reg_dtypes: list) -> None:
+        self.n_words = sum([DTYPE_WORDS[dtype] for dtype in reg_dtypes])
+
+        # dtype -> (names, word indexes, scalars, offsets) of its registers
+        self.groups = {}
+        word_index = 0
+        for name, scalar, offset, dtype in zip(reg_names, reg_scalars, reg_offsets, reg_dtypes):
+            if not name.startswith(UNUSED_PREFIX):
+                group = self.groups.setdefault(dtype, ([], [], [], []))
+                group[0].append(name)
+                group[1].append(word_index)
+                group[2].append(scalar)
+                group[3].append(offset)
+            word_index += DTYPE_WORDS[dtype]
+
+        for dtype, (names, word_indexes, scalars, offsets) in self.groups.items():
+            words = DTYPE_WORDS[dtype]
+            # (n_registers, words) indexes of every word of each register
+            columns = np.asarray(word_indexes)[:, np.newaxis] + np.arange(words)
+            self.groups[dtype] = (
+                names,
+                columns,
+                np.asarray(scalars, dtype=np.float64),
+                np.asarray(offsets, dtype=np.float64))
+
+    @classmethod
+    def from_plan(cls, plan: dict, polarity: int = 1):
+        """
+        Returns the decoder of a decode plan from the register map compiler.
+        """
+        reg_scalars = [scalar * polarity for scalar in plan["reg_scalars"]]
+        return cls(plan["reg_names"], reg_scalars, plan["reg_offsets"], plan["reg_dtypes"])
+
+    def get_n_words(self) -> int:
+        return self.n_words
+
+    def decode(self, frames) -> dict:
+        """
+        Decodes a (T, n_words) stack of raw frames, or a single frame, into a
+        dict of register name -> column of T values.
+        """
+        frames = np.asarray(frames)
+        if frames.ndim == 1:
+            frames = frames[np.newaxis, :]
+        if frames.shape[1] != self.n_words:
+            raise ValueError(f"Frames have {frames.shape[1]} words, the layout has {self.n_words}.")
+        # Negative registers may have been stored as python ints, wrap them
+        frames = frames.astype("<u2", copy=False)
+
+        n_frames = frames.shape[0]
+        columns = {}
+        for dtype, (names, word_columns, scalars, offsets) in self.groups.items():
+            # Gather the words of each register next to each other so they can
+            # be viewed as the dtype
+            words = np.ascontiguousarray(frames[:, word_columns])
+            values = words.view(NUMPY_DTYPES[dtype]).reshape(n_frames, len(names))
+            values = values.astype(np.float64)
+            values *= scalars
+            values += offsets
+            np.round(values, 1, out=values)
+            for index, name in enumerate(names):
+                columns[name] = values[:, index]
+        return columns
+
+
+def decode_frames_loop(frames, reg_names: list, reg_scalars: list, reg_offsets: list, reg_dtypes: list) -> list:
+    """
+    Decodes frames one at a time as Edge_device.update_read() does, used as
+    the reference for the benchmark.
+    """
+    unpack_string = "<" + "".join(reg_dtypes)
+    scalars = np.array(reg_scalars)
+    offsets = np.array(reg_offsets)
+    results = []
+    for frame in frames:
+        raw_bytes = np.array(frame, dtype='<u2').tobytes()
+        values = np.array(struct.unpack(unpack_string, raw_bytes))
+        result = np.round((scalars * values) + offsets, 1).tolist()
+        results.append({
+            name: value for name, value in zip(reg_names, result) if not name.startswith(UNUSED_PREFIX)})
+    return results
+
+
+if __name__ == "__main__":
+    import os
+    from register_map_compiler import load_register_map
+
+    config_path = sys.argv[1] if len(sys.argv) > 1 else f"{os.path.dirname(__file__)}/../config/config_statcom_registers_new.toml"
+    # A day of 10 Hz reads
+    n_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 864000
+    n_loop_frames = min(n_frames, 20000)
+
+    plan = load_register_map(config_path).get_plan()
+    decoder = FrameDecoder.from_plan(plan)
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 65536, size=(n_frames, decoder.get_n_words()), dtype=np.uint16)
+
+    start = time.perf_counter()
+    columns = decoder.decode(frames)
+    batch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = decode_frames_loop(
+        frames[:n_loop_frames], plan["reg_names"], plan["reg_scalars"], plan["reg_offsets"], plan["reg_dtypes"])
+    loop_time = (time.perf_counter() - start) * n_frames / n_loop_frames
+
+    for index, readings in enumerate(reference):
+        for name, value in readings.items():
+            decoded = columns[name][index]
+            # Floats can differ in the last bit after rounding
+            assert decoded == value or abs(decoded - value) <= 1e-9 * abs(value), (name, index, decoded, value)
+
+    print(f"{config_path}: {n_frames} frames of {decoder.get_n_words()} words, {len(columns)} registers")
+    print(f"    batch decode: {batch_time:8.2f} s")
+    print(f"    loop decode:  {loop_time:8.2f} s (extrapolated from {n_loop_frames} frames)")
+    print(f"    speed up:     {loop_time / batch_time:8.1f}x")
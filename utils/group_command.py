@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+GroupCommandIssuer used to send one command to every device of a type, e.g.
+set_power to all statcoms, and collect the acknowledgements.
+
+The command is published once on the group command topic of the device type,
+so every device process receives it at the same time instead of one after
+another. It carries an execute_at time execute_lead seconds in the future and
+each device waits for it before executing, so the devices act together even if
+some receive the command later than others.
+
+Each device acknowledges on its group command ack topic with the time it
+received and executed the command. send() waits up to ack_timeout seconds for
+the expected devices and returns a report with the acknowledgements, the
+devices that did not answer and the spread (skew) of the execution times.
+
+Usage:
+    python group_command.py statcom set_power 100 --devices statcom_1 statcom_2
+"""
+import argparse
+import logging
+import os
+import time
+import toml
+import uuid
+from datetime import datetime, timezone
+
+import db_logger
+import redis_custom_library as redis_lib
+from pubsub_topic_encoder_decoder import PubSubTopicEncoderDecoder as psted
+from redis_message_structures import CommandMessage, RedisEncoderDecoder
+
+LOGGER_LEVEL = logging.INFO
+
+logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL)
+logger = logger_setup.get_logger()
+
+CONFIG_FILE = f'{os.path.dirname(__file__)}/../config/config_python_modules.toml'
+
+
+class GroupCommandIssuer():
+    def __init__(self, sender_program_name: str, redis_server=None) -> None:
+        config = toml.load(CONFIG_FILE)["group_commands"]
+        self.execute_lead = config["execute_lead"]
+        self.ack_timeout = config["ack_timeout"]
+
+        self.sender_program_name = sender_program_name
+        self._redis_server = redis_lib.connect_to_redis_server() if redis_server is None else redis_server
+
+    def send(
+        self,
+        device_type: str,
+        command_key_word: str,
+        settings: list,
+        expected_devices: list = None,
+        timeout: float = None,
+    ) -> dict:
+        """
+        Sends the command to every device of device_type and waits for the
+        acknowledgements. Without expected_devices it waits the whole timeout
+        and reports every device that answered.
+        """
+        timeout = self.ack_timeout if timeout is None else timeout
+        command_id = uuid.uuid4().hex
+
+        # Subscribe before sending so no acknowledgement is missed
+        subscriber = self._redis_server.pubsub(ignore_subscribe_messages=True)
+        subscriber.psubscribe(psted.get_group_command_ack_pattern(device_type))
+
+        time_sent = time.time()
+        command = CommandMessage(
+            sender_program_name=self.sender_program_name,
+            recipient_device_name=device_type,
+            command_key_word=command_key_word,
+            settings=settings,
+            datetime=datetime.now(tz=timezone.utc),
+            command_id=command_id,
+            execute_at=time_sent + self.execute_lead)
+        self._redis_server.publish(
+            psted.encode_group_command_topic(device_type),
+            RedisEncoderDecoder.encode_command(command))
+
+        acks = self.collect_acks(subscriber, command_id, expected_devices, time_sent + timeout)
+        subscriber.close()
+
+        report = self.get_report(command, time_sent, acks, expected_devices)
+        if report["missing"] or report["failed"]:
+            logger.warning(
+                f"GROUP COMMAND: '{command_key_word}' to '{device_type}' missing acks from {report['missing']}, "
+                f"failed on {report['failed']}.")
+        return report
+
+    def collect_acks(self, subscriber, command_id: str, expected_devices: list, deadline: float) -> dict:
+        acks = {}
+        while time.time() < deadline:
+            if expected_devices is not None and all([device in acks for device in expected_devices]):
+                break
+
+            message = subscriber.get_message(timeout=max(0, deadline - time.time()))
+            if message is None or message["type"] != "pmessage":
+                continue
+
+            ack = RedisEncoderDecoder.decode_json_with_date(redis_lib.get_data(message))
+            # Late acknowledgements of earlier group commands are ignored
+            if ack["command_id"] == command_id:
+                acks[ack["device_name"]] = ack
+        return acks
+
+    @staticmethod
+    def get_report(command: CommandMessage, time_sent: float, acks: dict, expected_devices: list) -> dict:
+        executed = [ack["time_executed"] for ack in acks.values()]
+        received = [ack["time_received"] for ack in acks.values()]
+        return {
+            "command_id": command.command_id,
+            "command_key_word": command.command_key_word,
+            "time_sent": time_sent,
+            "execute_at": command.execute_at,
+            "acks": acks,
+            "missing": [] if expected_devices is None else [device for device in expected_devices if device not in acks],
+            "failed": [device for device, ack in acks.items() if not ack["success"]],
+            "max_receive_latency": max(received) - time_sent if received else None,
+            "execution_skew": max(executed) - min(executed) if executed else None,
+            "max_duration": max([ack["duration"] for ack in acks.values()]) if acks else None,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("device_type", type=str, help="Device type to send the command to, e.g. statcom.")
+    parser.add_argument("command", type=str, help="Command key word, e.g. set_power.")
+    parser.add_argument("settings", type=str, nargs="*", help="Command settings.")
+    parser.add_argument(
+        "--devices",
+        required=False,
+        type=str,
+        nargs="*",
+        default=None,
+        help="Devices expected to acknowledge, e.g. statcom_1 statcom_2.",
+    )
+    parser.add_argument(
+        "--timeout",
+        required=False,
+        type=float,
+        default=None,
+        help="Seconds to wait for the acknowledgements.",
+    )
+    args = parser.parse_args()
+
+    issuer = GroupCommandIssuer(os.path.basename(__file__))
+    report = issuer.send(args.device_type, args.command, args.settings, args.devices, args.timeout)
+
+    for device, ack in sorted(report["acks"].items()):
+        print(f"{device:>16}: received {(ack['time_received'] - report['time_sent']) * 1000:7.1f} ms, "
+              f"executed {(ack['time_executed'] - report['execute_at']) * 1000:+7.1f} ms, "
+              f"took {ack['duration'] * 1000:7.1f} ms, success {ack['success']}")
+    if report["execution_skew"] is not None:
+        print(f"execution skew: {report['execution_skew'] * 1000:.1f} ms")
+    if report["missing"]:
+        print(f"missing: {', '.join(report['missing'])}")
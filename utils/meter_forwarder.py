@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+MeterForwarder used to turn a grid meter read into the Statcom meter register
+payload without allocating memory each cycle, so the forwarding loop doesn't
+trigger garbage collection pauses that delay the lifesign.
+
+The Statcom meter payload is 14 registers:
+    kVA_1..3, kW_1..3, export lifesign, kVA_1..3, kW_1..3, generation lifesign
+
+At construction the word index of each kVA/kW register in the meter's basic
+read frame is looked up once from the decode plan. Each cycle forward() copies
+those words from the raw frame into a preallocated uint16 buffer, which is
+viewed as the register dtypes, and scales, offsets and rounds them with in
+place ufuncs into a reusable float64 array. The values are truncated to
+integers, range checked against the Statcom's int16 meter registers and
+written, negative values as two's complement, into both halves of the
+preallocated payload together with the lifesigns. A value out of range raises
+ValueError, so the write is skipped rather than a wrapped power sent.
+
+The payload array is passed straight to Statcom.write_modbus(), so after the
+first cycle the forwarding itself allocates nothing. Reading the meter and the
+Modbus write still allocate inside pymodbus.
+
+Usage:
+    python meter_forwarder.py [cycles]    # allocation benchmark
+"""
+import gc
+import struct
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from register_map_compiler import DTYPE_WORDS
+from register_values import NUMPY_DTYPES
+
+# dtype of the Statcom meter registers the payload is written to
+PAYLOAD_DTYPE = "h"
+POWER_REGISTERS = ("kVA_1", "kVA_2", "kVA_3", "kW_1", "kW_2", "kW_3")
+PAYLOAD_SIZE = 2 * len(POWER_REGISTERS) + 2
+EXPORT_LIFESIGN_SLOT = len(POWER_REGISTERS)
+GENERATION_LIFESIGN_SLOT = PAYLOAD_SIZE - 1
+
+
+class MeterForwarder():
+    def __init__(
+        self,
+        write_address: int,
+        reg_names: list,
+        reg_scalars: list,
+        reg_offsets: list,
+        reg_dtypes: list,
+        read_blocks: list = None,
+    ) -> None:
+        self.read_blocks = read_blocks
+
+        word_indexes = {}
+        word_index = 0
+        for name, dtype in zip(reg_names, reg_dtypes):
+            word_indexes[name] = word_index
+            word_index += DTYPE_WORDS[dtype]
+
+        self.values = np.zeros(len(POWER_REGISTERS), dtype=np.float64)
+        # An array rather than a scalar operand, which numpy would allocate
+        # an array for on every call
+        self.tens = np.full(len(POWER_REGISTERS), 10.0)
+        self.integers = np.zeros(len(POWER_REGISTERS), dtype=np.int64)
+        limits = np.iinfo(NUMPY_DTYPES[PAYLOAD_DTYPE])
+        self.minimums = np.full(len(POWER_REGISTERS), float(limits.min))
+        self.maximums = np.full(len(POWER_REGISTERS), float(limits.max))
+        self.below_range = np.zeros(len(POWER_REGISTERS), dtype=bool)
+        self.above_range = np.zeros(len(POWER_REGISTERS), dtype=bool)
+        self.payload = np.zeros(PAYLOAD_SIZE, dtype=np.uint16)
+        self.export_slots = self.payload[:len(POWER_REGISTERS)]
+        self.generation_slots = self.payload[EXPORT_LIFESIGN_SLOT + 1:GENERATION_LIFESIGN_SLOT]
+        self.write_blocks = [[write_address, self.payload]]
+
+        # Registers of one dtype are decoded together through one word buffer:
+        # (words, typed view of the words, slice of values, scalars, offsets)
+        self.groups = []
+        # (words buffer, index in the buffer, index in the raw frame) of every
+        # word copied each cycle
+        self.word_copies = []
+        positions = []
+        for name in POWER_REGISTERS:
+            if name not in word_indexes:
+                raise ValueError(f"Satec register missing {name.split('_')[0]} value.")
+            positions.append(reg_names.index(name))
+
+        start = 0
+        while start < len(POWER_REGISTERS):
+            # Consecutive payload registers of the same dtype share a group
+            dtype = reg_dtypes[positions[start]]
+            end = start
+            while end < len(POWER_REGISTERS) and reg_dtypes[positions[end]] == dtype:
+                end += 1
+            words = DTYPE_WORDS[dtype]
+            word_buffer = np.zeros((end - start) * words, dtype="<u2")
+            for index in range(start, end):
+                for word in range(words):
+                    self.word_copies.append((
+                        word_buffer,
+                        (index - start) * words + word,
+                        word_indexes[POWER_REGISTERS[index]] + word))
+            self.groups.append((
+                word_buffer.view(NUMPY_DTYPES[dtype]),
+                self.values[start:end],
+                np.array([reg_scalars[positions[index]] for index in range(start, end)], dtype=np.float64),
+                np.array([reg_offsets[positions[index]] for index in range(start, end)], dtype=np.float64)))
+            start = end
+        self.word_copies = tuple(self.word_copies)
+        self.groups = tuple(self.groups)
+
+    @classmethod
+    def from_meter(cls, meter, write_address: int):
+        """
+        Returns the forwarder of a Meter's basic read.
+        """
+        return cls(write_address, *meter.get_register_details(), read_blocks=meter.get_read_blocks())
+
+    def get_read_blocks(self) -> list:
+        return self.read_blocks
+
+    def get_payload(self) -> np.ndarray:
+        return self.payload
+
+    def get_write_blocks(self) -> list:
+        """
+        Returns the register blocks for Statcom.write_modbus(), which always
+        hold the payload of the last forward().
+        """
+        return self.write_blocks
+
+    def forward(self, raw_regs, export_lifesign: int, generation_lifesign: int) -> np.ndarray:
+        """
+        Decodes the power registers of a raw meter frame into the payload and
+        sets the lifesigns. Returns the payload. Raises ValueError, leaving
+        the payload unchanged, if a value doesn't fit the Statcom registers.
+        """
+        # Indexed while loops, as a for loop allocates an iterator
+        index = 0
+        while index < len(self.word_copies):
+            word_buffer, buffer_index, frame_index = self.word_copies[index]
+            word_buffer[buffer_index] = raw_regs[frame_index]
+            index += 1
+
+        index = 0
+        while index < len(self.groups):
+            typed_words, values, scalars, offsets = self.groups[index]
+            # Casting in a separate copy avoids the ufunc's cast buffer
+            np.copyto(values, typed_words, casting="safe")
+            np.multiply(values, scalars, out=values)
+            np.add(values, offsets, out=values)
+            index += 1
+
+        # Round to 1 decimal as update_read() does, with the steps of
+        # np.round() but no temporary arrays, then truncate like int()
+        np.multiply(self.values, self.tens, out=self.values)
+        np.rint(self.values, out=self.values)
+        np.divide(self.values, self.tens, out=self.values)
+        np.trunc(self.values, out=self.values)
+
+        # Comparing into preallocated masks and checking them element by
+        # element, as min(), max(), any() and count_nonzero() allocate
+        np.less(self.values, self.minimums, out=self.below_range)
+        np.greater(self.values, self.maximums, out=self.above_range)
+        index = 0
+        while index < len(POWER_REGISTERS):
+            if self.below_range[index] or self.above_range[index]:
+                raise ValueError(f"Meter powers {self.get_readings()} out of range for the Statcom registers.")
+            index += 1
+
+        # In range, so the casts only reinterpret negative values as two's
+        # complement words
+        np.copyto(self.integers, self.values, casting="unsafe")
+        np.copyto(self.export_slots, self.integers, casting="unsafe")
+        np.copyto(self.generation_slots, self.integers, casting="unsafe")
+        self.payload[EXPORT_LIFESIGN_SLOT] = export_lifesign
+        self.payload[GENERATION_LIFESIGN_SLOT] = generation_lifesign
+        return self.payload
+
+    def get_readings(self) -> dict:
+        """
+        Returns the last forwarded power values by register name, for display.
+        """
+        return dict(zip(POWER_REGISTERS, self.values.tolist()))
+
+
+def forward_with_dicts(raw_regs, reg_names, reg_scalars, reg_offsets, reg_dtypes, export_lifesign, generation_lifesign) -> list:
+    """
+    Builds the payload the way Monitor._update() did, through the update_read()
+    dict and new lists, used as the reference for the benchmark.
+    """
+    raw_bytes = np.array(raw_regs, dtype='<u2').tobytes()
+    values = np.array(struct.unpack('<' + "".join(reg_dtypes), raw_bytes))
+    result = np.round((np.array(reg_scalars) * values) + np.array(reg_offsets), 1).tolist()
+    readings = dict(zip(reg_names, result))
+
+    kVA_meter = []
+    kW_meter = []
+    for ph in range(3):
+        val = int(readings[f"kVA_{ph+1}"])
+        kVA_meter += [val + 2**16 if val < 0 else val]
+        val = int(readings[f"kW_{ph+1}"])
+        kW_meter += [val + 2**16 if val < 0 else val]
+    return kVA_meter + kW_meter + [export_lifesign] + kVA_meter + kW_meter + [generation_lifesign]
+
+
+def measure(cycle, cycles: int) -> dict:
+    """
+    Runs cycle() and returns the garbage collections it triggered, the
+    memory still allocated afterwards and the most memory allocated during a
+    single cycle, less what the measurement itself allocates.
+    """
+    if cycle is not None:
+        baseline = measure(None, cycles)
+    else:
+        baseline = dict(retained_bytes=0, max_cycle_bytes=0)
+        cycle = lambda: None
+
+    start = time.perf_counter()
+    for _ in range(cycles):
+        cycle()
+    elapsed = time.perf_counter() - start
+
+    gc_counts = [stats["collections"] for stats in gc.get_stats()]
+    tracemalloc.start()
+    start_memory, _ = tracemalloc.get_traced_memory()
+    max_cycle_bytes = 0
+    for _ in range(cycles):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        cycle()
+        _, peak = tracemalloc.get_traced_memory()
+        max_cycle_bytes = max(max_cycle_bytes, peak - before)
+    end_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "cycle_time": elapsed / cycles,
+        "collections": sum([stats["collections"] for stats in gc.get_stats()]) - sum(gc_counts),
+        "retained_bytes": end_memory - start_memory - baseline["retained_bytes"],
+        "max_cycle_bytes": max_cycle_bytes - baseline["max_cycle_bytes"],
+    }
+
+
+if __name__ == "__main__":
+    import os
+    from register_map_compiler import load_register_map
+
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    plan = load_register_map(f"{os.path.dirname(__file__)}/../config/config_meter_satec_registers.toml").get_plan()
+    register_details = (plan["reg_names"], plan["reg_scalars"], plan["reg_offsets"], plan["reg_dtypes"])
+    forwarder = MeterForwarder(1109, *register_details)
+
+    # A frame of realistic values, including negative powers
+    rng = np.random.default_rng(0)
+    frame_values = [
+        float(rng.uniform(-5000, 5000)) if dtype in "fd" else int(rng.integers(0 if dtype.isupper() else -5000, 5000))
+        for dtype in plan["reg_dtypes"]]
+    raw_regs = np.frombuffer(struct.pack("<" + "".join(plan["reg_dtypes"]), *frame_values), dtype="<u2").tolist()
+
+    # The lifesign counters are left out, they are the caller's
+    def forward_cycle():
+        forwarder.forward(raw_regs, 1000, 2000)
+
+    def dict_cycle():
+        forward_with_dicts(raw_regs, *register_details, 1000, 2000)
+
+    expected = forward_with_dicts(raw_regs, *register_details, 7, 8)
+    assert forwarder.forward(raw_regs, 7, 8).tolist() == expected, (forwarder.get_payload().tolist(), expected)
+
+    print(f"{cycles} cycles, payload {forwarder.get_payload().tolist()}")
+    for name, cycle in [("dicts and lists", dict_cycle), ("MeterForwarder", forward_cycle)]:
+        result = measure(cycle, cycles)
+        print(
+            f"    {name:16s}: {result['cycle_time'] * 1e6:7.1f} us/cycle, "
+            f"{result['collections']:5d} gc collections, "
+            f"{result['max_cycle_bytes']:6d} bytes allocated per cycle, "
+            f"{result['retained_bytes']:6d} bytes retained")
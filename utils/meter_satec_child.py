@@ -4,11 +4,13 @@ import sys
 import os
 import logging
 import toml
-import time
+import threading
 
 import db_logger
 from edge_device import Edge_device
 from utils_custom import Utils
+from redis_message_structures import CommandMessage, RedisEncoderDecoder
+from waveform_capture import WaveformCapture, CAPTURE_FAILED_EVENT, WAVEFORM_SINK_DISK, decode_waveform
 
 # Use either real getmac library for raspios or temporary copied one for buildroot 
 import getmac
@@ -17,7 +19,7 @@ get_mac_address = Utils.get_mac_address
 
 LOGGER_LEVEL = logging.INFO
 
-logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL)
+logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL, queued=True)
 logger = logger_setup.get_logger()
 
 # import matplotlib.pyplot as plt
@@ -63,9 +65,11 @@ class Meter(Edge_device):
             module_name: str, 
             host: str, 
             port: int, 
-            unit_id: int):
+            unit_id: int,
+            transport: str = "tcp"):
         
-        self.config = toml.load(CONFIG_FILE)
+        self.register_map = self.load_register_map(CONFIG_FILE)
+        self.config = self.register_map.get_config()
         # print(f"METER MODULE NAME == {module_name}")
 
         super().__init__(
@@ -73,22 +77,32 @@ class Meter(Edge_device):
                 host=host, 
                 port=port, 
                 unit_id=unit_id, 
-                uses_modbus=True)
+                uses_modbus=True,
+                transport=transport)
         
         self.polarity = self.config["pretested_meter_polarities"][self.module_type]
 
+        config = toml.load(f'{os.path.dirname(__file__)}/../config/config_python_modules.toml')
+        if config["decode_pool"]["enabled"]:
+            self.enable_decode_pool(config)
+
+        self.waveform_capture = WaveformCapture(
+                device=self,
+                select_row_writes=reg_write_select_row,
+                read_row_blocks=reg_read_row,
+                begin_end_write=reg_write_begin_end,
+                channel_names=waveform_names,
+                channel_scalars=waveform_scalars)
+
         # self.state.update(device_id=self.get_device_id())
         # print("METER", module_name, self.get_polarity()) #TODO: ERROR
         logger.debug(f"EDGE DEVICE: meter={module_name}, polarity={self.get_polarity()}")
 
     def start(self):
         while True:
-            now = time.time()
             self.listen()
-            if now > self.get_time_last_heartbeat() + self.get_heartbeat_period():
-                self.send_heartbeat() #TODO: CONFIG
-                logger.debug(f"HEATBEAT: {self.get_heartbeat_topic()}")
-                self.set_time_last_heartbeat(now)
+            self.keep_alive()
+            self.step_waveform_capture()
             self.sleep()
 
 # TODO: could sample on the second, or could depend on config for frequency for each device
@@ -103,47 +117,39 @@ class Meter(Edge_device):
         device_id = raw_bytes.hex()
         return device_id
 
-# TODO: return the waveform based on a trigger
-    # def get_waveform(self):
-    #     raw_waveform_data = []
-
-    #     self.write_modbus([reg_write_begin_end])
-
-    #     for registers in reg_write_select_row:
-    #         self.write_modbus([registers])
-
-    #         row_data = self.read_modbus(reg_read_row)
-
-    #         raw_waveform_data.append(row_data)
+    def get_waveform(self):
+        """
+        Captures and returns a waveform in one go, blocking the poll loop until
+        it completes. Use trigger_waveform() to capture between polls.
+        """
+        self.waveform_capture.trigger(sinks=[])
+        waveform_data = None
+        while waveform_data is None:
+            waveform_data = self.waveform_capture.step()
 
-    #     self.write_modbus([reg_write_begin_end])
-
-    #     waveform_data = self.decode_waveform(raw_waveform_data)
-
-    #     return waveform_data
+        return waveform_data
 
+    def step_waveform_capture(self):
+        """
+        Runs one stage of a triggered waveform capture between polls. A failed
+        capture is abandoned rather than stopping the poll loop.
+        """
+        try:
+            self.waveform_capture.step()
+        except Exception as e:
+            logger.warning(f"EDGE DEVICE: {self.get_module_name()}: waveform capture failed: {e}")
+            self.waveform_capture.reset()
+            self.publish_event({"event": CAPTURE_FAILED_EVENT, "error": str(e)})
+
+    def trigger_waveform(self, sinks):
+        return self.waveform_capture.trigger(sinks)
 
     def decode_waveform(self, raw_waveform_data):
-        waveform_data = []
-
-        for idx, row in enumerate(raw_waveform_data):
-            channel_offset = row[27]
-            if channel_offset >= 32768:
-                channel_offset = channel_offset - 65536
-            channel_multiplier = row[28] + 65536 * row[29]
-            channel_divisor = row[30]
-
-            raw_data = row[33:]
-            raw_data = np.array(raw_data, dtype=np.int16)
-            raw_data = raw_data.astype(np.float)
-
-            data = (raw_data - channel_offset) * channel_multiplier / channel_divisor
-
-            data = data * waveform_scalars[idx]
-
-            waveform_data.append(data)
-
-        return waveform_data
+        """
+        Returns a (6, N) array with a row of scaled samples for each of the
+        waveform_names channels.
+        """
+        return decode_waveform(raw_waveform_data, waveform_scalars)
 
     def get_datetime_values(self):
         return ["time"]
@@ -151,9 +157,23 @@ class Meter(Edge_device):
     def get_config(self):
         return self.config
 
-    def handle_command(self, command):
-        print("meter_satec_child.handle_command(): Meters cannot receive commands currently. Ignoring command...") #TODO: ERROR
-        # Introduce logging once handle_command is coded
+    def get_register_map(self):
+        return self.register_map
+
+    def handle_command(self, command_data):
+        command_dict: CommandMessage = RedisEncoderDecoder.decode_command(command_data)
+        command = command_dict.command_key_word
+        settings = command_dict.settings
+
+        logger.debug(f"COMMAND RECIEVED: '{self.get_module_name()}' program receiving command '{command}'")
+
+        if command == "capture_waveform":
+            # settings lists where to stream the capture, "disk" and/or "redis"
+            sinks = settings if len(settings) > 0 else [WAVEFORM_SINK_DISK]
+            if not self.trigger_waveform(sinks):
+                logger.warning("COMMAND: Waveform capture already in progress.")
+        else:
+            logger.warning("COMMAND: Command not recognised.")
 
 
 if __name__ == "__main__":
@@ -161,11 +181,29 @@ if __name__ == "__main__":
     # argv[0] is name of this python program
     # argv[1] is name of this module in the system architecture (specific for each device)
 
-    module_name = sys.argv[1]
+    # argv[5] is the optional transport, "tcp" (default), "serial" or
+    # "gateway". For serial, host is the serial port and port the baud rate.
+    # Several meters on one daisy chain or gateway can share it by giving comma
+    # separated module names and unit ids, e.g.
+    # meter_grid_1,meter_load_1 /dev/ttyUSB0 19200 1,2 serial
+
+    module_names = sys.argv[1].split(",")
     host = sys.argv[2]
     port = int(sys.argv[3])
-    unit_id = int(sys.argv[4])
-
-    print("Connected to meter satec on host: " + host + " device_id: " + get_mac_address(ip=host)) #TODO: ERROR
-    meter_grid = Meter(module_name, host, port, unit_id)
-    meter_grid.start()
\ No newline at end of file
+    unit_ids = [int(unit_id) for unit_id in sys.argv[4].split(",")]
+    transport = sys.argv[5] if len(sys.argv) > 5 else "tcp"
+
+    if transport == "tcp":
+        print("Connected to meter satec on host: " + host + " device_id: " + get_mac_address(ip=host)) #TODO: ERROR
+        meter_grid = Meter(module_names[0], host, port, unit_ids[0])
+        meter_grid.start()
+    else:
+        # Meters on one port or gateway run as threads so they share its bus
+        # arbiter
+        print(f"Connected to meter satec on {transport}: {host}, unit ids: {unit_ids}") #TODO: ERROR
+        meters = [Meter(module_name, host, port, unit_id, transport) for module_name, unit_id in zip(module_names, unit_ids)]
+        threads = [threading.Thread(target=meter.start, daemon=True) for meter in meters]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
\ No newline at end of file
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+ModbusRtuSimulator used to test serial devices and the bus arbiter without
+hardware.
+
+The simulator opens a pseudo terminal pair and answers Modbus RTU requests on
+the master side for a set of unit ids, each with its own 65536 holding
+registers. The slave side is a serial port path (e.g. /dev/pts/5) that
+ModbusSerialClient can open like a real RS-485 adapter. Read holding
+registers (3) and write multiple registers (16) are supported, other function
+codes get an illegal function exception response and requests for unknown
+units are not answered, like on a real bus. Given a baudrate, each answer is
+delayed by the time the request and response would take on the wire.
+
+Usage:
+    python modbus_rtu_simulator.py --units 1 2 3               # serve until stopped
+    python modbus_rtu_simulator.py --units 1 2 3 --poll 10     # poll all units through
+                                                                 a SerialBusArbiter for
+                                                                 10 s and print the rates
+"""
+import argparse
+import os
+import struct
+import threading
+import time
+import tty
+
+import numpy as np
+
+READ_HOLDING_REGISTERS = 3
+WRITE_MULTIPLE_REGISTERS = 16
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+MAX_READ_COUNT = 125
+CHARACTER_BITS = 11
+
+
+def crc16(frame: bytes) -> int:
+    crc = 0xFFFF
+    for byte in frame:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+
+def add_crc(frame: bytes) -> bytes:
+    return frame + struct.pack("<H", crc16(frame))
+
+
+def check_crc(frame: bytes) -> bool:
+    return len(frame) >= 4 and struct.unpack("<H", frame[-2:])[0] == crc16(frame[:-2])
+
+
+class ModbusRtuSimulator():
+    def __init__(self, unit_ids: list, baudrate: int = None) -> None:
+        self.baudrate = baudrate
+        self.registers = {unit_id: np.zeros(65536, dtype=np.uint16) for unit_id in unit_ids}
+        self.requests = {unit_id: 0 for unit_id in unit_ids}
+
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+
+        self._buffer = b""
+        self._thread = None
+
+    def get_port(self) -> str:
+        return self.port
+
+    def set_registers(self, unit_id: int, address: int, values: list):
+        self.registers[unit_id][address:address + len(values)] = values
+
+    def get_registers(self, unit_id: int, address: int, count: int) -> list:
+        return self.registers[unit_id][address:address + count].tolist()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            self._buffer += os.read(self.master_fd, 256)
+            frame = self._next_frame()
+            while frame is not None:
+                response = self.handle_frame(frame)
+                if response is not None:
+                    if self.baudrate is not None:
+                        time.sleep((len(frame) + len(response)) * CHARACTER_BITS / self.baudrate)
+                    os.write(self.master_fd, response)
+                frame = self._next_frame()
+
+    def _get_frame_length(self):
+        if len(self._buffer) < 2:
+            return None
+        function_code = self._buffer[1]
+        if function_code == WRITE_MULTIPLE_REGISTERS:
+            if len(self._buffer) < 7:
+                return None
+            return 9 + self._buffer[6]
+        # Read requests and the unsupported requests we answer are 8 bytes
+        return 8
+
+    def _next_frame(self):
+        length = self._get_frame_length()
+        if length is None or len(self._buffer) < length:
+            return None
+
+        frame, self._buffer = self._buffer[:length], self._buffer[length:]
+        if not check_crc(frame):
+            # A real device ignores corrupt frames, drop anything buffered so
+            # the next request starts cleanly
+            self._buffer = b""
+            return None
+        return frame
+
+    def handle_frame(self, frame: bytes):
+        """
+        Returns the response to a request frame, or None if it isn't for one
+        of the simulated units.
+        """
+        unit_id, function_code = frame[0], frame[1]
+        if unit_id not in self.registers:
+            return None
+        self.requests[unit_id] += 1
+        registers = self.registers[unit_id]
+
+        if function_code == READ_HOLDING_REGISTERS:
+            address, count = struct.unpack(">HH", frame[2:6])
+            if count < 1 or count > MAX_READ_COUNT or address + count > len(registers):
+                return self.exception_response(unit_id, function_code, ILLEGAL_DATA_ADDRESS)
+            values = registers[address:address + count].astype(">u2").tobytes()
+            return add_crc(bytes([unit_id, function_code, len(values)]) + values)
+
+        if function_code == WRITE_MULTIPLE_REGISTERS:
+            address, count, byte_count = struct.unpack(">HHB", frame[2:7])
+            if byte_count != 2 * count or address + count > len(registers):
+                return self.exception_response(unit_id, function_code, ILLEGAL_DATA_ADDRESS)
+            registers[address:address + count] = np.frombuffer(frame[7:7 + byte_count], dtype=">u2")
+            return add_crc(frame[:6])
+
+        return self.exception_response(unit_id, function_code, ILLEGAL_FUNCTION)
+
+    @staticmethod
+    def exception_response(unit_id: int, function_code: int, exception_code: int) -> bytes:
+        return add_crc(bytes([unit_id, function_code | 0x80, exception_code]))
+
+
+def poll_units(port: str, baudrate: int, unit_ids: list, duration: float, count: int = 50):
+    """
+    Polls every unit from its own thread through one SerialBusArbiter, as
+    Edge_device instances sharing a daisy chain do, and returns the reads per
+    second achieved by each unit.
+    """
+    from bus_arbiter import SerialBusArbiter
+
+    arbiter = SerialBusArbiter(port, baudrate)
+    reads = {unit_id: 0 for unit_id in unit_ids}
+    deadline = time.time() + duration
+
+    def poll(unit_id):
+        client = arbiter.get_client(unit_id)
+        while time.time() < deadline:
+            with arbiter.batch(unit_id):
+                response = client.read_holding_registers(0, count)
+            if not response.isError():
+                reads[unit_id] += 1
+
+    threads = [threading.Thread(target=poll, args=(unit_id,)) for unit_id in unit_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {unit_id: count / duration for unit_id, count in reads.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--units", type=int, nargs="+", default=[1], help="Unit ids to simulate.")
+    parser.add_argument("--baudrate", type=int, default=19200, help="Simulated line speed.")
+    parser.add_argument(
+        "--poll",
+        required=False,
+        type=float,
+        default=None,
+        help="Poll every unit through a SerialBusArbiter for this many seconds and print the rates.",
+    )
+    args = parser.parse_args()
+
+    simulator = ModbusRtuSimulator(args.units, args.baudrate)
+    for unit_id in args.units:
+        simulator.set_registers(unit_id, 0, list(range(unit_id * 100, unit_id * 100 + 125)))
+    simulator.start()
+    print(f"Simulating units {args.units} on {simulator.get_port()} at {args.baudrate} baud.")
+
+    if args.poll is None:
+        while True:
+            time.sleep(1)
+    else:
+        for unit_id, rate in poll_units(simulator.get_port(), args.baudrate, args.units, args.poll).items():
+            print(f"unit {unit_id}: {rate:6.1f} reads/s")
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+PollRateController used to pick the highest sustainable poll rate for a device.
+
+Each completed read poll is recorded with the round trip time of its requests,
+normalised per request so polls of different numbers of register blocks are
+comparable. Writes are not recorded, their round trip times differ from those
+of reads. The controller keeps an exponentially weighted moving average of the round trip
+time and of the error rate and adjusts the poll frequency with an additive
+increase / multiplicative decrease (AIMD) scheme, the same approach TCP uses to
+find the capacity of a link:
+
+    - On a clean poll the frequency is increased by a small step, capped by the
+      rate the link can sustain at the target utilisation
+      (target_utilisation / (rtt * requests per poll)) and by the configured
+      maximum frequency.
+
+    - On an error, or when the round trip time rises well above the best round
+      trip time seen so far (the device or link is saturating and queueing
+      requests), the frequency is multiplied by the backoff factor.
+
+    - While the smoothed error rate is above max_error_rate the frequency is
+      held rather than increased.
+
+The frequency is always kept within the configured [min_frequency,
+max_frequency] bounds.
+"""
+
+RTT_SMOOTHING = 0.2
+ERROR_SMOOTHING = 0.1
+# The best round trip time slowly drifts up so one unusually fast poll cannot
+# make every later poll look saturated
+MIN_RTT_DRIFT = 0.01
+
+
+class PollRateController():
+    def __init__(
+        self,
+        min_frequency: float,
+        max_frequency: float,
+        initial_frequency: float = None,
+        target_utilisation: float = 0.7,
+        increase_step: float = 0.1,
+        backoff_factor: float = 0.5,
+        saturation_ratio: float = 3.0,
+        max_error_rate: float = 0.05,
+    ) -> None:
+        self.min_frequency = min_frequency
+        self.max_frequency = max_frequency
+        self.target_utilisation = target_utilisation
+        self.increase_step = increase_step
+        self.backoff_factor = backoff_factor
+        self.saturation_ratio = saturation_ratio
+        self.max_error_rate = max_error_rate
+
+        if initial_frequency is None:
+            initial_frequency = min_frequency
+        self.frequency = self._clamp(initial_frequency)
+
+        self.rtt = None
+        self.min_rtt = None
+        self.error_rate = 0.0
+        self.polls = 0
+        self.errors = 0
+
+    @staticmethod
+    def from_config(config: dict, module_type: str, initial_frequency: float = None):
+        """
+        Creates a controller from the config_python_modules.toml sections
+        "adaptive-polling", "adaptive-polling-min-frequency" and
+        "adaptive-polling-max-frequency" for the given device type.
+        """
+        parameters = config["adaptive-polling"]
+        return PollRateController(
+            min_frequency=config["adaptive-polling-min-frequency"][module_type],
+            max_frequency=config["adaptive-polling-max-frequency"][module_type],
+            initial_frequency=initial_frequency,
+            target_utilisation=parameters["target_utilisation"],
+            increase_step=parameters["increase_step"],
+            backoff_factor=parameters["backoff_factor"],
+            saturation_ratio=parameters["saturation_ratio"],
+            max_error_rate=parameters["max_error_rate"],
+        )
+
+    def _clamp(self, frequency):
+        return min(self.max_frequency, max(self.min_frequency, frequency))
+
+    def get_frequency(self):
+        return self.frequency
+
+    def get_period(self):
+        return 1 / self.frequency
+
+    def get_rtt(self):
+        return self.rtt
+
+    def get_error_rate(self):
+        return self.error_rate
+
+    def get_stats(self):
+        return {
+            "frequency": self.frequency,
+            "rtt": self.rtt,
+            "min_rtt": self.min_rtt,
+            "error_rate": self.error_rate,
+            "polls": self.polls,
+            "errors": self.errors,
+        }
+
+    def record(self, rtt: float, errors: int = 0, requests: int = 1):
+        """
+        Records a completed poll of requests requests that took rtt seconds
+        each on average and needed the given number of retries, then updates
+        the poll frequency.
+        """
+        self.polls += 1
+        self.errors += errors
+
+        error_sample = 1.0 if errors > 0 else 0.0
+        self.error_rate += ERROR_SMOOTHING * (error_sample - self.error_rate)
+
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += RTT_SMOOTHING * (rtt - self.rtt)
+
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        else:
+            self.min_rtt += MIN_RTT_DRIFT * (rtt - self.min_rtt)
+
+        saturated = self.rtt > self.min_rtt * self.saturation_ratio
+
+        if errors > 0 or saturated:
+            self.frequency = self._clamp(self.frequency * self.backoff_factor)
+        elif self.error_rate > self.max_error_rate:
+            # Recently unreliable, hold the current rate until errors decay
+            pass
+        else:
+            frequency = self.frequency + self.increase_step
+            if self.rtt > 0:
+                frequency = min(frequency, self.target_utilisation / (self.rtt * requests))
+            self.frequency = self._clamp(frequency)
+
+        return self.frequency
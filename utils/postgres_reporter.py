@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+PostgresReporter used to write the device readings published on redis into the
+timeseries tables of the database.
+
+Readings are received on the readings topic pattern, decoded and buffered per
+table. Every reporting_interval seconds each table's buffer is written in one
+bulk insert (COPY for Postgres, a multi-row insert for the SQLite stand-in).
+
+If the database can't be reached, or the buffer grows past
+max_buffered_rows before the next flush, the buffered readings are appended to
+a spool file per table on disk. The spool is written to the database before any
+new readings once the database is available again, streamed in batches of
+replay_batch_rows. The offset of the first unwritten line is saved next to the
+spool after each batch, so a failed or interrupted replay carries on from it.
+The spool is bounded by max_spool_bytes, beyond which new readings are dropped
+and counted.
+
+The database table for a reading is found from the device type and reading
+type, e.g. a "basic" reading from "meter_grid_1" goes into "meter_readings" and
+a "cell_voltage" reading from "battery_1" into
+"battery_cell_voltage_readings". Report by exception delta readings go into the
+same table as their full readings, with the device's last values carried
+forward into the fields the delta leaves out, so a row never has a missing
+value for a field that didn't change. Deltas received before a device's first
+full reading are dropped and counted. Reading fields that aren't columns of the
+table (e.g. the optional read timing fields) are left out.
+
+Usage:
+    python postgres_reporter.py              # write to the db_config database
+    python postgres_reporter.py --sqlite DB  # write to a SQLite file instead
+"""
+import argparse
+import csv
+import io
+import logging
+import os
+import sqlite3
+import time
+import toml
+
+import db_logger
+import redis_custom_library as redis_lib
+from pubsub_topic_encoder_decoder import PubSubTopicEncoderDecoder as psted
+from redis_message_structures import RedisEncoderDecoder
+from report_by_exception import decode_delta_reading_type, is_delta_reading_type
+
+# psycopg2 is only needed when writing to Postgres, the SQLite stand-in works
+# without it
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+LOGGER_LEVEL = logging.INFO
+
+logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL, queued=True)
+logger = logger_setup.get_logger()
+
+CONFIG_FILE = f'{os.path.dirname(__file__)}/../config/config_python_modules.toml'
+SPOOL_DIRECTORY = f'{os.path.dirname(__file__)}/../spool/postgres_reporter/'
+
+
+class PostgresConnection():
+    def __init__(self, db_config: dict) -> None:
+        if psycopg2 is None:
+            raise ImportError("psycopg2 is required to write readings to Postgres.")
+        self.connection = psycopg2.connect(
+            dbname=db_config["db_name"],
+            host=db_config["host"],
+            port=db_config["port"],
+            user=db_config["user"],
+            password=db_config["password"])
+
+    def insert_rows(self, table: str, columns: list, rows: list):
+        """
+        Bulk inserts the rows with COPY, streaming them as CSV.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([value.isoformat() if hasattr(value, "isoformat") else value for value in row])
+        buffer.seek(0)
+
+        column_list = ", ".join([f'"{column}"' for column in columns])
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.copy_expert(f'COPY "{table}" ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+
+    def get_columns(self, table: str):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = %s", (table,))
+            return set([row[0] for row in cursor.fetchall()])
+
+    def close(self):
+        self.connection.close()
+
+
+class SqliteConnection():
+    """
+    Local stand-in for the Postgres database. Tables and columns are created
+    as readings arrive.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.connection = sqlite3.connect(path)
+
+    def _ensure_table(self, table: str, columns: list):
+        cursor = self.connection.execute(f'PRAGMA table_info("{table}")')
+        existing_columns = [row[1] for row in cursor.fetchall()]
+        if not existing_columns:
+            column_list = ", ".join([f'"{column}"' for column in columns])
+            self.connection.execute(f'CREATE TABLE "{table}" ({column_list})')
+            return
+        for column in columns:
+            if column not in existing_columns:
+                self.connection.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}"')
+
+    def insert_rows(self, table: str, columns: list, rows: list):
+        """
+        Bulk inserts the rows with a single multi-row insert.
+        """
+        rows = [[value.isoformat() if hasattr(value, "isoformat") else value for value in row] for row in rows]
+        column_list = ", ".join([f'"{column}"' for column in columns])
+        placeholders = ", ".join(["?"] * len(columns))
+        try:
+            self._ensure_table(table, columns)
+            self.connection.executemany(
+                f'INSERT INTO "{table}" ({column_list}) VALUES ({placeholders})', rows)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+
+    def get_columns(self, table: str):
+        # Columns are added as readings arrive, so every field is kept
+        return None
+
+    def close(self):
+        self.connection.close()
+
+
+class PostgresReporter():
+    def __init__(self, connection_factory=None, spool_directory: str = SPOOL_DIRECTORY) -> None:
+        """
+        connection_factory is called with no arguments to (re)connect to the
+        database. It defaults to a PostgresConnection using db_config.
+        """
+        self.config = toml.load(CONFIG_FILE)
+        reporter_config = self.config["postgres_reporter"]
+        self.reporting_interval = reporter_config["reporting_interval"]
+        self.max_buffered_rows = reporter_config["max_buffered_rows"]
+        self.max_spool_bytes = reporter_config["max_spool_bytes"]
+        self.replay_batch_rows = reporter_config["replay_batch_rows"]
+        self.ignored_reading_types = reporter_config["ignored_reading_types"]
+        self.tables = self.config["timeseries_tables"]["tables"]
+
+        if connection_factory is None:
+            db_config = self.config["db_config"]
+            connection_factory = lambda: PostgresConnection(db_config)
+        self.connection_factory = connection_factory
+        self.connection = None
+
+        self.spool_directory = spool_directory
+        os.makedirs(self.spool_directory, exist_ok=True)
+
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.rows_written = 0
+        self.rows_spooled = 0
+        self.rows_dropped = 0
+        self.deltas_dropped = 0
+        self.time_last_flush = time.time()
+        # (device name, reading type) -> last values of the device's readings
+        self.last_values = {}
+
+        self._table_lookup = {}
+        # table -> set of its columns, or None if any field can be inserted
+        self._table_columns = {}
+        # (table, field) of the fields left out, logged once each
+        self.dropped_fields = set()
+
+    # getters for reporting
+    def get_stats(self):
+        return {
+            "buffered_rows": self.buffered_rows,
+            "rows_written": self.rows_written,
+            "rows_spooled": self.rows_spooled,
+            "rows_dropped": self.rows_dropped,
+            "deltas_dropped": self.deltas_dropped,
+            "spool_bytes": self.get_spool_bytes(),
+        }
+
+    def get_table(self, device_name: str, reading_type: str):
+        """
+        Returns the timeseries table for a reading, or None if there is no
+        table for it.
+        """
+        key = (device_name, reading_type)
+        if key not in self._table_lookup:
+            reading_type = decode_delta_reading_type(reading_type)
+            device_type = device_name.rsplit("_", 1)[0]
+            self._table_lookup[key] = self._find_table(device_type, reading_type)
+        return self._table_lookup[key]
+
+    def _find_table(self, device_type: str, reading_type: str):
+        # Try the most specific name first, then drop trailing parts of the
+        # device type, e.g. meter_grid -> meter
+        device_parts = device_type.split("_")
+        for length in range(len(device_parts), 0, -1):
+            prefix = "_".join(device_parts[:length])
+            for table in [f"{prefix}_{reading_type}_readings", f"{prefix}_readings"]:
+                if table in self.tables:
+                    return table
+        return None
+
+    def handle_reading_message(self, message):
+        topic = psted.decode_readings_topic(redis_lib.get_channel(message))
+        if topic["reading_type"] in self.ignored_reading_types:
+            return
+
+        table = self.get_table(topic["device_name"], topic["reading_type"])
+        if table is None:
+            return
+
+        reading = self.fill_reading(
+            topic["device_name"],
+            topic["reading_type"],
+            RedisEncoderDecoder.decode_reading(redis_lib.get_data(message)))
+        if reading is not None:
+            self.add_reading(table, reading)
+
+    def fill_reading(self, device_name: str, reading_type: str, reading: dict):
+        """
+        Returns a report by exception delta reading with the device's last
+        values filled in, or None if the device has no full reading yet.
+        Full readings are returned as they are.
+        """
+        key = (device_name, decode_delta_reading_type(reading_type))
+        if is_delta_reading_type(reading_type):
+            if key not in self.last_values:
+                self.deltas_dropped += 1
+                return None
+            reading = dict(self.last_values[key], **reading)
+        self.last_values[key] = reading
+        return reading
+
+    def add_reading(self, table: str, reading: dict):
+        self.buffers.setdefault(table, []).append(reading)
+        self.buffered_rows += 1
+
+        # Backpressure: rather than holding an unbounded buffer in memory while
+        # the database is slow, move the buffer to the disk spool
+        if self.buffered_rows >= self.max_buffered_rows:
+            logger.warning(f"POSTGRES REPORTER: {self.buffered_rows} rows buffered, spooling to disk.")
+            self.spool_buffers()
+
+    # Spool
+    def get_spool_path(self, table: str):
+        return f"{self.spool_directory}{table}.jsonl"
+
+    def get_spool_offset_path(self, table: str):
+        return f"{self.spool_directory}{table}.offset"
+
+    def get_spooled_tables(self):
+        return [file_name[:-len(".jsonl")] for file_name in os.listdir(self.spool_directory) if file_name.endswith(".jsonl")]
+
+    def get_spool_bytes(self):
+        return sum([os.path.getsize(self.get_spool_path(table)) for table in self.get_spooled_tables()])
+
+    def get_spool_offset(self, table: str):
+        offset_path = self.get_spool_offset_path(table)
+        if not os.path.isfile(offset_path):
+            return 0
+        with open(offset_path) as offset_file:
+            return int(offset_file.read() or 0)
+
+    def save_spool_offset(self, table: str, offset: int):
+        offset_path = self.get_spool_offset_path(table)
+        with open(offset_path + ".tmp", "w") as offset_file:
+            offset_file.write(str(offset))
+        os.replace(offset_path + ".tmp", offset_path)
+
+    def remove_spool(self, table: str):
+        os.remove(self.get_spool_path(table))
+        if os.path.isfile(self.get_spool_offset_path(table)):
+            os.remove(self.get_spool_offset_path(table))
+
+    def spool_buffers(self):
+        for table, readings in self.buffers.items():
+            self.spool_readings(table, readings)
+
+        if self.rows_dropped > 0:
+            logger.warning(f"POSTGRES REPORTER: spool full, {self.rows_dropped} row(s) dropped in total.")
+        self.clear_buffers()
+
+    def spool_readings(self, table: str, readings: list):
+        spool_bytes = self.get_spool_bytes()
+        with open(self.get_spool_path(table), "ab") as spool:
+            for reading in readings:
+                line = (RedisEncoderDecoder.encode_reading(reading) + "\n").encode("utf-8")
+                if spool_bytes + len(line) > self.max_spool_bytes:
+                    self.rows_dropped += 1
+                    continue
+                spool.write(line)
+                spool_bytes += len(line)
+                self.rows_spooled += 1
+
+    def clear_buffers(self):
+        self.buffers = {}
+        self.buffered_rows = 0
+
+    def replay_spool(self, table: str):
+        """
+        Writes the spooled readings for a table to the database in batches,
+        from the saved offset. If a batch fails, the offset is kept at the
+        batch, or moved past it if part of it was written, with the unwritten
+        rows of the batch spooled again at the end.
+        """
+        spool_path = self.get_spool_path(table)
+        if not os.path.isfile(spool_path):
+            return
+
+        written = 0
+        with open(spool_path, "rb") as spool:
+            spool.seek(self.get_spool_offset(table))
+            while True:
+                lines = []
+                while len(lines) < self.replay_batch_rows:
+                    line = spool.readline()
+                    if not line:
+                        break
+                    lines.append(line)
+                if not lines:
+                    break
+
+                batch = [RedisEncoderDecoder.decode_reading(line.decode("utf-8")) for line in lines]
+                try:
+                    self.write_readings(table, batch)
+                except Exception:
+                    if len(batch) < len(lines):
+                        self.spool_readings(table, batch)
+                        self.save_spool_offset(table, spool.tell())
+                    logger.info(f"POSTGRES REPORTER: wrote {written + len(lines) - len(batch)} spooled row(s) to '{table}'.")
+                    raise
+                written += len(lines)
+                self.save_spool_offset(table, spool.tell())
+
+        self.remove_spool(table)
+        logger.info(f"POSTGRES REPORTER: wrote {written} spooled row(s) to '{table}'.")
+
+    # Database
+    def connect(self):
+        if self.connection is None:
+            self.connection = self.connection_factory()
+        return self.connection
+
+    def get_table_columns(self, table: str):
+        if table not in self._table_columns:
+            self._table_columns[table] = self.connect().get_columns(table)
+        return self._table_columns[table]
+
+    def disconnect(self):
+        self._table_columns = {}
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+
+    def write_readings(self, table: str, readings: list):
+        """
+        Writes readings to a table, one insert per set of fields: delta
+        readings only carry the fields that changed. If an insert fails, the
+        readings of the inserts that succeeded are removed from readings, so
+        only the unwritten ones are spooled, and the error is re-raised.
+        """
+        columns = self.get_table_columns(table)
+        groups = {}
+        for index, reading in enumerate(readings):
+            if columns is not None:
+                dropped_fields = [key for key in reading if key not in columns and (table, key) not in self.dropped_fields]
+                if dropped_fields:
+                    self.dropped_fields.update([(table, key) for key in dropped_fields])
+                    logger.info(f"POSTGRES REPORTER: '{table}' has no column for field(s) {dropped_fields}, leaving them out.")
+                reading = {key: value for key, value in reading.items() if key in columns}
+            groups.setdefault(tuple(reading.keys()), []).append((index, reading))
+
+        written = set()
+        try:
+            for columns, rows in groups.items():
+                self.connect().insert_rows(table, list(columns), [list(row.values()) for _, row in rows])
+                self.rows_written += len(rows)
+                written.update([index for index, _ in rows])
+        except Exception:
+            readings[:] = [reading for index, reading in enumerate(readings) if index not in written]
+            raise
+
+    def flush(self):
+        self.time_last_flush = time.time()
+        try:
+            for table in self.get_spooled_tables():
+                self.replay_spool(table)
+            for table, readings in list(self.buffers.items()):
+                self.write_readings(table, readings)
+                del self.buffers[table]
+                self.buffered_rows -= len(readings)
+        except Exception as e:
+            logger.warning(f"POSTGRES REPORTER: failed to write readings, spooling to disk: {e}")
+            self.disconnect()
+            self.spool_buffers()
+
+    def start(self):
+        redis_server = redis_lib.connect_to_redis_server()
+        subscriber = redis_server.pubsub(ignore_subscribe_messages=True)
+        subscriber.psubscribe(psted.get_readings_topic_pattern())
+
+        while True:
+            timeout = max(0, self.time_last_flush + self.reporting_interval - time.time())
+            message = subscriber.get_message(timeout=timeout)
+            if message is not None and message["type"] == "pmessage":
+                try:
+                    self.handle_reading_message(message)
+                except Exception as e:
+                    logger.warning(f"POSTGRES REPORTER: failed to decode reading: {e}")
+
+            if time.time() >= self.time_last_flush + self.reporting_interval:
+                self.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sqlite",
+        required=False,
+        type=str,
+        default=None,
+        help="Write readings to this SQLite file instead of Postgres.",
+    )
+    args = parser.parse_args()
+
+    if args.sqlite is None:
+        reporter = PostgresReporter()
+    else:
+        reporter = PostgresReporter(connection_factory=lambda: SqliteConnection(args.sqlite))
+    reporter.start()
@@ -4,19 +4,35 @@ Contains encoders and decoders for the pubsub topic using naming conventions
 suggested by both google cloud and hivemq 
 https://cloud.google.com/pubsub/docs/admin
 https://www.hivemq.com/blog/mqtt-essentials-part-5-mqtt-topics-best-practices/
+
+Devices publish on the same few topics for their whole life, so the encoders
+cache and intern the topic strings they build and the decoders cache the split
+of each topic they parse. The decoders return a new dict on each call so the
+cached values can't be changed by the caller.
 """
+import sys
+from functools import lru_cache
+
+TOPIC_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=TOPIC_CACHE_SIZE)
+def _split_topic(topic: str) -> tuple:
+    return tuple(topic.split("/"))
+
 
 class PubSubTopicEncoderDecoder():
     def __init__(self) -> None:
         pass
 
     @staticmethod
+    @lru_cache(maxsize=TOPIC_CACHE_SIZE)
     def encode_command_topic(device_name, device_num):
-        return f"device/{device_name}/{device_num}/command"
+        return sys.intern(f"device/{device_name}/{device_num}/command")
 
     @staticmethod
     def decode_command_topic(topic):
-        topic = topic.split("/")
+        topic = _split_topic(topic)
         device_name = topic[1]
         device_num  = topic[2]
         return {
@@ -25,12 +41,13 @@ class PubSubTopicEncoderDecoder():
         }
 
     @staticmethod
+    @lru_cache(maxsize=TOPIC_CACHE_SIZE)
     def encode_group_command_topic(device_type):
-        return f"device/{device_type}/group_command"
+        return sys.intern(f"device/{device_type}/group_command")
 
     @staticmethod
     def decode_group_command_topic(topic):
-        topic = topic.split("/")
+        topic = _split_topic(topic)
         device_name = topic[1]
         return {
             "device_name": device_name
@@ -39,6 +56,25 @@ class PubSubTopicEncoderDecoder():
     @staticmethod
     def get_group_command_pattern():
         return "device/*/group_command"
+
+    @staticmethod
+    @lru_cache(maxsize=TOPIC_CACHE_SIZE)
+    def encode_group_command_ack_topic(device_type, device_name):
+        return sys.intern(f"device/{device_type}/group_command_ack/{device_name}")
+
+    @staticmethod
+    def decode_group_command_ack_topic(topic):
+        topic = _split_topic(topic)
+        device_type = topic[1]
+        device_name = topic[3]
+        return {
+            "device_type": device_type,
+            "device_name": device_name
+        }
+
+    @staticmethod
+    def get_group_command_ack_pattern(device_type):
+        return f"device/{device_type}/group_command_ack/*"
         
     @staticmethod
     def encode_user_command_topic() -> str:
@@ -49,12 +85,13 @@ class PubSubTopicEncoderDecoder():
         raise NotImplementedError
 
     @staticmethod
+    @lru_cache(maxsize=TOPIC_CACHE_SIZE)
     def encode_readings_topic(
         device_name: str, 
         device_num: int, 
         reading_type: str
     ) -> str:
-        return f"device/{device_name}/{device_num}/readings/{reading_type}"
+        return sys.intern(f"device/{device_name}/{device_num}/readings/{reading_type}")
     
     @staticmethod
     def get_readings_topic_pattern() -> str:
@@ -63,7 +100,7 @@ class PubSubTopicEncoderDecoder():
     @staticmethod
     def decode_readings_topic(topic):
         # print(topic)
-        topic = topic.split("/")
+        topic = _split_topic(topic)
         device_name = topic[1]
         device_num = topic[2]
         try:
@@ -86,12 +123,17 @@ class PubSubTopicEncoderDecoder():
         raise NotImplementedError
 
     @staticmethod
+    @lru_cache(maxsize=TOPIC_CACHE_SIZE)
     def encode_heartbeat(module_name, module_num=None):
-        return f"heartbeat/{module_name}/{module_num}"
+        return sys.intern(f"heartbeat/{module_name}/{module_num}")
+
+    @staticmethod
+    def get_heartbeat_pattern():
+        return "heartbeat/*/*"
 
     @staticmethod
     def decode_heartbeat(topic):
-        topic = topic.split("/")
+        topic = _split_topic(topic)
         module_name = topic[1]
         module_num = topic[2]
         return {
@@ -100,16 +142,35 @@ class PubSubTopicEncoderDecoder():
         }
 
     @staticmethod
+    @lru_cache(maxsize=TOPIC_CACHE_SIZE)
     def encode_error_topic(module):
-        return f"device/{module}/errors"
+        return sys.intern(f"device/{module}/errors")
 
     @staticmethod
     def decode_error_topic(topic):
-        topic = topic.split("/")
+        topic = _split_topic(topic)
         module_name = topic[1]
         return {
             'module_name': module_name
         }
+
+    @staticmethod
+    @lru_cache(maxsize=TOPIC_CACHE_SIZE)
+    def encode_event_topic(module):
+        return sys.intern(f"device/{module}/events")
+
+    @staticmethod
+    def get_event_topic_pattern():
+        return "device/*/events"
+
+    @staticmethod
+    @lru_cache(maxsize=TOPIC_CACHE_SIZE)
+    def encode_metrics_topic(module):
+        return sys.intern(f"device/{module}/metrics")
+
+    @staticmethod
+    def get_metrics_topic_pattern():
+        return "device/*/metrics"
         
     @staticmethod
     def encode_power_command_topic():
@@ -129,6 +190,10 @@ class PubSubTopicEncoderDecoder():
     def encode_system_status_topic():
         return "system_status"
 
+    @staticmethod
+    def encode_subprocess_log_topic():
+        return "system_status/subprocess_log"
+
     # SiteStateStorage channels
     
     @staticmethod
@@ -148,7 +213,7 @@ class PubSubTopicEncoderDecoder():
     
     @staticmethod
     def decode_state_query_topic(topic: str) -> dict:
-        topic_info: list = topic.split('/')
+        topic_info: tuple = _split_topic(topic)
         sender_program: str = topic_info[2]
         return {"sender_program": sender_program}
     
@@ -157,12 +222,13 @@ class PubSubTopicEncoderDecoder():
         return "state/query/*"
     
     @staticmethod
+    @lru_cache(maxsize=TOPIC_CACHE_SIZE)
     def encode_state_answer_topic(receiving_program: str) -> str:
-        return f"state/answer/{receiving_program}"
+        return sys.intern(f"state/answer/{receiving_program}")
 
     @staticmethod
     def decode_state_answer_topic(topic: str) -> dict:
-        topic_info: list = topic.split('/')
+        topic_info: tuple = _split_topic(topic)
         sender_program: str = topic_info[2]
         return {"sender_program": sender_program}
 
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+ReadingSpool used to store encoded readings on disk while redis is unavailable
+and forward them once it is back.
+
+Messages are appended as JSON lines ({"topic": ..., "data": ...}) to numbered
+segment files in the spool directory. A new segment is started once the
+current one reaches segment_bytes. When the spool grows past max_bytes the
+oldest segment is deleted, so disk usage stays bounded and the newest readings
+are kept.
+
+drain() sends the oldest messages first and removes each segment once all of
+its messages have been sent. Delivery is at least once: if the process stops
+part way through a segment the remaining messages of that segment, including
+some already sent, are sent again on the next start.
+
+All methods are thread safe so the device loop can append while a background
+thread drains. drain() only holds the lock to read a batch of messages and to
+record how far it got, never while sending, so a hung send can't block the
+device loop's append().
+"""
+import json
+import os
+import threading
+
+SEGMENT_SUFFIX = ".jsonl"
+
+
+class ReadingSpool():
+    def __init__(self, directory: str, max_bytes: int, segment_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.dropped_segments = 0
+
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._segments = sorted([
+            int(file_name[:-len(SEGMENT_SUFFIX)])
+            for file_name in os.listdir(self.directory)
+            if file_name.endswith(SEGMENT_SUFFIX)])
+        self._bytes = sum([os.path.getsize(self._get_segment_path(segment)) for segment in self._segments])
+        self._read_offset = 0
+
+    def _get_segment_path(self, segment: int):
+        return f"{self.directory}{segment:010d}{SEGMENT_SUFFIX}"
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._bytes == 0
+
+    def get_bytes(self) -> int:
+        return self._bytes
+
+    def get_dropped_segments(self) -> int:
+        return self.dropped_segments
+
+    def append(self, topic: str, data: str):
+        line = (json.dumps({"topic": topic, "data": data}) + "\n").encode("utf-8")
+
+        with self._lock:
+            if not self._segments or os.path.getsize(self._get_segment_path(self._segments[-1])) >= self.segment_bytes:
+                self._segments.append(self._segments[-1] + 1 if self._segments else 0)
+
+            with open(self._get_segment_path(self._segments[-1]), "ab") as segment:
+                segment.write(line)
+            self._bytes += len(line)
+
+            # Keep the newest readings when the spool is full
+            while self._bytes > self.max_bytes and len(self._segments) > 1:
+                self._remove_segment(self._segments[0])
+                self._read_offset = 0
+                self.dropped_segments += 1
+
+    def _remove_segment(self, segment: int):
+        path = self._get_segment_path(segment)
+        self._bytes -= os.path.getsize(path)
+        os.remove(path)
+        self._segments.remove(segment)
+
+    def drain(self, send, max_messages: int) -> int:
+        """
+        Calls send(topic, data) for up to max_messages of the oldest spooled
+        messages. Stops at the first message send raises for, which is kept
+        for the next drain, and re-raises. Returns the number of messages sent.
+        Only one thread may drain at a time.
+        """
+        sent = 0
+        while sent < max_messages:
+            with self._lock:
+                if not self._segments:
+                    break
+                segment = self._segments[0]
+                batch = self._read_batch(segment, max_messages - sent)
+                if not batch:
+                    # Every message of the segment has been sent
+                    self._remove_segment(segment)
+                    self._read_offset = 0
+                    continue
+
+            offset = None
+            try:
+                for message, message_end in batch:
+                    send(message["topic"], message["data"])
+                    offset = message_end
+                    sent += 1
+            finally:
+                # Unsent messages stay in the spool. The segment may have been
+                # dropped by append() while sending.
+                with self._lock:
+                    if offset is not None and self._segments and self._segments[0] == segment:
+                        self._read_offset = offset
+        return sent
+
+    def _read_batch(self, segment: int, max_messages: int) -> list:
+        """
+        Returns up to max_messages (message, offset after it) of a segment
+        from the read offset. Called with the lock held.
+        """
+        batch = []
+        with open(self._get_segment_path(segment), "rb") as segment_file:
+            segment_file.seek(self._read_offset)
+            while len(batch) < max_messages:
+                line = segment_file.readline()
+                if not line:
+                    break
+                batch.append((json.loads(line), segment_file.tell()))
+        return batch
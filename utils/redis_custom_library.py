@@ -39,6 +39,16 @@ def connect_to_redis_server() -> redis.Redis:
             sys.exit(1)
             
             
+def connect_to_running_redis_server() -> redis.Redis:
+    """ Returns a connection to the redis server, raising 
+    redis.exceptions.ConnectionError if it is not running rather than trying 
+    to start it. 
+    """
+    r = redis.Redis(host=IP_ADDRESS, port=REDIS_SERVER_PORT, db=REDIS_SERVER_DB)
+    r.ping()
+    return r
+            
+            
 def get_next_message(subscriber, blocking: bool=False) -> dict:
     """ Returns the next message in the subscribers queue. None if there is no 
     meessage 
@@ -58,6 +68,11 @@ def get_next_message(subscriber, blocking: bool=False) -> dict:
 def get_current_message(subscriber, blocking: bool=False) -> dict:
     """ Returns the next message in the queue that has a timestamp >= time 
     when this method was called. 
+
+    Controllers that need the current readings of several devices should use
+    time_aligned_join.TimeAlignedJoin instead: drain() the subscriber each
+    cycle and read the aligned values with get_vector(), rather than sleeping
+    and JSON parsing every message here.
     """
     # message = subscriber.get_message()
     # if message is None or message["pattern"] is None:
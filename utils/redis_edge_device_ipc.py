@@ -7,26 +7,34 @@ import numpy as np
 import toml
 from pubsub_topic_encoder_decoder import PubSubTopicEncoderDecoder as psted
 from redis_message_structures import RedisEncoderDecoder
+from topic_router import TopicRouter
 
 DATE_TIME_STRING = "%m/%d/%Y %H:%M:%S:%f"
 CONFIG_FILE = f'{os.path.dirname(__file__)}/../config/config_python_modules.toml'
 
 class Redis_edge_device_ipc():
-    def __init__(self, device_name, device_id):
+    def __init__(self, device_name, device_id, device_type=None):
         self.config = toml.load(CONFIG_FILE)
-        self._redis_server = redis_lib.connect_to_redis_server()
+        # Fail straight away if redis is down so the device can spool readings
+        self._redis_server = redis_lib.connect_to_running_redis_server()
         
         # Create subscriber and subscribe to requred channels
         self.subscriber = self._redis_server.pubsub()
         self.subscriber.psubscribe('error-master')
         # self.subscriber.psubscribe('trigger-reporting')
-        # self.subscriber.psubscribe('group-command')
+
+        # Group commands are sent once for every device of a type
+        self.group_command_channel = None
+        if device_type is not None:
+            self.group_command_channel = psted.encode_group_command_topic(device_type)
+            self.subscriber.psubscribe(self.group_command_channel)
 
         # self.command_channel = 'command-' + device_name
         self.command_channel = psted.encode_command_topic(device_name, device_id)
         self.subscriber.psubscribe(self.command_channel)
         print("\'" + device_name + "\' program is receiving commands on channel: \'" + self.command_channel + "\'")  #TODO: ERROR
         self.reporting_frequency = self.config["ipc-parameters"]["reporting_frequency"]
+        self.router = None
 
 
     def publish_data(self, device_name, device_num, reading_type, data, date_time_keys):
@@ -41,30 +49,43 @@ class Redis_edge_device_ipc():
         # data_json = json.dumps(data, indent = 4)
         # print(f"Publishing to {topic}")
         # device_name = f"{device_type}_{device_num}"
-        data_json = RedisEncoderDecoder.encode_reading(data)
-        readings_topic = psted.encode_readings_topic(device_name, device_num, reading_type)
+        readings_topic, data_json = Redis_edge_device_ipc.encode_data(device_name, device_num, reading_type, data)
         # print(f"reading type msg sent === {reading_type}")
         self.send_message(readings_topic, data_json)
         # self._redis_server.publish(readings_topic, data_json)
 
+    @staticmethod
+    def encode_data(device_name, device_num, reading_type, data):
+        """
+        Returns the readings topic and the encoded reading without sending it.
+        """
+        data_json = RedisEncoderDecoder.encode_reading(data)
+        readings_topic = psted.encode_readings_topic(device_name, device_num, reading_type)
+        return readings_topic, data_json
+
 
-    def listen(self, handle_command, log_reading, handle_error, set_sleep_time):
+    def get_router(self, handle_command, handle_error, handle_group_command=None) -> TopicRouter:
+        """
+        Returns the router for the subscribed channels, built on the first
+        call as the handlers are the same for the life of the device.
+        """
+        if self.router is None:
+            self.router = TopicRouter()
+            # If message from 'error-master' channel then handle the error
+            self.router.add_route('error-master', lambda channel, data: handle_error(data))
+            # Handle commands sent through the command channel
+            self.router.add_route(self.command_channel, lambda channel, data: handle_command(data))
+            if self.group_command_channel is not None:
+                group_handler = handle_command if handle_group_command is None else handle_group_command
+                self.router.add_route(self.group_command_channel, lambda channel, data: group_handler(data))
+        return self.router
+
+    def listen(self, handle_command, log_reading, handle_error, set_sleep_time, handle_group_command=None):
+        router = self.get_router(handle_command, handle_error, handle_group_command)
         message = self.subscriber.get_message()
         
         while message != None:
-            
-            if redis_lib.get_pattern(message) is not None:
-
-                channel = redis_lib.get_channel(message)
-                
-                # If message from 'error-master' channel then handle the error
-                if channel == 'error-master':
-                    handle_error(redis_lib.get_data(message))
-
-                # Handle commands sent through the command channel
-                elif channel == self.command_channel:
-                    handle_command(redis_lib.get_data(message))
-            
+            router.dispatch(message)
             message = self.subscriber.get_message()
             #TODO: add an emergency heart beat, incase taking ages
             
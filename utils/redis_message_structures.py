@@ -1,7 +1,101 @@
 #!/usr/bin/env python3
+"""
+Message structures and the encoders and decoders used for messages sent over
+redis.
+
+All messages are encoded through a codec backend, chosen with
+RedisEncoderDecoder.set_codec():
+    "json"    - stdlib json, always available and the default
+    "orjson"  - orjson, a faster JSON library. Opt-in, as its output differs
+                from json: compact separators, NaN encoded as null, and
+                numpy scalars or non-str keys raise TypeError
+    "msgpack" - msgpack binary encoding. Not wire compatible with the JSON 
+                backends so only for links where both ends use it
+Datetimes are encoded as isoformat strings by every backend in the same pass as
+the rest of the message.
+
+Run this module to benchmark the encode + decode throughput of each available
+backend for a 90 field reading.
+"""
 import json
+import time
 from datetime import datetime, timezone
 
+# Optional faster codec backends
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _encode_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+class JsonCodec():
+    name = "json"
+
+    @staticmethod
+    def dumps(data) -> str:
+        return json.dumps(data, default=_encode_default)
+
+    @staticmethod
+    def loads(encoded_data):
+        return json.loads(encoded_data)
+
+
+class OrjsonCodec():
+    name = "orjson"
+
+    @staticmethod
+    def dumps(data) -> str:
+        # orjson returns bytes, decode so callers always get a str like json
+        return orjson.dumps(data, default=_encode_default).decode("utf-8")
+
+    @staticmethod
+    def loads(encoded_data):
+        return orjson.loads(encoded_data)
+
+
+class MsgpackCodec():
+    name = "msgpack"
+
+    @staticmethod
+    def dumps(data) -> bytes:
+        return msgpack.packb(data, default=_encode_default)
+
+    @staticmethod
+    def loads(encoded_data):
+        return msgpack.unpackb(encoded_data)
+
+
+CODECS = {
+    JsonCodec.name: JsonCodec,
+    OrjsonCodec.name: OrjsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+
+def get_available_codecs() -> list:
+    available = [JsonCodec.name]
+    if orjson is not None:
+        available.append(OrjsonCodec.name)
+    if msgpack is not None:
+        available.append(MsgpackCodec.name)
+    return available
+
+
+# The other backends change the wire format, so they are only used when chosen
+# with set_codec()
+_codec = JsonCodec
+
 class CommandMessage:
     def __init__(
         self, 
@@ -9,13 +103,19 @@ class CommandMessage:
         recipient_device_name: str, 
         command_key_word: str, 
         settings: str, 
-        datetime: datetime=datetime.now(tz=timezone.utc)
+        datetime: datetime=datetime.now(tz=timezone.utc),
+        command_id: str=None,
+        execute_at: float=None
     ) -> None:
         self.datetime = datetime
         self.sender_program_name = sender_program_name
         self.recipient_device_name = recipient_device_name
         self.command_key_word = command_key_word
         self.settings = settings
+        # Only set for group commands: the id the devices acknowledge with and
+        # the epoch time the devices should execute the command at
+        self.command_id = command_id
+        self.execute_at = execute_at
     
     def encode(self) -> dict:
         return self.__dict__
@@ -27,18 +127,29 @@ class CommandMessage:
             sender_program_name=data["sender_program_name"],
             recipient_device_name=data["recipient_device_name"],
             command_key_word=data["command_key_word"],
-            settings=data["settings"]
+            settings=data["settings"],
+            command_id=data.get("command_id"),
+            execute_at=data.get("execute_at")
         )
     
 
 # DATE_TIME_STRING = "%m/%d/%Y %H:%M:%S:%f"
 
 class RedisEncoderDecoder(object):
+    @staticmethod
+    def set_codec(codec_name: str):
+        global _codec
+        if codec_name not in get_available_codecs():
+            raise ValueError(f"Codec '{codec_name}' is not available, installed codecs: {get_available_codecs()}")
+        _codec = CODECS[codec_name]
+
+    @staticmethod
+    def get_codec_name() -> str:
+        return _codec.name
+
     @staticmethod
     def encode_command(command_message: CommandMessage):
-        command_data = command_message.__dict__
-        command_data["datetime"] = command_data["datetime"].isoformat()
-        return json.dumps(command_data)
+        return _codec.dumps(command_message.__dict__)
 
     def encode_command_for_database(command_dict_original):
         command_dict = command_dict_original.copy()
@@ -47,8 +158,8 @@ class RedisEncoderDecoder(object):
 
     @staticmethod
     def decode_command(json_data) -> CommandMessage:
-        if type(json_data) == str:
-            command_data = json.loads(json_data)
+        if type(json_data) in (str, bytes):
+            command_data = _codec.loads(json_data)
             command_data["datetime"] = datetime.fromisoformat(command_data["datetime"])
         else:
             command_data = json_data
@@ -58,46 +169,64 @@ class RedisEncoderDecoder(object):
             sender_program_name=command_data["sender_program_name"], 
             recipient_device_name=command_data["recipient_device_name"], 
             command_key_word=command_data["command_key_word"], 
-            settings=command_data["settings"]
+            settings=command_data["settings"],
+            command_id=command_data.get("command_id"),
+            execute_at=command_data.get("execute_at")
             )
 
     @staticmethod
-    def encode_reading(reading_dict_original):
-        reading_dict = reading_dict_original.copy()
+    def encode_reading(reading_dict):
         # reading_dict["time"] = reading_dict["time"].strftime(DATE_TIME_STRING)
-        reading_dict["datetime"] = reading_dict["datetime"].isoformat()
-        return json.dumps(reading_dict)
+        return _codec.dumps(reading_dict)
         
     @staticmethod
     def decode_reading(json_data) -> dict:
-        readings_data = json.loads(json_data)
+        readings_data = _codec.loads(json_data)
         # readings_data["time"] = datetime.strptime(readings_data["time"], DATE_TIME_STRING)
         readings_data["datetime"] = datetime.fromisoformat(readings_data["datetime"])
         return readings_data
 
     @staticmethod
-    def encode_combined_reading(combined_readings_dict_original):
-        combined_readings_dict = combined_readings_dict_original.copy()
-        
+    def encode_combined_reading(combined_readings_dict):
+        """
+        Encodes the combined reading with each reading nested as an encoded
+        string, the format existing subscribers decode.
+        """
         # combined_readings_dict["time"] = combined_readings_dict["time"].strftime(DATE_TIME_STRING)
-        combined_readings_dict["datetime"] = combined_readings_dict["datetime"].isoformat()
-
-        for key in combined_readings_dict.keys():
-            if key != "datetime":
-                combined_readings_dict[key] = RedisEncoderDecoder.encode_reading(combined_readings_dict[key])
-        
-        return json.dumps(combined_readings_dict)
+        combined_readings_dict = {
+            key: value if key == "datetime" else RedisEncoderDecoder.encode_reading(value)
+            for key, value in combined_readings_dict.items()}
+        return _codec.dumps(combined_readings_dict)
+    
+    @staticmethod
+    def encode_combined_reading_from_encoded(combined_datetime: datetime, encoded_readings: dict):
+        """
+        Builds a combined reading from readings that are already JSON encoded,
+        e.g. as received from redis, without decoding and re-encoding them.
+        Each reading is nested as a JSON string, as encode_combined_reading()
+        does, so only the string is escaped. Only for the JSON codecs.
+        """
+        parts = [f'"datetime": {json.dumps(combined_datetime.isoformat())}']
+        for key, encoded_reading in encoded_readings.items():
+            parts.append(f'{json.dumps(key)}: {json.dumps(encoded_reading)}')
+        return "{" + ", ".join(parts) + "}"
     
     @staticmethod
     def decode_combined_reading(json_data):
-        combined_readings_dict = json.loads(json_data)
+        combined_readings_dict = _codec.loads(json_data)
 
         # combined_readings_dict["time"] = datetime.strptime(combined_readings_dict["time"], DATE_TIME_STRING)
         combined_readings_dict["datetime"] = datetime.fromisoformat(combined_readings_dict["datetime"])
 
         for key in combined_readings_dict.keys():
             if key != "datetime":
-                combined_readings_dict[key] = RedisEncoderDecoder.decode_reading(combined_readings_dict[key])
+                reading = combined_readings_dict[key]
+                # Readings are nested as JSON strings, combined readings
+                # briefly published with JSON objects are also accepted
+                if isinstance(reading, str):
+                    combined_readings_dict[key] = RedisEncoderDecoder.decode_reading(reading)
+                else:
+                    reading["datetime"] = datetime.fromisoformat(reading["datetime"])
         
         return combined_readings_dict
 
@@ -114,7 +243,7 @@ class RedisEncoderDecoder(object):
 
     @staticmethod
     def decode_subprocess_log(json_data):
-        subprocess_log = json.loads(json_data)
+        subprocess_log = _codec.loads(json_data)
         # subprocess_log["time"] = datetime.strptime(subprocess_log["time"], DATE_TIME_STRING)
         subprocess_log["datetime"] = datetime.fromisoformat(subprocess_log["datetime"])
         return subprocess_log
@@ -122,40 +251,59 @@ class RedisEncoderDecoder(object):
     @staticmethod
     def encode_raspi_state_database(raspi_state):
         # raspi_state["time"] = raspi_state["time"].strftime(DATE_TIME_STRING)
-        raspi_state["datetime"] = raspi_state["datetime"].isoformat()
-        return json.dumps(raspi_state)
+        return _codec.dumps(raspi_state)
     
     @staticmethod
     def decode_raspi_state_database(raspi_state_json):
-        raspi_state = json.loads(raspi_state_json)
+        raspi_state = _codec.loads(raspi_state_json)
         raspi_state["datetime"] = datetime.fromisoformat(raspi_state["datetime"])
         return raspi_state
 
     @staticmethod
     def encode_error_code(error_code):
         # error_code["time"] = error_code["time"].strftime(DATE_TIME_STRING)
-        error_code["datetime"] = error_code["datetime"].isoformat()
-        return json.dumps(error_code)
+        return _codec.dumps(error_code)
 
     @staticmethod
     def decode_error_code(error_code_json):
-        error_code_json = json.loads(error_code_json)
+        error_code_json = _codec.loads(error_code_json)
         # error_code_json['time'] = datetime.strptime(error_code_json['time'], DATE_TIME_STRING)
         error_code_json['datetime'] = datetime.fromisoformat(error_code_json['datetime'])
         return error_code_json
     
     @staticmethod
     def encode_json_with_date(raw_data: dict):
-        raw_data = raw_data.copy()
-        if "datetime" in raw_data.keys():
-            raw_data["datetime"] = raw_data["datetime"].isoformat()
-        else:
-            raw_data["datetime"] = datetime.now(tz=timezone.utc).isoformat()
+        if "datetime" not in raw_data.keys():
+            raw_data = raw_data.copy()
+            raw_data["datetime"] = datetime.now(tz=timezone.utc)
             
-        return json.dumps(raw_data)
+        return _codec.dumps(raw_data)
 
     @staticmethod
     def decode_json_with_date(json_data):
-        json_data = json.loads(json_data)
+        json_data = _codec.loads(json_data)
         json_data['datetime'] = datetime.fromisoformat(json_data['datetime'])
         return json_data
+
+
+def benchmark(codec_name: str, iterations: int = 20000, fields: int = 90):
+    """
+    Returns the number of encode + decode round trips per second of a reading
+    with the given number of fields.
+    """
+    RedisEncoderDecoder.set_codec(codec_name)
+    reading = {"datetime": datetime.now(tz=timezone.utc), "device_id": "0123456789ab"}
+    for field in range(fields):
+        reading[f"Register_{field}"] = field * 1.1
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        RedisEncoderDecoder.decode_reading(RedisEncoderDecoder.encode_reading(reading))
+    return iterations / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    default_codec = RedisEncoderDecoder.get_codec_name()
+    for codec_name in get_available_codecs():
+        print(f"{codec_name:>8}: {benchmark(codec_name):10.0f} readings/s (encode + decode, 90 fields)")
+    RedisEncoderDecoder.set_codec(default_codec)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+RegisterGroupScheduler used to poll groups of registers at different rates.
+
+A device register config file can split its registers into groups, each with
+its own read blocks and reporting frequency:
+
+    [[register_groups]]
+    name = "power"
+    reporting_frequency = 10
+
+    [[register_groups.blocks]]
+    start = 1109
+    size = 16
+
+On each poll the scheduler finds the groups that are due, merges their blocks
+(joining blocks that overlap or touch) and returns a custom_read map for
+Edge_device.update_read() containing only the registers inside those blocks.
+Merged blocks longer than the 125 register Modbus limit are split again,
+between registers. Blocks follow the same convention as "basic_read_block":
+the registers start + 1 to start + size - 1 are read.
+"""
+import register_map_compiler
+
+
+class RegisterGroup():
+    def __init__(self, name: str, reporting_frequency: float, blocks: list) -> None:
+        self.name = name
+        self.period = 1 / reporting_frequency
+        self.blocks = blocks
+        self.time_next_due = None
+
+    def is_due(self, now: float) -> bool:
+        return self.time_next_due is None or now >= self.time_next_due
+
+    def set_read(self, now: float):
+        # Step from the previous due time so the cadence does not drift, but
+        # never schedule in the past after a long stall
+        if self.time_next_due is None:
+            self.time_next_due = now + self.period
+        else:
+            self.time_next_due = max(self.time_next_due + self.period, now)
+
+
+class RegisterGroupScheduler():
+    def __init__(self, groups: list, registers: list, reading_type: str = "basic") -> None:
+        self.groups = groups
+        self.registers = registers
+        self.reading_type = reading_type
+        self._custom_reads = {}
+
+    @staticmethod
+    def from_config(config: dict, reading_type: str = "basic"):
+        """
+        Returns a scheduler for the "register_groups" section of a device
+        register config file, or None if the device has no register groups.
+        """
+        if "register_groups" not in config:
+            return None
+
+        groups = [
+            RegisterGroup(group["name"], group["reporting_frequency"], group["blocks"])
+            for group in config["register_groups"]]
+        return RegisterGroupScheduler(groups, config["basic_read_registers"], reading_type)
+
+    def get_groups(self):
+        return self.groups
+
+    def get_blocks(self):
+        blocks = []
+        for group in self.groups:
+            blocks.extend(group.blocks)
+        return blocks
+
+    def get_fastest_period(self):
+        return min([group.period for group in self.groups])
+
+    @staticmethod
+    def merge_blocks(blocks: list) -> list:
+        return register_map_compiler.merge_blocks(blocks)
+
+    def build_custom_read(self, groups: list) -> dict:
+        blocks = register_map_compiler.split_blocks(
+            self.merge_blocks([block for group in groups for block in group.blocks]),
+            self.registers)
+
+        registers = []
+        for register in self.registers:
+            for block in blocks:
+                if block["start"] < register["location"] <= block["start"] + block["size"] - 1:
+                    registers.append(dict(register, offset=register.get("offset", 0)))
+                    break
+
+        return {
+            "reading_type": self.reading_type,
+            "registers": registers,
+            "blocks": blocks,
+        }
+
+    def get_due_read(self, now: float):
+        """
+        Returns the custom_read map for all groups due at time now and marks
+        them as read, or None if no group is due.
+        """
+        due_groups = [group for group in self.groups if group.is_due(now)]
+        if not due_groups:
+            return None
+
+        for group in due_groups:
+            group.set_read(now)
+
+        # The same combinations of groups come up every cycle so the merged
+        # reads are cached by group names
+        key = tuple([group.name for group in due_groups])
+        if key not in self._custom_reads:
+            self._custom_reads[key] = self.build_custom_read(due_groups)
+        return self._custom_reads[key]
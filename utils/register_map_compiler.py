@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Register map compiler used to validate a device register config file and
+cache the decode plan for its reads.
+
+Validation checks every register and block of the TOML file:
+    - each register has a reg_name, location, dtype and scalar, and a known
+      dtype
+    - no two registers share a name or overlap, counting 2 words for
+      i/I/l/L/f and 4 words for q/Q/d registers
+    - each register lies inside a basic_read_block, registers outside the
+      register group blocks are reported as warnings
+    - no register sits on the first location of a block, which is not read,
+      and no block splits a multi word register
+    - no block reads more than the 125 register Modbus limit
+    - the blocks of all register groups, merged as when every group is due
+      at once and split at the Modbus limit, don't split a register
+
+Blocks follow the convention of Edge_device.read_modbus(): a block reads the
+locations start + 1 to start + size - 1.
+
+A decode plan lists, for every word a read returns, the register it belongs
+to, so Edge_device.update_read() can unpack a read in one step. Words not in
+a register are decoded as "unused_<location>" and dropped.
+
+The parsed config and the plans are pickled to the cache directory, named
+after the config file and a hash of its real path so two files with the same
+name in different directories don't share an artefact, with the compiler
+version and the source file's mtime and sha256. load_register_map()
+returns the cached artefact while those still match and recompiles the file
+otherwise, raising RegisterMapError if it is invalid.
+
+Usage:
+    python register_map_compiler.py ../config/config_statcom_registers_new.toml ...
+
+Exits non-zero if any file has errors, so it can run before deployment.
+"""
+import hashlib
+import os
+import pickle
+import sys
+import toml
+
+COMPILER_VERSION = 2
+CACHE_DIRECTORY = f'{os.path.dirname(__file__)}/../cache/register_maps/'
+MAX_READ_REGISTERS = 125
+UNUSED_DTYPE = "h"
+DTYPE_WORDS = {
+    "h": 1, "H": 1,
+    "i": 2, "I": 2, "l": 2, "L": 2, "f": 2,
+    "q": 4, "Q": 4, "d": 4,
+}
+REQUIRED_REGISTER_KEYS = ("reg_name", "location", "dtype", "scalar")
+
+
+class RegisterMapError(Exception):
+    pass
+
+
+def get_register_words(register: dict) -> int:
+    return DTYPE_WORDS[register["dtype"]]
+
+
+def validate_blocks(registers: list, blocks: list, block_section: str, uncovered_is_error: bool = True) -> tuple:
+    """
+    Returns the errors and warnings of the registers against one set of read
+    blocks.
+    """
+    errors = []
+    warnings = []
+
+    for block in blocks:
+        if block["size"] - 1 > MAX_READ_REGISTERS:
+            errors.append(f"{block_section} at {block['start']} reads {block['size'] - 1} registers, more than {MAX_READ_REGISTERS}.")
+
+    sorted_blocks = sorted(blocks, key=lambda x: x["start"])
+    for previous, block in zip(sorted_blocks, sorted_blocks[1:]):
+        if block["start"] < previous["start"] + previous["size"] - 1:
+            warnings.append(f"{block_section} at {previous['start']} and {block['start']} overlap, registers are read twice.")
+
+    for register in registers:
+        location = register["location"]
+        last_location = location + get_register_words(register) - 1
+        covered = False
+        for block in blocks:
+            first_read = block["start"] + 1
+            last_read = block["start"] + block["size"] - 1
+            if location == block["start"]:
+                errors.append(f"'{register['reg_name']}' at {location} is the first location of the {block_section} at {block['start']}, which is not read.")
+            elif first_read <= location <= last_read:
+                covered = True
+                if last_location > last_read:
+                    errors.append(f"{block_section} at {block['start']} splits '{register['reg_name']}' at {location}-{last_location}.")
+            elif location < first_read <= last_location:
+                errors.append(f"{block_section} at {block['start']} splits '{register['reg_name']}' at {location}-{last_location}.")
+        if not covered:
+            message = f"'{register['reg_name']}' at {location} is not in any {block_section}."
+            (errors if uncovered_is_error else warnings).append(message)
+
+    return errors, warnings
+
+
+def merge_blocks(blocks: list) -> list:
+    """
+    Sorts the blocks by start register and joins any that overlap or touch
+    so each register is only read once per poll.
+    """
+    merged = []
+    for block in sorted(blocks, key=lambda x: x["start"]):
+        if merged and block["start"] <= merged[-1]["start"] + merged[-1]["size"]:
+            end = max(merged[-1]["start"] + merged[-1]["size"], block["start"] + block["size"])
+            merged[-1]["size"] = end - merged[-1]["start"]
+        else:
+            merged.append(dict(start=block["start"], size=block["size"]))
+    return merged
+
+
+def split_blocks(blocks: list, registers: list) -> list:
+    """
+    Splits blocks reading more than MAX_READ_REGISTERS registers into several
+    blocks, never between the words of a register.
+    """
+    # (first, last) location of each multi word register
+    spans = [(register["location"], register["location"] + get_register_words(register) - 1)
+             for register in registers if get_register_words(register) > 1]
+    split = []
+    for block in blocks:
+        first_read = block["start"] + 1
+        last_read = block["start"] + block["size"] - 1
+        while last_read - first_read + 1 > MAX_READ_REGISTERS:
+            end = first_read + MAX_READ_REGISTERS - 1
+            for first, last in spans:
+                if first <= end < last and first > first_read:
+                    end = first - 1
+            split.append(dict(start=first_read - 1, size=end - first_read + 2))
+            first_read = end + 1
+        split.append(dict(start=first_read - 1, size=last_read - first_read + 2))
+    return split
+
+
+def validate_merged_group_blocks(registers: list, groups: list) -> list:
+    """
+    Returns the errors of the read of every register group at once.
+    """
+    errors = []
+    blocks = split_blocks(merge_blocks([block for group in groups for block in group["blocks"]]), registers)
+    for block in blocks:
+        if block["size"] - 1 > MAX_READ_REGISTERS:
+            errors.append(f"merged register group block at {block['start']} reads {block['size'] - 1} registers, more than {MAX_READ_REGISTERS}.")
+    for previous, block in zip(blocks, blocks[1:]):
+        boundary = previous["start"] + previous["size"] - 1
+        for register in registers:
+            if register["location"] <= boundary < register["location"] + get_register_words(register) - 1:
+                errors.append(f"merged register group blocks split '{register['reg_name']}' at {register['location']}.")
+    return errors
+
+
+def validate(config: dict) -> tuple:
+    """
+    Returns the lists of errors and warnings found in a register config.
+    """
+    errors = []
+    warnings = []
+
+    registers = config.get("basic_read_registers", [])
+    valid_registers = []
+    for index, register in enumerate(registers):
+        missing = [key for key in REQUIRED_REGISTER_KEYS if key not in register]
+        if missing:
+            errors.append(f"Register {index} ({register.get('reg_name')}) is missing {', '.join(missing)}.")
+        elif register["dtype"] not in DTYPE_WORDS:
+            errors.append(f"'{register['reg_name']}' has unknown dtype '{register['dtype']}'.")
+        else:
+            valid_registers.append(register)
+
+    names = [register["reg_name"] for register in valid_registers]
+    for name in sorted(set(names)):
+        if names.count(name) > 1:
+            errors.append(f"'{name}' is defined {names.count(name)} times.")
+
+    sorted_registers = sorted(valid_registers, key=lambda x: x["location"])
+    for previous, register in zip(sorted_registers, sorted_registers[1:]):
+        if register["location"] < previous["location"] + get_register_words(previous):
+            errors.append(
+                f"'{register['reg_name']}' at {register['location']} overlaps '{previous['reg_name']}' "
+                f"at {previous['location']}-{previous['location'] + get_register_words(previous) - 1}.")
+
+    if "basic_read_block" not in config:
+        errors.append("No basic_read_block defined.")
+    else:
+        block_errors, block_warnings = validate_blocks(valid_registers, config["basic_read_block"], "basic_read_block")
+        errors.extend(block_errors)
+        warnings.extend(block_warnings)
+
+    if "register_groups" in config:
+        group_blocks = [block for group in config["register_groups"] for block in group["blocks"]]
+        # Registers outside the groups are valid but never read
+        block_errors, block_warnings = validate_blocks(valid_registers, group_blocks, "register group block", uncovered_is_error=False)
+        errors.extend(block_errors)
+        warnings.extend(block_warnings)
+        if not block_errors:
+            errors.extend(validate_merged_group_blocks(valid_registers, config["register_groups"]))
+
+    return errors, warnings
+
+
+def build_decode_plan(registers: list, blocks: list) -> dict:
+    """
+    Returns the decode plan for a read of the blocks: the names, scalars,
+    offsets and dtypes of the values unpacked from the read, in order.
+    """
+    by_location = {register["location"]: register for register in registers}
+    plan = dict(
+        blocks=[(block["start"], block["size"]) for block in blocks],
+        reg_names=[],
+        reg_scalars=[],
+        reg_offsets=[],
+        reg_dtypes=[])
+
+    for block in blocks:
+        location = block["start"] + 1
+        last_location = block["start"] + block["size"] - 1
+        while location <= last_location:
+            register = by_location.get(location)
+            if register is None:
+                plan["reg_names"].append(f"unused_{location}")
+                plan["reg_scalars"].append(1)
+                plan["reg_offsets"].append(0)
+                plan["reg_dtypes"].append(UNUSED_DTYPE)
+                location += 1
+            else:
+                plan["reg_names"].append(register["reg_name"])
+                plan["reg_scalars"].append(register["scalar"])
+                plan["reg_offsets"].append(register.get("offset", 0))
+                plan["reg_dtypes"].append(register["dtype"])
+                location += get_register_words(register)
+
+    plan["unpack_string"] = "<" + "".join(plan["reg_dtypes"])
+    return plan
+
+
+def get_read_key(blocks: list) -> tuple:
+    return tuple([(block["start"], block["size"]) for block in blocks])
+
+
+def compile_register_map(config_path: str) -> dict:
+    """
+    Validates a register config file and returns its artefact. Raises
+    RegisterMapError if the file is invalid.
+    """
+    with open(config_path, "rb") as config_file:
+        source = config_file.read()
+    config = toml.loads(source.decode("utf-8"))
+
+    errors, warnings = validate(config)
+    if errors:
+        raise RegisterMapError(f"{config_path}: " + " ".join(errors))
+
+    registers = config["basic_read_registers"]
+    plans = {get_read_key(config["basic_read_block"]): build_decode_plan(registers, config["basic_read_block"])}
+    for group in config.get("register_groups", []):
+        plans[get_read_key(group["blocks"])] = build_decode_plan(registers, group["blocks"])
+
+    return dict(
+        version=COMPILER_VERSION,
+        source_path=os.path.realpath(config_path),
+        source_mtime=os.path.getmtime(config_path),
+        source_sha256=hashlib.sha256(source).hexdigest(),
+        warnings=warnings,
+        config=config,
+        plans=plans)
+
+
+def get_artefact_path(config_path: str, cache_directory: str = CACHE_DIRECTORY) -> str:
+    file_name = os.path.basename(config_path).rsplit(".", 1)[0]
+    path_hash = hashlib.sha256(os.path.realpath(config_path).encode("utf-8")).hexdigest()[:16]
+    return f"{cache_directory}{file_name}_{path_hash}.pickle"
+
+
+def _is_current(artefact: dict, config_path: str) -> bool:
+    if artefact.get("version") != COMPILER_VERSION or artefact.get("source_path") != os.path.realpath(config_path):
+        return False
+    if artefact["source_mtime"] == os.path.getmtime(config_path):
+        return True
+
+    # The file was touched, it only needs compiling if its content changed
+    with open(config_path, "rb") as config_file:
+        if hashlib.sha256(config_file.read()).hexdigest() != artefact["source_sha256"]:
+            return False
+    artefact["source_mtime"] = os.path.getmtime(config_path)
+    return True
+
+
+def load_register_map(config_path: str, cache_directory: str = CACHE_DIRECTORY):
+    """
+    Returns the RegisterMap of a register config file, from the cached
+    artefact if it is current, otherwise compiling and caching it.
+    """
+    artefact_path = get_artefact_path(config_path, cache_directory)
+    artefact = None
+    if os.path.isfile(artefact_path):
+        try:
+            with open(artefact_path, "rb") as artefact_file:
+                artefact = pickle.load(artefact_file)
+            if not _is_current(artefact, config_path):
+                artefact = None
+        except Exception:
+            artefact = None
+
+    if artefact is None:
+        artefact = compile_register_map(config_path)
+        os.makedirs(cache_directory, exist_ok=True)
+        # Write then rename so devices starting together never read a part
+        # written artefact
+        temporary_path = f"{artefact_path}.{os.getpid()}"
+        with open(temporary_path, "wb") as artefact_file:
+            pickle.dump(artefact, artefact_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, artefact_path)
+
+    return RegisterMap(artefact)
+
+
+class RegisterMap():
+    def __init__(self, artefact: dict) -> None:
+        self.artefact = artefact
+        self.plans = dict(artefact["plans"])
+
+    def get_config(self) -> dict:
+        return self.artefact["config"]
+
+    def get_warnings(self) -> list:
+        return self.artefact["warnings"]
+
+    def get_plan(self, custom_read=None) -> dict:
+        """
+        Returns the decode plan for the basic read, or for a custom_read as
+        passed to Edge_device.update_read(). Plans for reads that were not
+        compiled, e.g. merged register group reads, are built on first use.
+        """
+        config = self.get_config()
+        blocks = config["basic_read_block"] if custom_read is None else custom_read["blocks"]
+        key = get_read_key(blocks)
+        if key not in self.plans:
+            registers = config["basic_read_registers"] if custom_read is None else custom_read["registers"]
+            self.plans[key] = build_decode_plan(registers, blocks)
+        return self.plans[key]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python register_map_compiler.py <register config file> ...")
+        sys.exit(2)
+
+    failed = False
+    for config_path in sys.argv[1:]:
+        try:
+            register_map = load_register_map(config_path)
+        except RegisterMapError as e:
+            failed = True
+            config = toml.load(config_path)
+            errors, _ = validate(config)
+            print(f"{config_path}: {len(errors)} error(s)")
+            for error in errors:
+                print(f"    ERROR: {error}")
+            continue
+
+        print(f"{config_path}: ok, {len(register_map.plans)} decode plan(s) cached")
+        for warning in register_map.get_warnings():
+            print(f"    WARNING: {warning}")
+
+    sys.exit(1 if failed else 0)
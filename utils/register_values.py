@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Register value conversions driven by the register dtype, used instead of
+converting between signed and unsigned values by hand.
+
+Modbus registers are 16 bit words, the dtype of a register (the struct format
+characters of the register config: h, H, i, I, l, L, f, q, Q, d) says how its
+words hold a value. encode_values() turns engineering values into the uint16
+words to write, applying the inverse of the register's scalar and offset, and
+decode_values() turns words back into values. Both convert a whole list in
+one numpy pass. Multi word values use the word order of
+Edge_device.update_read(), least significant word first.
+
+RegisterValues looks the dtype, scalar, offset and address of a register up
+by name from the register config, so writes follow the register map:
+
+    address, words = register_values.encode("Set_Power", [-100, -100, -100])
+
+encodes three consecutive int16 registers starting at Set_Power.
+"""
+import numpy as np
+
+from register_map_compiler import DTYPE_WORDS
+
+# Explicit little endian numpy dtypes of the struct format characters, numpy's
+# own "l" is 8 bytes on most platforms
+NUMPY_DTYPES = {
+    "h": "<i2", "H": "<u2",
+    "i": "<i4", "I": "<u4", "l": "<i4", "L": "<u4", "f": "<f4",
+    "q": "<i8", "Q": "<u8", "d": "<f8",
+}
+FLOAT_DTYPES = ("f", "d")
+
+
+def encode_values(values, dtype: str, scalar: float = 1.0, offset: float = 0.0) -> list:
+    """
+    Returns the uint16 words of the values as registers of the dtype. Integer
+    registers are rounded to the nearest step. Raises ValueError if a value
+    doesn't fit the dtype.
+    """
+    raw = (np.asarray(values, dtype=np.float64) - offset) / scalar
+    numpy_dtype = np.dtype(NUMPY_DTYPES[dtype])
+
+    if dtype not in FLOAT_DTYPES:
+        np.rint(raw, out=raw)
+        limits = np.iinfo(numpy_dtype)
+        if raw.size and (raw.min() < limits.min or raw.max() > limits.max):
+            raise ValueError(f"Values {np.asarray(values).tolist()} out of range for dtype '{dtype}'.")
+
+    return raw.astype(numpy_dtype).view("<u2").tolist()
+
+
+def decode_values(words, dtype: str, scalar: float = 1.0, offset: float = 0.0) -> np.ndarray:
+    """
+    Returns the values held by uint16 words as registers of the dtype.
+    """
+    # Words stored as signed python ints wrap to their uint16 value
+    words = np.asarray(words).astype("<u2")
+    return words.view(NUMPY_DTYPES[dtype]) * scalar + offset
+
+
+class RegisterValues():
+    def __init__(self, registers: list) -> None:
+        # reg_name -> (address, dtype, scalar, offset)
+        self.registers = {
+            register["reg_name"]: (
+                register["location"] - 1,
+                register["dtype"],
+                register["scalar"],
+                register.get("offset", 0))
+            for register in registers}
+
+    def get_address(self, reg_name: str) -> int:
+        return self.registers[reg_name][0]
+
+    def get_words(self, reg_name: str) -> int:
+        return DTYPE_WORDS[self.registers[reg_name][1]]
+
+    def encode(self, reg_name: str, values) -> tuple:
+        """
+        Returns the address and words to write the values to the register and
+        the registers of the same dtype following it.
+        """
+        address, dtype, scalar, offset = self.registers[reg_name]
+        return address, encode_values(values, dtype, scalar, offset)
+
+    def decode(self, reg_name: str, words) -> np.ndarray:
+        _, dtype, scalar, offset = self.registers[reg_name]
+        return decode_values(words, dtype, scalar, offset)
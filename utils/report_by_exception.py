@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+ReportByExceptionFilter used to publish only the readings that have changed.
+
+Each register can be given a deadband next to its scalar in the device register
+config file:
+
+    [[basic_read_registers]]
+    reg_name = "RPI_Temperature_1"
+    scalar = 0.1
+    dtype = "H"
+    location = 1086
+    deadband = 0.5
+    deadband_type = "absolute"
+
+deadband_type is either "absolute" (the default, in the scaled units of the
+register) or "percent" (of the last reported value). A field is reported when
+it moves further than its deadband from the value last reported for it.
+Registers without a deadband are reported on any change. A device keeps one
+filter per reading type, built from the registers of the reads of that type,
+e.g. of its register groups or custom reads.
+
+Changed fields are published as a delta reading on the "<reading_type>_delta"
+topic. A full keyframe of the whole state is published on the normal
+"<reading_type>" topic at the slow reporting frequency so consumers can always
+rebuild the full state.
+"""
+
+DELTA_READING_SUFFIX = "_delta"
+DEADBAND_ABSOLUTE = "absolute"
+DEADBAND_PERCENT = "percent"
+
+# Fields sent with every delta so the reading can be placed in time and
+# attributed to a device
+ALWAYS_REPORTED_FIELDS = ("datetime", "device_id", "read_start_time", "read_duration")
+
+
+def encode_delta_reading_type(reading_type: str) -> str:
+    return reading_type + DELTA_READING_SUFFIX
+
+
+def is_delta_reading_type(reading_type: str) -> bool:
+    return reading_type.endswith(DELTA_READING_SUFFIX)
+
+
+def decode_delta_reading_type(reading_type: str) -> str:
+    if is_delta_reading_type(reading_type):
+        return reading_type[:-len(DELTA_READING_SUFFIX)]
+    return reading_type
+
+
+class ReportByExceptionFilter():
+    def __init__(self, deadbands: dict, keyframe_period: float) -> None:
+        """
+        deadbands maps a field name to a (deadband, deadband_type) tuple.
+        """
+        self.deadbands = deadbands
+        self.keyframe_period = keyframe_period
+        self.last_reported = {}
+        self.time_last_keyframe = None
+        # id -> register list whose deadbands have been added
+        self._register_lists = {}
+
+    @staticmethod
+    def get_register_deadbands(registers: list) -> dict:
+        deadbands = {}
+        for register in registers:
+            if "deadband" in register:
+                deadband_type = register.get("deadband_type", DEADBAND_ABSOLUTE)
+                if deadband_type not in (DEADBAND_ABSOLUTE, DEADBAND_PERCENT):
+                    raise ValueError(
+                        f"Register '{register['reg_name']}' has unknown deadband_type '{deadband_type}'.")
+                deadbands[register["reg_name"]] = (register["deadband"], deadband_type)
+        return deadbands
+
+    @staticmethod
+    def from_register_config(registers: list, keyframe_period: float):
+        """
+        Builds the filter from a list of register config entries, e.g. the
+        "basic_read_registers" section of a device register config file.
+        """
+        report_filter = ReportByExceptionFilter({}, keyframe_period)
+        report_filter.add_registers(registers)
+        return report_filter
+
+    def add_registers(self, registers: list):
+        """
+        Adds the deadbands of a list of register config entries. Each list is
+        only read once, reads reuse the same list every poll.
+        """
+        if id(registers) in self._register_lists:
+            return
+        self.deadbands.update(self.get_register_deadbands(registers))
+        self._register_lists[id(registers)] = registers
+
+    def get_deadbands(self):
+        return self.deadbands
+
+    def is_keyframe_due(self, now: float) -> bool:
+        if self.time_last_keyframe is None:
+            return True
+        return now - self.time_last_keyframe >= self.keyframe_period
+
+    def exceeds_deadband(self, key, value) -> bool:
+        if key not in self.last_reported:
+            return True
+
+        last_value = self.last_reported[key]
+        if value == last_value:
+            return False
+
+        deadband = self.deadbands.get(key)
+        if deadband is None:
+            return True
+
+        try:
+            change = abs(value - last_value)
+        except TypeError:
+            return True
+
+        band, deadband_type = deadband
+        if deadband_type == DEADBAND_PERCENT:
+            band = abs(last_value) * band / 100
+        return change > band
+
+    def get_changes(self, state: dict) -> dict:
+        changes = {}
+        for key, value in state.items():
+            if key in ALWAYS_REPORTED_FIELDS:
+                continue
+            if self.exceeds_deadband(key, value):
+                changes[key] = value
+        return changes
+
+    def filter(self, state: dict, now: float):
+        """
+        Returns (is_keyframe, reading). reading is the full state when a
+        keyframe is due, the changed fields when any moved outside their
+        deadband, otherwise None and nothing needs to be published.
+        """
+        if self.is_keyframe_due(now):
+            self.time_last_keyframe = now
+            self.last_reported = dict(state)
+            return True, state
+
+        changes = self.get_changes(state)
+        if not changes:
+            return False, None
+
+        self.last_reported.update(changes)
+        for key in ALWAYS_REPORTED_FIELDS:
+            if key in state:
+                changes[key] = state[key]
+        return False, changes
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+SiteStateAggregator used to combine the latest readings of every device into
+one snapshot per tick.
+
+The aggregator subscribes to the readings of all devices and keeps the latest
+encoded reading of each device in memory. Every tick (aligned to the wall clock
+at the combined_readings reporting_frequency) it publishes one combined reading
+on the combined readings topic. The stored readings are spliced into the
+combined reading as they were received, so each reading is only JSON encoded
+once, by the device that published it.
+
+Report by exception delta readings are merged into the latest full reading of
+the device. Readings older than max_reading_age seconds are left out of the
+snapshot. In report by exception mode a device whose values stay within their
+deadbands only publishes a keyframe every slow reporting period, so the
+keyframe period is added to the age allowed.
+
+It also answers state queries sent with RedisStateAggregatorIpc.ask_query().
+The query is a device key (e.g. "statcom_1"), or "all" for every device, and is
+answered from the in-memory view on the state answer topic of the sender.
+"""
+import json
+import logging
+import math
+import os
+import time
+import toml
+from datetime import datetime, timezone
+
+import db_logger
+import redis_custom_library as redis_lib
+from pubsub_topic_encoder_decoder import PubSubTopicEncoderDecoder as psted
+from redis_message_structures import RedisEncoderDecoder
+from report_by_exception import decode_delta_reading_type, is_delta_reading_type
+from topic_router import TopicRouter
+
+LOGGER_LEVEL = logging.INFO
+
+logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL, queued=True)
+logger = logger_setup.get_logger()
+
+CONFIG_FILE = f'{os.path.dirname(__file__)}/../config/config_python_modules.toml'
+QUERY_ALL = "all"
+
+
+class SiteStateAggregator():
+    def __init__(self) -> None:
+        self.config = toml.load(CONFIG_FILE)
+        combined_config = self.config["combined_readings"]
+        self.period = 1 / combined_config["reporting_frequency"]
+        self.reading_types = combined_config["reading_types"]
+        self.max_reading_age = combined_config["max_reading_age"]
+        ipc_config = self.config["ipc-parameters"]
+        if ipc_config["report_by_exception"]:
+            self.max_reading_age += 1 / ipc_config["slow_reporting_frequency"]
+
+        # Latest encoded reading and the time it was received for each device
+        self.latest = {}
+        self.time_received = {}
+
+        self.time_next_tick = self.get_next_tick(time.time())
+
+    def get_next_tick(self, now: float):
+        return math.floor(now / self.period) * self.period + self.period
+
+    def get_reading_key(self, device_name: str, reading_type: str):
+        if reading_type == "basic":
+            return device_name
+        return f"{device_name}_{reading_type}"
+
+    def get_current_readings(self, now: float) -> dict:
+        return {
+            key: encoded_reading
+            for key, encoded_reading in self.latest.items()
+            if now - self.time_received[key] <= self.max_reading_age}
+
+    def handle_reading(self, channel: str, data: str):
+        topic = psted.decode_readings_topic(channel)
+        reading_type = topic["reading_type"]
+        if decode_delta_reading_type(reading_type) not in self.reading_types:
+            return
+
+        key = self.get_reading_key(topic["device_name"], decode_delta_reading_type(reading_type))
+
+        if is_delta_reading_type(reading_type):
+            # Deltas can only be applied once a full reading has been received
+            if key not in self.latest:
+                return
+            reading = json.loads(self.latest[key])
+            reading.update(json.loads(data))
+            data = json.dumps(reading)
+
+        self.latest[key] = data
+        self.time_received[key] = time.time()
+
+    def get_combined_reading(self, now: float) -> str:
+        return RedisEncoderDecoder.encode_combined_reading_from_encoded(
+            datetime.fromtimestamp(now, tz=timezone.utc),
+            self.get_current_readings(now))
+
+    def handle_query(self, redis_server, channel: str, data: str):
+        sender_program = psted.decode_state_query_topic(channel)["sender_program"]
+        query = RedisEncoderDecoder.decode_json_with_date(data)["query"]
+
+        readings = self.get_current_readings(time.time())
+        if query != QUERY_ALL:
+            readings = {key: reading for key, reading in readings.items() if key == query}
+
+        answer = {
+            "datetime": datetime.now(tz=timezone.utc),
+            "query": query,
+            "readings": {key: json.loads(reading) for key, reading in readings.items()},
+        }
+        redis_server.publish(
+            psted.encode_state_answer_topic(sender_program),
+            RedisEncoderDecoder.encode_json_with_date(answer))
+
+    def start(self):
+        redis_server = redis_lib.connect_to_redis_server()
+        subscriber = redis_server.pubsub(ignore_subscribe_messages=True)
+
+        router = TopicRouter()
+        router.add_route(psted.get_readings_topic_pattern(), self.handle_reading)
+        router.add_route(
+            psted.get_state_query_topic_pattern(),
+            lambda channel, data: self.handle_query(redis_server, channel, data))
+        subscriber.psubscribe(*router.get_patterns())
+        combined_topic = psted.encode_combined_readings_topic()
+
+        while True:
+            now = time.time()
+            if now >= self.time_next_tick:
+                redis_server.publish(combined_topic, self.get_combined_reading(self.time_next_tick))
+                self.time_next_tick = self.get_next_tick(now)
+                continue
+
+            message = subscriber.get_message(timeout=self.time_next_tick - now)
+            if message is None:
+                continue
+
+            try:
+                router.dispatch(message)
+            except Exception as e:
+                logger.warning(f"SITE STATE AGGREGATOR: failed to handle message on '{redis_lib.get_channel(message)}': {e}")
+
+
+if __name__ == "__main__":
+    aggregator = SiteStateAggregator()
+    aggregator.start()
@@ -8,15 +8,36 @@ from redis_message_structures import RedisEncoderDecoder
 import db_logger
 import logging
 from redis_message_structures import CommandMessage, RedisEncoderDecoder
+from command_queue import CommandQueue
+from register_values import RegisterValues, encode_values
 
 # Use either real getmac library for raspios or temporary copied one for buildroot 
 import getmac
 from utils_custom import Utils
 get_mac_address = Utils.get_mac_address
 
-logger_setup = db_logger.DBLogger(os.path.basename(__file__), logging.INFO)
+logger_setup = db_logger.DBLogger(os.path.basename(__file__), logging.INFO, queued=True)
 logger = logger_setup.get_logger()
 
+# Commands that set the same registers, only the newest one queued is run
+COMMAND_COALESCE_KEYS = {
+    "start": "run",
+    "stop": "run",
+    "set_power": "power",
+    "set_powers_3p": "power",
+    "voltage_mode": "mode",
+    "current_mode": "mode",
+    "enable": "drm",
+    "disable": "drm",
+    "zero_var_mode": "reactive_mode",
+    "manual_var_mode": "reactive_mode",
+    "volt_var_mode": "reactive_mode",
+    "set_reactive_power": "reactive_power",
+}
+# Safety commands are run before the rest of a batch, a later start or enable
+# runs after them rather than replacing them
+PRIORITY_COMMANDS = ("stop", "disable")
+
 class Statcom(Edge_device):
     def __init__(self, module_name, host, port, unit_id, mode, version):
         
@@ -24,23 +45,27 @@ class Statcom(Edge_device):
         
         CONFIG_FILE = f'{os.path.dirname(__file__)}/../config/config_statcom_registers_new.toml' if self.new_version else f'{os.path.dirname(__file__)}/../config/config_statcom_registers.toml'
         
-        self.config = toml.load(CONFIG_FILE)
+        self.register_map = self.load_register_map(CONFIG_FILE)
+        self.config = self.register_map.get_config()
+        self.register_values = RegisterValues(self.config["basic_read_registers"])
         super().__init__(module_name, host, port, unit_id, True)
         
         # self.state = dict(SUN=None, time=None)
         # self.state = dict(device_id=self.get_device_id(), datetime=None)
         self.read_only_mode = True if mode == "read_only" else False
+        self.command_queue = CommandQueue(COMMAND_COALESCE_KEYS, PRIORITY_COMMANDS)
+
+        config = toml.load(f'{os.path.dirname(__file__)}/../config/config_python_modules.toml')
+        if config["write_verification"]["enabled"]:
+            self.enable_write_verification(config)
         # self.set_sleep_time()
 
     def start_loop(self):
 
         while True:
-            now = time.time()
-            if now > self.time_last_heartbeat + self.get_heartbeat_period():
-                self.send_heartbeat()
-                self.set_time_last_heartbeat(now)
-
+            self.keep_alive()
             self.listen()
+            self.verify_writes()
             self.sleep()
             # print(self.state)
 
@@ -51,6 +76,9 @@ class Statcom(Edge_device):
     def get_config(self):
         return self.config
 
+    def get_register_map(self):
+        return self.register_map
+
     def handle_command(self, command_data: str):
         command_dict: CommandMessage = RedisEncoderDecoder.decode_command(command_data)
         command = command_dict.command_key_word
@@ -61,6 +89,35 @@ class Statcom(Edge_device):
         logger.debug(f"COMMAND RECIEVED: '{self.get_module_name()}' program receiving command '{command}'")
         #TODO: ERROR
 
+        # Commands are run in batches by process_command_queue() so a burst
+        # of setpoints only results in one write and one read
+        if self.command_queue.put(command_dict):
+            logger.debug(f"COMMAND: '{command}' superseded a queued command.")
+
+    def process_command_queue(self):
+        """
+        Runs the queued commands. Without write verification the statcom is
+        then read once to verify them, with it the writes are verified by the
+        following polls.
+        """
+        batch = self.command_queue.get_batch()
+        commands_run = 0
+        for command_dict in batch:
+            # A bad command must not lose the rest of the batch
+            try:
+                self.execute_command(command_dict)
+                commands_run += 1
+            except Exception as e:
+                self.command_queue.record_failure()
+                logger.warning(f"COMMAND: '{command_dict.command_key_word}' with settings {command_dict.settings} failed: {e}")
+
+        if commands_run and self.write_verifier is None:
+            self.update()
+
+    def execute_command(self, command_dict: CommandMessage):
+        command = command_dict.command_key_word
+        settings = command_dict.settings
+
         if command == "start":
             self.start()
         elif command == "stop":
@@ -97,82 +154,64 @@ class Statcom(Edge_device):
             # print("Command not recognised.") #TODO: ERROR
             logger.warning("COMMAND: Command not recognised.")
 
-        self.update()
 
-
-    def write_modbus(self, register_blocks):
-        function_codes = []
-
-        for start_register, register_values in register_blocks:
-            response = self.client.write_registers(start_register, register_values, unit=self.get_unit_id())
-
-            function_codes.append(response.function_code)
-
-        return function_codes
+    def _write_setpoint(self, address, values):
+        """
+        Writes the setpoint registers and records the values for write
+        verification.
+        """
+        self.client.write_registers(address, values, unit=self.get_unit_id())
+        if self.write_verifier is not None:
+            self.write_verifier.expect(address, values, time.time())
 
     def start(self):
-        self.client.write_registers(1050, [1], unit=self.get_unit_id()) # verified new statcom registers
+        self._write_setpoint(1050, [1]) # verified new statcom registers
 
     def stop(self):
-        self.client.write_registers(1050, [0], unit=self.get_unit_id()) # verified new statcom registers
+        self._write_setpoint(1050, [0]) # verified new statcom registers
 
     def set_power(self, power): 
-        target = power
-        if target < 0:
-            target += 65536
-        target = [int(target)]*3
-        self.client.write_registers(1000, target, unit=self.get_unit_id()) # verified new statcom registers
+        # One Set_Power register per phase
+        self._write_setpoint(*self.register_values.encode("Set_Power", [power]*3)) # verified new statcom registers
     
     def set_power_multiple_phases(self, power_1, power_2, power_3):
         print(power_1, power_2, power_3)
         
-        if power_1 < 0:
-            power_1 += 65536
-        
-        if power_2 < 0:
-            power_2 += 65536
-        
-        if power_3 < 0:
-            power_3 += 65536
-
         if self.new_version:
-            self.client.write_registers(1000, [power_1, power_2, power_3], unit=self.get_unit_id())
+            self._write_setpoint(*self.register_values.encode("Set_Power", [power_1, power_2, power_3]))
         else:
-            self.client.write_registers(1000, [power_3, power_1, power_2], unit=self.get_unit_id())
+            self._write_setpoint(*self.register_values.encode("Set_Power", [power_3, power_1, power_2]))
 
     # def get_state(self):
     #     return statcom_state_lookup[self.state[2046]]
 
     def set_mode_voltage(self):
-        self.client.write_registers(1055, [1], unit=self.get_unit_id()) # verified new statcom registers
+        self._write_setpoint(1055, [1]) # verified new statcom registers
 
     def set_mode_current(self):
-        self.client.write_registers(1055, [0], unit=self.get_unit_id()) # verified new statcom registers
+        self._write_setpoint(1055, [0]) # verified new statcom registers
 
     def set_drm_enable(self,): # verified new statcom registers
-        self.client.write_registers(1048, [1], unit=self.get_unit_id()) #TODO(ed): check the correct register 
+        self._write_setpoint(1048, [1]) #TODO(ed): check the correct register 
 
     def set_drm_disable(self,): # verified new statcom registers
-        self.client.write_registers(1048, [0], unit=self.get_unit_id()) #TODO(ed): check the correct register
+        self._write_setpoint(1048, [0]) #TODO(ed): check the correct register
 
     def set_ac_reactive_power_zero(self):
-        self.client.write_registers(1054, [0], unit=self.get_unit_id())
+        self._write_setpoint(1054, [0])
         
     def set_ac_reactive_power_manual_mode(self):
-        self.client.write_registers(1054, [1], unit=self.get_unit_id())
+        self._write_setpoint(1054, [1])
         
     def set_ac_reactive_power_volt_mode(self):
-        self.client.write_registers(1054, [2], unit=self.get_unit_id())
+        self._write_setpoint(1054, [2])
         
     def set_reactive_power(self, power):
-        target = power
-        if target < 0:
-            target += 65536
-        target = [int(target)]*3
+        target = encode_values([power]*3, "h")
             
-        self.client.write_registers(1004, target, unit=self.get_unit_id())
-        self.client.write_registers(1005, target, unit=self.get_unit_id())
-        self.client.write_registers(1006, target, unit=self.get_unit_id())
+        self._write_setpoint(1004, target)
+        self._write_setpoint(1005, target)
+        self._write_setpoint(1006, target)
 
 if __name__ == "__main__":
     
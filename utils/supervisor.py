@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Supervisor used to launch the device workers listed in the [devices] config,
+pin each one to a CPU core and restart the workers that die or go silent.
+
+Each [[devices.<name>]] entry is launched as its own process running the
+entry's type (e.g. "meter_satec_child" or "statcom_child") from this directory,
+with the module name "<name>_<n>" for the n-th entry of that name and the
+entry's config as the positional arguments the worker's __main__ expects.
+Entries whose worker module is not in this directory are skipped with a
+warning, so a config listing devices this box doesn't run still starts the
+rest.
+
+Devices on one serial port or behind one gateway must run in one process to
+share its bus arbiter, so entries of the same type with a "serial" or
+"gateway" transport and the same host and port are grouped into one worker,
+given comma separated module names and unit ids, e.g.
+    meter_grid_1,meter_load_1 /dev/ttyUSB0 19200 1,2 serial
+
+Workers are pinned round robin to the CPU cores in [supervisor] cpus, or to
+all the cores the supervisor may run on if the list is empty. The core is set
+in the child before it runs the worker, so the worker never runs unpinned.
+
+The supervisor subscribes to the heartbeat topics. A worker that has exited,
+or that has not sent a heartbeat for heartbeat_timeout (after startup_grace
+from its start, to allow for connecting), is stopped and started again. A
+grouped worker is alive while any of its modules sends heartbeats. Each
+restart in a row waits twice as long as the previous one, from
+initial_backoff up to max_backoff, and the backoff is reset once a worker has
+been running for stable_time. While redis is unavailable the workers can't
+send heartbeats, so only exited workers are restarted.
+
+Every start and stop is logged and published on the subprocess log topic with
+RedisEncoderDecoder.encode_subprocess_log_for_database().
+
+Usage:
+    python supervisor.py
+"""
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import toml
+import redis
+
+import db_logger
+import redis_custom_library as redis_lib
+from pubsub_topic_encoder_decoder import PubSubTopicEncoderDecoder as psted
+from redis_message_structures import RedisEncoderDecoder
+from topic_router import TopicRouter
+
+LOGGER_LEVEL = logging.INFO
+
+logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL, queued=True)
+logger = logger_setup.get_logger()
+
+CONFIG_FILE = f'{os.path.dirname(__file__)}/../config/config_python_modules.toml'
+WORKER_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REDIS_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+# Config keys passed to each worker type, in the order of its arguments after
+# the module name. Trailing keys missing from a device config are left out, so
+# the worker uses its default.
+WORKER_ARGUMENTS = {
+    "meter_satec_child": ("host", "port", "unit", "transport"),
+    "statcom_child": ("host", "port", "unit", "mode", "version"),
+}
+DEFAULT_WORKER_ARGUMENTS = ("host", "port", "unit")
+# Transports whose devices share a bus, so run in one worker
+SHARED_TRANSPORTS = ("serial", "gateway")
+
+STARTING = True
+KILLING = False
+
+
+def get_worker_arguments(worker_type: str, device_config: dict) -> list:
+    args = []
+    for key in WORKER_ARGUMENTS.get(worker_type, DEFAULT_WORKER_ARGUMENTS):
+        if key not in device_config:
+            break
+        args.append(str(device_config[key]))
+    return args
+
+
+def get_worker_groups(devices_config: dict) -> list:
+    """
+    Returns (module names, worker type, worker config) for each worker of the
+    [devices] config. Entries sharing a bus are grouped, with their unit ids
+    comma separated in the worker config.
+    """
+    groups = {}
+    for device_name, entries in devices_config.items():
+        for index, entry in enumerate(entries):
+            module_name = f"{device_name}_{index + 1}"
+            device_config = entry["config"]
+            key = module_name
+            if device_config.get("transport") in SHARED_TRANSPORTS:
+                key = (entry["type"], device_config["transport"], device_config.get("host"), device_config.get("port"))
+            if key not in groups:
+                groups[key] = ([module_name], entry["type"], dict(device_config))
+                continue
+            module_names, _, worker_config = groups[key]
+            module_names.append(module_name)
+            worker_config["unit"] = f"{worker_config['unit']},{device_config['unit']}"
+    return list(groups.values())
+
+
+def get_available_cpus() -> list:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ProcessConnection():
+    def __init__(self, module_name: str, worker_type: str, args: list, cpu: int = None) -> None:
+        """
+        module_name is comma separated for a worker running several devices.
+        """
+        self.module_name = module_name
+        self.module_names = module_name.split(",")
+        self.worker_type = worker_type
+        self.args = args
+        self.cpu = cpu
+
+        self.process = None
+        self.process_id = None
+        self.time_started = None
+        self.time_last_heartbeat = None
+        self.time_next_start = 0
+
+        self.starts = 0
+        self.restarts = 0
+        # Restarts since the worker last ran for stable_time
+        self.failures = 0
+
+    def get_command(self) -> list:
+        return [sys.executable, f"{WORKER_DIRECTORY}/{self.worker_type}.py", self.module_name] + self.args
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def pin_cpu(self):
+        # Runs in the child between fork and exec
+        os.sched_setaffinity(0, {self.cpu})
+
+    def start(self, now: float):
+        preexec_fn = None
+        if self.cpu is not None and hasattr(os, "sched_setaffinity"):
+            preexec_fn = self.pin_cpu
+        try:
+            self.process = subprocess.Popen(self.get_command(), cwd=WORKER_DIRECTORY, preexec_fn=preexec_fn)
+        except subprocess.SubprocessError as e:
+            if preexec_fn is None:
+                raise
+            logger.warning(f"SUPERVISOR: {self.module_name}: failed to pin to cpu {self.cpu}, starting unpinned: {e}")
+            self.process = subprocess.Popen(self.get_command(), cwd=WORKER_DIRECTORY)
+        self.process_id = self.process.pid
+        self.time_started = now
+        self.time_last_heartbeat = None
+        self.starts += 1
+
+    def stop(self, timeout: float):
+        """
+        Terminates the worker, killing it if it hasn't exited within timeout.
+        Returns the exit code.
+        """
+        if self.is_running():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        return self.process.returncode
+
+    def get_stats(self, now: float) -> dict:
+        return {
+            "pid": self.process_id,
+            "cpu": self.cpu,
+            "running": self.is_running(),
+            "starts": self.starts,
+            "restarts": self.restarts,
+            "uptime": now - self.time_started if self.is_running() else 0,
+            "time_since_heartbeat": None if self.time_last_heartbeat is None else now - self.time_last_heartbeat,
+        }
+
+
+class Supervisor():
+    def __init__(self, config: dict = None) -> None:
+        if config is None:
+            config = toml.load(CONFIG_FILE)
+        supervisor_config = config["supervisor"]
+        self.heartbeat_timeout = supervisor_config["heartbeat_timeout"]
+        self.startup_grace = supervisor_config["startup_grace"]
+        self.check_period = supervisor_config["check_period"]
+        self.initial_backoff = supervisor_config["initial_backoff"]
+        self.max_backoff = supervisor_config["max_backoff"]
+        self.stable_time = supervisor_config["stable_time"]
+        self.stop_timeout = supervisor_config["stop_timeout"]
+        self.redis_reconnect_period = config["spool"]["reconnect_period"]
+        cpus = supervisor_config["cpus"] or get_available_cpus()
+
+        # worker module name -> ProcessConnection
+        self.workers = {}
+        # module name of each device -> ProcessConnection running it
+        self.module_workers = {}
+        for module_names, worker_type, worker_config in get_worker_groups(config["devices"]):
+            module_name = ",".join(module_names)
+            if not os.path.isfile(f"{WORKER_DIRECTORY}/{worker_type}.py"):
+                logger.warning(f"SUPERVISOR: {module_name}: no worker module '{worker_type}', skipping.")
+                continue
+            worker = ProcessConnection(
+                module_name,
+                worker_type,
+                get_worker_arguments(worker_type, worker_config),
+                cpus[len(self.workers) % len(cpus)])
+            self.workers[module_name] = worker
+            for name in module_names:
+                self.module_workers[name] = worker
+
+        self.redis_server = None
+        self.subscriber = None
+        self.redis_connected = False
+        self.time_last_redis_attempt = 0
+        self.router = TopicRouter()
+        self.router.add_route(psted.get_heartbeat_pattern(), self.handle_heartbeat)
+        self.subprocess_log_topic = psted.encode_subprocess_log_topic()
+
+    def get_workers(self) -> dict:
+        return self.workers
+
+    def get_stats(self) -> dict:
+        now = time.time()
+        return {module_name: worker.get_stats(now) for module_name, worker in self.workers.items()}
+
+    def get_backoff(self, failures: int) -> float:
+        return min(self.max_backoff, self.initial_backoff * 2 ** failures)
+
+    def handle_heartbeat(self, channel: str, data: str):
+        worker = self.module_workers.get(psted.decode_heartbeat(channel)["module_name"])
+        if worker is not None:
+            worker.time_last_heartbeat = time.time()
+
+    def connect_redis(self, now: float):
+        self.time_last_redis_attempt = now
+        try:
+            self.redis_server = redis_lib.connect_to_running_redis_server()
+            self.subscriber = self.redis_server.pubsub(ignore_subscribe_messages=True)
+            self.subscriber.psubscribe(*self.router.get_patterns())
+            self.redis_connected = True
+            # Heartbeats sent while disconnected were missed, the timeouts
+            # start again from now
+            for worker in self.workers.values():
+                if worker.is_running():
+                    worker.time_last_heartbeat = now
+            logger.info("SUPERVISOR: connected to redis.")
+        except REDIS_ERRORS as e:
+            self.redis_connected = False
+            logger.warning(f"SUPERVISOR: redis unavailable, only restarting exited workers: {e}")
+
+    def publish_subprocess_log(self, worker: ProcessConnection, starting_flag: bool):
+        subprocess_log = RedisEncoderDecoder.encode_subprocess_log_for_database(worker, starting_flag)
+        if not self.redis_connected:
+            return
+        try:
+            self.redis_server.publish(
+                self.subprocess_log_topic,
+                RedisEncoderDecoder.encode_json_with_date(subprocess_log))
+        except REDIS_ERRORS:
+            self.redis_connected = False
+
+    def start_worker(self, worker: ProcessConnection, now: float):
+        worker.start(now)
+        logger.info(f"SUPERVISOR: started {worker.module_name} (pid {worker.process_id}, cpu {worker.cpu}): {' '.join(worker.args)}")
+        self.publish_subprocess_log(worker, STARTING)
+
+    def stop_worker(self, worker: ProcessConnection, reason: str):
+        return_code = worker.stop(self.stop_timeout)
+        logger.warning(f"SUPERVISOR: stopped {worker.module_name} (pid {worker.process_id}, exit code {return_code}): {reason}")
+        self.publish_subprocess_log(worker, KILLING)
+
+    def restart_worker(self, worker: ProcessConnection, now: float, reason: str):
+        """
+        Stops the worker and schedules its next start after the backoff.
+        """
+        self.stop_worker(worker, reason)
+        if now - worker.time_started >= self.stable_time:
+            worker.failures = 0
+        backoff = self.get_backoff(worker.failures)
+        worker.failures += 1
+        worker.restarts += 1
+        worker.time_next_start = now + backoff
+        logger.info(f"SUPERVISOR: restarting {worker.module_name} in {backoff:.1f}s.")
+
+    def check_worker(self, worker: ProcessConnection, now: float):
+        if worker.process is None or worker.time_next_start > worker.time_started:
+            # Not started yet, or waiting out a restart backoff
+            if now >= worker.time_next_start:
+                self.start_worker(worker, now)
+            return
+
+        if not worker.is_running():
+            self.restart_worker(worker, now, "exited")
+            return
+
+        if not self.redis_connected:
+            return
+        time_last_alive = worker.time_started + self.startup_grace
+        if worker.time_last_heartbeat is not None:
+            time_last_alive = max(time_last_alive, worker.time_last_heartbeat)
+        if now - time_last_alive > self.heartbeat_timeout:
+            self.restart_worker(worker, now, f"no heartbeat for {now - time_last_alive:.1f}s")
+
+    def check_workers(self, now: float):
+        for worker in self.workers.values():
+            self.check_worker(worker, now)
+
+    def receive_heartbeats(self, timeout: float):
+        if not self.redis_connected:
+            time.sleep(timeout)
+            return
+
+        time_end = time.time() + timeout
+        try:
+            while True:
+                message = self.subscriber.get_message(timeout=max(0, time_end - time.time()))
+                if message is not None:
+                    self.router.dispatch(message)
+                if time.time() >= time_end:
+                    return
+        except REDIS_ERRORS as e:
+            self.redis_connected = False
+            logger.warning(f"SUPERVISOR: lost connection to redis: {e}")
+
+    def stop_all(self):
+        for worker in self.workers.values():
+            if worker.is_running():
+                self.stop_worker(worker, "supervisor stopping")
+
+    def start(self):
+        # Stop the workers with the supervisor
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                now = time.time()
+                if not self.redis_connected and now >= self.time_last_redis_attempt + self.redis_reconnect_period:
+                    self.connect_redis(now)
+                self.check_workers(now)
+                self.receive_heartbeats(self.check_period)
+        finally:
+            self.stop_all()
+
+
+if __name__ == "__main__":
+    supervisor = Supervisor()
+    supervisor.start()
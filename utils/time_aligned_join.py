@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+TimeAlignedJoin used to line up chosen fields of several devices at a common
+time, e.g. the grid meter's kW against the Statcom's export power.
+
+Each device keeps a short buffer of its recent readings, as a sorted list of
+reading times and one list of values per chosen field. get_vector() looks up
+any time in each buffer with bisect, O(log n) in the buffer length, and
+returns one value per (device, field) column:
+    - between two readings the value is linearly interpolated
+    - after the last reading the last value is held for up to hold_time
+    - None if the nearest readings are more than max_gap seconds away, so a
+      device that stopped reporting doesn't hold a stale value, or if the
+      time is before the buffer
+
+Devices reporting by exception publish nothing while their values stay within
+their deadbands, up to the keyframe period, so a quiet device isn't stale.
+from_config() sets hold_time to the keyframe period when report by exception
+is on: a value is held until the next reading, or for hold_time after the last
+one.
+
+Readings are taken from the device readings topics. drain() handles every
+message already waiting on a subscriber and returns without blocking, so a
+controller can call it once per control cycle instead of polling for the
+current message with redis_custom_library.get_current_message(). A
+controller replaces its get_current_message() loop with drain() followed by
+get_vector(time.time()), or get() for a single field. Readings can also be
+added directly with add_reading().
+
+Report by exception delta readings only carry the fields that changed, the
+other fields are still within their deadband, so their values in the reading
+just before the delta are carried forward to the delta's time.
+
+Usage:
+    python time_aligned_join.py [buffer length]    # lookup benchmark
+"""
+import bisect
+import logging
+import os
+import time
+import toml
+
+import db_logger
+import redis_custom_library as redis_lib
+from pubsub_topic_encoder_decoder import PubSubTopicEncoderDecoder as psted
+from redis_message_structures import RedisEncoderDecoder
+from report_by_exception import decode_delta_reading_type, is_delta_reading_type
+from topic_router import TopicRouter
+
+LOGGER_LEVEL = logging.INFO
+
+logger_setup = db_logger.DBLogger(os.path.basename(__file__), LOGGER_LEVEL, queued=True)
+logger = logger_setup.get_logger()
+
+CONFIG_FILE = f'{os.path.dirname(__file__)}/../config/config_python_modules.toml'
+
+
+def interpolate(time_before: float, value_before, time_after: float, value_after, at_time: float):
+    """
+    Returns the value at at_time on the line between two readings. Values that
+    aren't numbers are not interpolated, the earlier value is returned.
+    """
+    if time_after == time_before or isinstance(value_before, bool) or not isinstance(value_before, (int, float)) \
+            or not isinstance(value_after, (int, float)):
+        return value_before
+    fraction = (at_time - time_before) / (time_after - time_before)
+    return value_before + fraction * (value_after - value_before)
+
+
+class DeviceBuffer():
+    def __init__(self, fields: list, buffer_time: float) -> None:
+        self.fields = fields
+        self.buffer_time = buffer_time
+        self.times = []
+        self.values = {field: [] for field in fields}
+        # Readings before start have expired, they are removed in one slice
+        # once they are half of the buffer
+        self.start = 0
+
+    def __len__(self):
+        return len(self.times) - self.start
+
+    def get_last_values(self) -> dict:
+        if not len(self):
+            return {}
+        return {field: values[-1] for field, values in self.values.items()}
+
+    def get_values_before(self, timestamp: float):
+        """
+        Returns the values of the last reading at or before timestamp, or None
+        if there is none in the buffer.
+        """
+        index = bisect.bisect_right(self.times, timestamp, lo=self.start)
+        if index == self.start:
+            return None
+        return {field: values[index - 1] for field, values in self.values.items()}
+
+    def add(self, timestamp: float, reading: dict):
+        """
+        Adds the chosen fields of a reading, fields missing from it are None.
+        Readings are normally received in order, a late reading is inserted at
+        its place.
+        """
+        if not self.times or timestamp >= self.times[-1]:
+            index = len(self.times)
+        else:
+            index = bisect.bisect_right(self.times, timestamp, lo=self.start)
+            if index == self.start and self.start > 0:
+                # Older than the buffer
+                return
+        self.times.insert(index, timestamp)
+        for field, values in self.values.items():
+            values.insert(index, reading.get(field))
+        self.expire(self.times[-1] - self.buffer_time)
+
+    def expire(self, oldest_time: float):
+        # Keep the last reading before oldest_time, to interpolate from
+        self.start = max(self.start, bisect.bisect_left(self.times, oldest_time, lo=self.start) - 1)
+        if self.start > len(self.times) // 2:
+            del self.times[:self.start]
+            for values in self.values.values():
+                del values[:self.start]
+            self.start = 0
+
+    def get(self, field: str, at_time: float, max_gap: float, hold_time: float = None):
+        """
+        Returns the value of a field at at_time, or None if there is no reading
+        within max_gap of it. The value of a reading is held for up to
+        hold_time, which defaults to max_gap.
+        """
+        if hold_time is None:
+            hold_time = max_gap
+        index = bisect.bisect_right(self.times, at_time, lo=self.start)
+        if index == self.start:
+            return None
+
+        values = self.values[field]
+        time_before = self.times[index - 1]
+        if index == len(self.times):
+            if at_time - time_before > hold_time:
+                return None
+            return values[index - 1]
+
+        time_after = self.times[index]
+        value_before = values[index - 1]
+        value_after = values[index]
+        if time_after - time_before > max_gap and at_time - time_before <= hold_time:
+            # Readings further apart than max_gap but within the hold time,
+            # the value didn't change enough to be reported in between
+            return value_before
+        if time_after - time_before > max_gap or value_before is None or value_after is None:
+            # Too far apart to interpolate, use the nearest reading if it is
+            # close enough
+            if at_time - time_before <= time_after - at_time:
+                nearest_time, nearest_value = time_before, value_before
+            else:
+                nearest_time, nearest_value = time_after, value_after
+            if abs(nearest_time - at_time) > max_gap:
+                return None
+            return nearest_value
+        return interpolate(time_before, value_before, time_after, value_after, at_time)
+
+
+class TimeAlignedJoin():
+    def __init__(
+        self,
+        fields: dict,
+        reading_type: str = "basic",
+        buffer_time: float = 10.0,
+        max_gap: float = 1.0,
+        hold_time: float = None,
+    ) -> None:
+        """
+        fields maps a device name, as in its readings topic (e.g.
+        "meter_grid_1"), to the list of its fields to join. Readings older
+        than buffer_time seconds before a device's latest reading are dropped.
+        hold_time defaults to max_gap.
+        """
+        self.reading_type = reading_type
+        self.max_gap = max_gap
+        self.hold_time = max_gap if hold_time is None else hold_time
+        self.buffers = {device_name: DeviceBuffer(list(device_fields), buffer_time) for device_name, device_fields in fields.items()}
+        self.columns = [(device_name, field) for device_name, device_fields in fields.items() for field in device_fields]
+
+        self.readings_received = 0
+        self.readings_dropped = 0
+
+        self.router = TopicRouter()
+        self.router.add_route(psted.get_readings_topic_pattern(), self.handle_reading)
+
+    @classmethod
+    def from_config(cls, fields: dict, config: dict = None, **kwargs):
+        """
+        Returns a join holding values for the keyframe period when the devices
+        report by exception, as set in config_python_modules.toml. The buffer
+        then covers at least two keyframes.
+        """
+        if config is None:
+            config = toml.load(CONFIG_FILE)
+        ipc_config = config["ipc-parameters"]
+        if ipc_config["report_by_exception"]:
+            keyframe_period = 1 / ipc_config["slow_reporting_frequency"]
+            kwargs.setdefault("hold_time", keyframe_period)
+            kwargs["buffer_time"] = max(kwargs.get("buffer_time", 10.0), 2 * keyframe_period)
+        return cls(fields, **kwargs)
+
+    def get_columns(self) -> list:
+        """
+        Returns the (device name, field) of each value of get_vector().
+        """
+        return self.columns
+
+    def get_buffer(self, device_name: str) -> DeviceBuffer:
+        return self.buffers[device_name]
+
+    def get_stats(self):
+        return {
+            "readings_received": self.readings_received,
+            "readings_dropped": self.readings_dropped,
+            "buffered_readings": {device_name: len(buffer) for device_name, buffer in self.buffers.items()},
+        }
+
+    def add_reading(self, device_name: str, timestamp: float, reading: dict, is_delta: bool = False):
+        buffer = self.buffers.get(device_name)
+        if buffer is None:
+            return
+        if is_delta:
+            # A delta applies to the reading before it, which isn't the last
+            # buffered one when it arrives late
+            values_before = buffer.get_values_before(timestamp)
+            if values_before is None:
+                # A delta can only be applied once a full reading before it is
+                # buffered
+                self.readings_dropped += 1
+                return
+            reading = dict(values_before, **reading)
+        buffer.add(timestamp, reading)
+        self.readings_received += 1
+
+    def handle_reading(self, channel: str, data: str):
+        topic = psted.decode_readings_topic(channel)
+        if topic["device_name"] not in self.buffers or decode_delta_reading_type(topic["reading_type"]) != self.reading_type:
+            return
+        reading = RedisEncoderDecoder.decode_reading(data)
+        self.add_reading(
+            topic["device_name"],
+            reading["datetime"].timestamp(),
+            reading,
+            is_delta_reading_type(topic["reading_type"]))
+
+    def subscribe(self, subscriber):
+        """
+        Subscribes a redis pubsub to the readings topics, for drain().
+        """
+        subscriber.psubscribe(*self.router.get_patterns())
+
+    def drain(self, subscriber) -> int:
+        """
+        Adds the readings of every message waiting on the subscriber, without
+        waiting for more. Returns the number of messages handled.
+        """
+        handled = 0
+        while True:
+            message = subscriber.get_message()
+            if message is None:
+                return handled
+            try:
+                self.router.dispatch(message)
+            except Exception as e:
+                logger.warning(f"TIME ALIGNED JOIN: failed to handle message on '{redis_lib.get_channel(message)}': {e}")
+            handled += 1
+
+    def get(self, device_name: str, field: str, at_time: float):
+        return self.buffers[device_name].get(field, at_time, self.max_gap, self.hold_time)
+
+    def get_vector(self, at_time: float) -> list:
+        """
+        Returns the value of every column at at_time, None where a device has
+        no reading within max_gap.
+        """
+        return [self.buffers[device_name].get(field, at_time, self.max_gap, self.hold_time) for device_name, field in self.columns]
+
+    def get_latest_common_time(self):
+        """
+        Returns the latest time every device has a reading at or after, so
+        get_vector() at it interpolates rather than holds values, or None if a
+        device has no readings.
+        """
+        if any(not len(buffer) for buffer in self.buffers.values()):
+            return None
+        return min(buffer.times[-1] for buffer in self.buffers.values())
+
+
+def get_linear_scan(times: list, values: list, at_time: float):
+    """
+    Returns the interpolated value at at_time by scanning the readings in
+    order, used as the reference for the benchmark.
+    """
+    for index in range(1, len(times)):
+        if times[index] > at_time:
+            return interpolate(times[index - 1], values[index - 1], times[index], values[index], at_time)
+    return values[-1]
+
+
+if __name__ == "__main__":
+    import random
+    import sys
+
+    n_readings = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_lookups = 20000
+    period = 0.1
+
+    join = TimeAlignedJoin(
+        {"meter_grid_1": ["kW_1", "kW_2", "kW_3"], "statcom_1": ["Export_Meter_kW_1"]},
+        buffer_time=n_readings * period,
+        max_gap=2 * period)
+    # The devices poll at the same rate but out of phase
+    for index in range(n_readings):
+        join.add_reading("meter_grid_1", index * period, {"kW_1": index, "kW_2": 2 * index, "kW_3": 3 * index})
+        join.add_reading("statcom_1", index * period + 0.03, {"Export_Meter_kW_1": -index})
+
+    rng = random.Random(0)
+    lookup_times = [rng.uniform(0.03, (n_readings - 1) * period) for _ in range(n_lookups)]
+
+    buffer = join.get_buffer("meter_grid_1")
+    for at_time in lookup_times[:100]:
+        assert abs(join.get("meter_grid_1", "kW_1", at_time) - get_linear_scan(buffer.times, buffer.values["kW_1"], at_time)) < 1e-9
+
+    start = time.perf_counter()
+    for at_time in lookup_times:
+        get_linear_scan(buffer.times, buffer.values["kW_1"], at_time)
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for at_time in lookup_times:
+        join.get("meter_grid_1", "kW_1", at_time)
+    bisect_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for at_time in lookup_times:
+        join.get_vector(at_time)
+    vector_time = time.perf_counter() - start
+
+    print(f"{n_readings} buffered readings per device, {n_lookups} lookups")
+    print(f"    linear scan:  {scan_time / n_lookups * 1e6:8.2f} us/lookup")
+    print(f"    bisect:       {bisect_time / n_lookups * 1e6:8.2f} us/lookup")
+    print(f"    get_vector(): {vector_time / n_lookups * 1e6:8.2f} us/vector of {len(join.get_columns())} columns")
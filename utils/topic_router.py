@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+TopicRouter used to dispatch redis pubsub messages to handlers by topic.
+
+Routes are added with the same glob patterns that are passed to psubscribe(),
+e.g. "device/*/*/readings/*" or "state/query/*". Each pattern is compiled once
+into a trie with one level per topic segment, where "*" matches exactly one
+segment. This matches redis for the topic naming used in
+PubSubTopicEncoderDecoder, where wildcards always span a whole segment.
+
+Dispatching a message takes the fastest path available:
+    1. pmessages carry the pattern they matched, which is looked up directly
+       in a dict of the registered patterns
+    2. otherwise the channel is looked up in a cache of previously routed
+       channels
+    3. otherwise the channel is matched against the trie and the result is
+       cached
+
+Handlers are called as handler(channel, data) with the channel and data
+decoded to str.
+"""
+import time
+
+TOPIC_SEPARATOR = "/"
+TOPIC_WILDCARD = "*"
+# Channels are mostly a fixed set of device topics, the cache is only cleared
+# if something publishes on a very large number of distinct channels
+CHANNEL_CACHE_SIZE = 4096
+
+_HANDLER = None
+
+
+class TopicRouter():
+    def __init__(self) -> None:
+        self._trie = {}
+        self._pattern_handlers = {}
+        self._channel_handlers = {}
+
+    def add_route(self, pattern: str, handler):
+        """
+        Routes the messages on channels matching pattern to handler. Adding a
+        pattern again replaces its handler.
+        """
+        node = self._trie
+        for segment in pattern.split(TOPIC_SEPARATOR):
+            node = node.setdefault(segment, {})
+        node[_HANDLER] = handler
+
+        self._pattern_handlers[pattern.encode("utf-8")] = handler
+        self._channel_handlers = {}
+
+    def get_patterns(self) -> list:
+        return [pattern.decode("utf-8") for pattern in self._pattern_handlers.keys()]
+
+    def match(self, channel: str):
+        """
+        Returns the handler for channel, or None if no route matches. Literal
+        segments take precedence over wildcards.
+        """
+        try:
+            return self._channel_handlers[channel]
+        except KeyError:
+            pass
+
+        handler = self._match_segments(self._trie, channel.split(TOPIC_SEPARATOR), 0)
+        if len(self._channel_handlers) >= CHANNEL_CACHE_SIZE:
+            self._channel_handlers = {}
+        self._channel_handlers[channel] = handler
+        return handler
+
+    def _match_segments(self, node: dict, segments: list, index: int):
+        if index == len(segments):
+            return node.get(_HANDLER)
+
+        for key in (segments[index], TOPIC_WILDCARD):
+            child = node.get(key)
+            if child is not None:
+                handler = self._match_segments(child, segments, index + 1)
+                if handler is not None:
+                    return handler
+        return None
+
+    def dispatch(self, message) -> bool:
+        """
+        Calls the handler for a redis pubsub message. Returns False if the
+        message is not a published message or no route matches it.
+        """
+        if message is None or message["type"] not in ("message", "pmessage"):
+            return False
+
+        handler = None
+        if message["pattern"] is not None:
+            handler = self._pattern_handlers.get(message["pattern"])
+
+        channel = message["channel"].decode("utf-8")
+        if handler is None:
+            handler = self.match(channel)
+            if handler is None:
+                return False
+
+        handler(channel, message["data"].decode("utf-8"))
+        return True
+
+
+if __name__ == "__main__":
+    # Compares routing through the router with decoding and comparing the
+    # channel of every message
+    from pubsub_topic_encoder_decoder import PubSubTopicEncoderDecoder as psted
+
+    readings_pattern = psted.get_readings_topic_pattern()
+    query_pattern = psted.get_state_query_topic_pattern()
+    handled = []
+
+    router = TopicRouter()
+    router.add_route(readings_pattern, lambda channel, data: handled.append(psted.decode_readings_topic(channel)))
+    router.add_route(query_pattern, lambda channel, data: handled.append(psted.decode_state_query_topic(channel)))
+
+    messages = [
+        {
+            "type": "pmessage",
+            "pattern": readings_pattern.encode("utf-8"),
+            "channel": psted.encode_readings_topic(f"meter_grid_{device}", device, "basic").encode("utf-8"),
+            "data": b"{}",
+        }
+        for device in range(20)]
+    iterations = 10000
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            router.dispatch(message)
+    duration = time.perf_counter() - start
+    print(f"pattern dispatch: {iterations * len(messages) / duration:10.0f} messages/s")
+
+    for message in messages:
+        message["pattern"] = None
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            router.dispatch(message)
+    duration = time.perf_counter() - start
+    print(f"channel dispatch: {iterations * len(messages) / duration:10.0f} messages/s")
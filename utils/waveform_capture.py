@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+WaveformCapture used to read a waveform from a Satec meter without stalling the
+normal poll loop.
+
+A capture is the sequence:
+    1. write the begin/end register block to freeze the waveform buffer
+    2. for each channel row, write the row select block then read the row
+    3. write the begin/end register block again to release the buffer
+
+Rather than running the whole sequence at once, step() performs one stage
+(a write plus one batched row read) each time it is called, so the device loop
+can call it between normal polls. The raw rows are kept in a preallocated
+(channels, row_size) uint16 array and decoded for all channels at once when
+the capture completes.
+
+If a stage fails, the caller abandons the capture with reset() and publishes a
+CAPTURE_FAILED_EVENT, the meter releases the frozen buffer itself after its
+timeout.
+
+Each raw row holds a 33 register header followed by the samples. Header
+register 27 is the channel offset (int16), 28/29 the channel multiplier
+(low/high words) and 30 the channel divisor.
+"""
+import os
+import numpy as np
+from datetime import datetime, timezone
+
+ROW_HEADER_SIZE = 33
+ROW_OFFSET_INDEX = 27
+ROW_MULTIPLIER_LOW_INDEX = 28
+ROW_MULTIPLIER_HIGH_INDEX = 29
+ROW_DIVISOR_INDEX = 30
+
+WAVEFORM_SINK_DISK = "disk"
+WAVEFORM_SINK_REDIS = "redis"
+WAVEFORM_DIRECTORY = f"{os.path.dirname(__file__)}/../waveforms/"
+CAPTURE_FAILED_EVENT = "waveform_capture_failed"
+
+
+def decode_waveform(raw_rows, scalars) -> np.ndarray:
+    """
+    Decodes the raw rows of a capture, one row per channel, into a
+    (channels, samples) float64 array of scaled values.
+    """
+    raw_rows = np.asarray(raw_rows, dtype=np.uint16)
+
+    offsets = raw_rows[:, ROW_OFFSET_INDEX].view(np.int16).astype(np.float64)
+    multipliers = (raw_rows[:, ROW_MULTIPLIER_LOW_INDEX].astype(np.float64)
+                   + 65536 * raw_rows[:, ROW_MULTIPLIER_HIGH_INDEX].astype(np.float64))
+    divisors = raw_rows[:, ROW_DIVISOR_INDEX].astype(np.float64)
+    gains = multipliers / divisors * np.asarray(scalars, dtype=np.float64)
+
+    samples = raw_rows[:, ROW_HEADER_SIZE:].view(np.int16).astype(np.float64)
+    return (samples - offsets[:, np.newaxis]) * gains[:, np.newaxis]
+
+
+class WaveformCapture():
+    def __init__(
+        self,
+        device,
+        select_row_writes: list,
+        read_row_blocks: list,
+        begin_end_write: tuple,
+        channel_names: list,
+        channel_scalars: list,
+    ) -> None:
+        self.device = device
+        self.select_row_writes = select_row_writes
+        self.read_row_blocks = read_row_blocks
+        self.begin_end_write = begin_end_write
+        self.channel_names = channel_names
+        self.channel_scalars = channel_scalars
+
+        row_size = sum([size for _, size in read_row_blocks])
+        self.raw_rows = np.zeros((len(select_row_writes), row_size), dtype=np.uint16)
+
+        self.sinks = []
+        self.row = None
+        self.capture_datetime = None
+        self.last_waveform = None
+
+    def is_capturing(self) -> bool:
+        return self.row is not None
+
+    def get_last_waveform(self):
+        return self.last_waveform
+
+    def trigger(self, sinks: list):
+        """
+        Starts a new capture that is streamed to the given sinks ("disk"
+        and/or "redis") once complete. Ignored if a capture is running.
+        """
+        if self.is_capturing():
+            return False
+        self.sinks = sinks
+        self.row = -1
+        return True
+
+    def reset(self):
+        """
+        Abandons the capture in progress, if any.
+        """
+        self.row = None
+        self.sinks = []
+
+    def step(self):
+        """
+        Runs the next stage of the capture, if one is in progress. Returns the
+        decoded waveform when the capture completes, otherwise None.
+        """
+        if self.row is None:
+            return None
+
+        if self.row == -1:
+            self.capture_datetime = datetime.now(tz=timezone.utc)
+            self.device.write_modbus([self.begin_end_write])
+        else:
+            self.device.write_modbus([self.select_row_writes[self.row]])
+            self.raw_rows[self.row, :] = self.device.read_modbus(self.read_row_blocks, exact_count=True)
+
+        self.row += 1
+        if self.row < len(self.select_row_writes):
+            return None
+
+        self.device.write_modbus([self.begin_end_write])
+        self.row = None
+
+        self.last_waveform = decode_waveform(self.raw_rows, self.channel_scalars)
+        self.stream(self.last_waveform)
+        return self.last_waveform
+
+    def stream(self, waveform: np.ndarray):
+        if WAVEFORM_SINK_DISK in self.sinks:
+            self.save(waveform)
+        if WAVEFORM_SINK_REDIS in self.sinks:
+            self.publish(waveform)
+
+    def save(self, waveform: np.ndarray):
+        os.makedirs(WAVEFORM_DIRECTORY, exist_ok=True)
+        file_name = f"{self.device.get_module_name()}_{self.capture_datetime.strftime('%Y%m%dT%H%M%S%f')}.npy"
+        np.save(WAVEFORM_DIRECTORY + file_name, waveform)
+
+    def publish(self, waveform: np.ndarray):
+        reading = dict(
+            datetime=self.capture_datetime,
+            device_id=self.device.get_device_id(),
+            channels=self.channel_names)
+        for name, channel in zip(self.channel_names, waveform):
+            reading[name] = channel.tolist()
+        self.device.publish_reading("waveform", reading)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+WriteVerifier used to confirm that register writes were applied, without
+reading the registers back straight after each write.
+
+After a write the expected value of each written register is recorded. Every
+block read by the device is checked against the expected values, so registers
+inside the normal poll blocks are verified by the next scheduled read at no
+extra cost. Registers that have not been read within verify_timeout seconds
+are overdue and returned by get_overdue_blocks() for a small targeted read.
+
+Each expected value is resolved by the first read of its register: a match is
+counted as verified with the time it took, a different value is counted as a
+mismatch and reported as an event. Addresses are the 0-based addresses passed
+to write_registers/read_holding_registers.
+"""
+
+WRITE_MISMATCH_EVENT = "write_mismatch"
+
+
+class WriteVerifier():
+    def __init__(self, verify_timeout: float) -> None:
+        self.verify_timeout = verify_timeout
+
+        # address -> (expected uint16 value, time written)
+        self.expected = {}
+        self.events = []
+
+        self.writes_expected = 0
+        self.writes_verified = 0
+        self.mismatches = 0
+        self.targeted_reads = 0
+        self.total_verify_latency = 0
+        self.max_verify_latency = 0
+
+    def get_stats(self):
+        return {
+            "writes_expected": self.writes_expected,
+            "writes_verified": self.writes_verified,
+            "mismatches": self.mismatches,
+            "pending": len(self.expected),
+            "targeted_reads": self.targeted_reads,
+            "mean_verify_latency": self.total_verify_latency / self.writes_verified if self.writes_verified else None,
+            "max_verify_latency": self.max_verify_latency,
+        }
+
+    def expect(self, address: int, values: list, now: float):
+        """
+        Records the uint16 values written from address onwards. A new write to
+        an address replaces the value expected from an older one.
+        """
+        for index, value in enumerate(values):
+            self.expected[address + index] = (int(value) & 0xFFFF, now)
+        self.writes_expected += len(values)
+
+    def observe(self, register_blocks: list, raw_regs: list, now: float, exact_count: bool = False):
+        """
+        Checks the registers of a read against the expected values. The blocks
+        and exact_count are those passed to Edge_device.read_modbus().
+        """
+        if not self.expected:
+            return
+
+        index = 0
+        for start_register, number_registers in register_blocks:
+            count = number_registers if exact_count else number_registers - 1
+            for address in range(start_register, start_register + count):
+                if address in self.expected:
+                    self._resolve(address, raw_regs[index + address - start_register], now)
+            index += count
+
+    def _resolve(self, address: int, observed: int, now: float):
+        expected, time_written = self.expected.pop(address)
+        if observed == expected:
+            latency = now - time_written
+            self.writes_verified += 1
+            self.total_verify_latency += latency
+            self.max_verify_latency = max(self.max_verify_latency, latency)
+        else:
+            self.mismatches += 1
+            self.events.append({
+                "event": WRITE_MISMATCH_EVENT,
+                "address": address,
+                "expected": expected,
+                "observed": observed,
+                "time_written": time_written,
+            })
+
+    def get_overdue_blocks(self, now: float) -> list:
+        """
+        Returns (start, count) blocks, for a read with exact_count=True,
+        covering the registers not verified within verify_timeout.
+        Neighbouring registers are read together.
+        """
+        overdue = sorted([
+            address for address, (_, time_written) in self.expected.items()
+            if now - time_written > self.verify_timeout])
+
+        blocks = []
+        for address in overdue:
+            if blocks and address == blocks[-1][0] + blocks[-1][1]:
+                blocks[-1] = (blocks[-1][0], blocks[-1][1] + 1)
+            else:
+                blocks.append((address, 1))
+
+        self.targeted_reads += len(blocks)
+        return blocks
+
+    def pop_events(self) -> list:
+        events = self.events
+        self.events = []
+        return events